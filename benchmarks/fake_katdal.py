@@ -0,0 +1,288 @@
+"""
+Synthetic stand-in for katdal.visdatav4.VisibilityDataV4.
+
+The fake exposes the attributes and the select() behaviour that the RFI
+pipeline uses, with a configurable number of dumps, channels and antennas.
+Flags are generated lazily per dask chunk with a given RFI occupancy, so
+large observations can be simulated without the MeerKAT archive.
+"""
+import contextlib
+import re
+import zlib
+
+import dask.array as da
+import katdal
+import numpy as np
+
+# Correlator inputs of the polarisation products
+POL_INPUTS = {'HH': ('h', 'h'), 'VV': ('v', 'v'), 'HV': ('h', 'v'), 'VH': ('v', 'h')}
+# Bits of the raw flags, as in katdal.flags.NAMES
+FLAG_NAMES = ('reserved0', 'static', 'cam', 'data_lost', 'ingest_rfi', 'predicted_rfi',
+              'cal_rfi', 'postproc')
+
+
+class FakeAntenna(object):
+    """Antenna with a name and an ENU position in metres."""
+
+    def __init__(self, number, position_enu):
+        self.name = 'm{:03d}'.format(number)
+        self.position_enu = tuple(position_enu)
+
+
+class FakeTarget(object):
+    """Catalogue target with its tags."""
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = list(tags)
+
+
+class FakeCatalogue(object):
+    """Catalogue holding a list of targets."""
+
+    def __init__(self, targets):
+        self.targets = list(targets)
+
+
+class FakeSource(object):
+    """Data source with the capture block ID of the observation."""
+
+    def __init__(self, capture_block_id):
+        self.capture_block_id = capture_block_id
+
+
+class FakeLazyIndexer(object):
+    """
+    Lazy indexer over a dask array, like katdal.lazy_indexer.DaskLazyIndexer.
+
+    Indexing computes the selected part and returns a numpy array.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, keep):
+        return np.asarray(self.dataset[keep].compute())
+
+
+def _as_index(idx):
+    """Turn a contiguous index array into a slice, which dask indexes cheaply."""
+    if len(idx) and np.all(np.diff(idx) == 1):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+
+def _flag_block(block, occupancy, seed, block_info=None):
+    """
+    Draw the raw flags of one dask chunk, seeded by its position.
+
+    The cal_rfi bit is set with the given occupancy and the ingest_rfi bit
+    with half of it, independently.
+    """
+    location = block_info[0]['array-location']
+    occupancy = occupancy[location[1][0]:location[1][1], None]
+    raw = np.zeros(block.shape, dtype=np.uint8)
+    for bit, scale in ((FLAG_NAMES.index('cal_rfi'), 1.0), (FLAG_NAMES.index('ingest_rfi'), 0.5)):
+        rng = np.random.default_rng([seed, bit, location[0][0], location[1][0], location[2][0]])
+        raw |= (rng.random(block.shape) < scale * occupancy).astype(np.uint8) << bit
+    return raw
+
+
+class FakeVisibilityData(object):
+    """
+    Synthetic observation with the interface of VisibilityDataV4.
+
+    Every dump is a track of a target tagged 'target'. The pointing drifts
+    slowly in azimuth and elevation, and the cal_rfi flags of every channel
+    and correlation product are set independently with probability
+    `occupancy`, raised to `band_occupancy` in a few bands of persistent
+    RFI. The ingest_rfi flags are set with half of that probability.
+
+    Parameters:
+    -----------
+    path : str
+        name of the observation, its ten digit capture block ID is kept. default: ''
+    ndumps : int
+        number of dumps. default: 256
+    nchan : int
+        number of frequency channels. default: 4096
+    nant : int
+        number of antennas. default: 16
+    occupancy : float
+        probability of a flag outside the RFI bands. default: 0.05
+    band_occupancy : float
+        probability of a flag inside the RFI bands. default: 0.9
+    dump_period : float
+        dump period in seconds. default: 8.0
+    start_time : float
+        unix time of the first dump. default: 1.7e9
+    stopped_ants : int
+        number of antennas whose activity sensor reports 'stop'. default: 0
+    time_chunk : int
+        dumps per dask chunk of the flags. default: 8
+    chan_chunk : int
+        channels per dask chunk of the flags. default: 1024
+    seed : int
+        seed of the pointing and flags. default: derived from `path`
+    """
+
+    def __init__(self, path='', ndumps=256, nchan=4096, nant=16, occupancy=0.05,
+                 band_occupancy=0.9, dump_period=8.0, start_time=1.7e9, stopped_ants=0,
+                 time_chunk=8, chan_chunk=1024, seed=None):
+        match = re.search(r'\d{10}', path)
+        cbid = match.group(0) if match else '1700000000'
+        self.seed = zlib.crc32(cbid.encode()) if seed is None else seed
+        rng = np.random.default_rng(self.seed)
+        self.name = path
+        self.source = FakeSource(cbid)
+        self.dump_period = float(dump_period)
+        # The pads of the array are the same in every observation
+        self.ants = [FakeAntenna(n, np.random.default_rng(n).uniform(-4000, 4000, 3) *
+                                 [1, 1, 0.01]) for n in range(nant)]
+        self.sensor = {}
+        for n, ant in enumerate(self.ants):
+            activity = 'stop' if n >= nant - stopped_ants else 'track'
+            self.sensor[ant.name + '_activity'] = np.full(ndumps, activity)
+        self.catalogue = FakeCatalogue([FakeTarget('J1939-6342', ['radec', 'target']),
+                                        FakeTarget('J1331+3030', ['radec', 'bpcal'])])
+        self.target_indices = [0]
+        self._timestamps = start_time + self.dump_period * np.arange(ndumps)
+        drift = np.arange(ndumps)[:, None] * self.dump_period / 240.
+        self._az = (rng.uniform(0, 360) + drift + rng.normal(0, 0.01, (ndumps, nant))) % 360
+        self._el = np.clip(rng.uniform(15, 85) + 0.2 * drift + rng.normal(0, 0.01, (ndumps, nant)),
+                           0, 90)
+        self._freqs = 856e6 + 856e6 * np.arange(nchan) / nchan
+        # Persistent RFI bands, such as GSM and GNSS, at fixed fractions of the band
+        self._occupancy = np.full(nchan, occupancy)
+        for start, stop in ((0.08, 0.12), (0.40, 0.42), (0.70, 0.76)):
+            self._occupancy[int(start * nchan):int(stop * nchan)] = band_occupancy
+        self._chunks = (time_chunk, chan_chunk)
+        # Flags are drawn for every correlation product, so that they do not
+        # depend on the selection
+        self._every = self._all_products('all')
+        self._columns = {tuple(product): n for n, product in enumerate(self._every)}
+        self.select()
+
+    def select(self, reset='auto', dumps=None, channels=None, corrprods='cross', pol=None,
+               ants=None, scans=None, targets=None, flags=None, **kwargs):
+        """
+        Select dumps, channels, correlation products and flag types.
+
+        Scan and target selections keep all dumps, since every dump is a
+        track of a good target. With reset='' the channel and dump selections
+        refine the current ones, as in katdal, and a reset of 'T', 'F' or 'B'
+        only clears the selection of the time, frequency or baseline axis.
+        `pol` is one polarisation, a comma separated string or a list of them.
+        """
+        reset = 'TFB' if reset == 'auto' or not hasattr(self, '_dumps') else reset
+        if 'T' in reset:
+            self._dumps = np.arange(len(self._timestamps))
+        if 'F' in reset:
+            self._channels = np.arange(len(self._freqs))
+        if 'B' in reset:
+            self._products = self._all_products()
+        if dumps is not None:
+            self._dumps = self._dumps[dumps]
+        if channels is not None:
+            self._channels = self._channels[channels]
+        if reset == 'TFB' or pol is not None or ants is not None:
+            self._products = self._all_products(corrprods, pol, ants)
+        if reset == 'TFB' or flags is not None:
+            self.flag_type = flags
+
+    def _all_products(self, corrprods='cross', pol=None, ants=None):
+        """Correlation products of the selected antennas and polarisations."""
+        names = [ant.name for ant in self.ants if ants is None or ant.name in ants]
+        if isinstance(pol, str):
+            pol = pol.split(',')
+        pols = [POL_INPUTS[p] for p in pol] if pol else list(POL_INPUTS.values())
+        products = []
+        for i, first in enumerate(names):
+            seconds = {'auto': names[i:i + 1], 'cross': names[i + 1:], 'all': names[i:]}
+            for second in seconds[corrprods]:
+                products.extend((first + p, second + q) for p, q in pols)
+        return np.array(products).reshape(-1, 2)
+
+    @property
+    def corr_products(self):
+        return self._products
+
+    @property
+    def freqs(self):
+        return self._freqs[self._channels]
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def timestamps(self):
+        return self._timestamps[self._dumps]
+
+    @property
+    def dumps(self):
+        return self._dumps
+
+    @property
+    def az(self):
+        return self._az[self._dumps]
+
+    @property
+    def el(self):
+        return self._el[self._dumps]
+
+    @property
+    def shape(self):
+        return (len(self._dumps), len(self._channels), len(self._products))
+
+    def _raw_dataset(self):
+        """Lazy raw flags of the selected dumps, channels and products."""
+        ntime, nchan = len(self._timestamps), len(self._freqs)
+        shape = (ntime, nchan, len(self._every))
+        template = da.zeros(shape, dtype=np.uint8, chunks=self._chunks + (shape[2],))
+        dataset = template.map_blocks(_flag_block, self._occupancy, self.seed, dtype=np.uint8)
+        columns = np.array([self._columns[tuple(product)] for product in self._products],
+                           dtype=int)
+        dataset = dataset[_as_index(self._dumps)][:, _as_index(self._channels)]
+        return dataset[:, :, _as_index(columns)]
+
+    @property
+    def raw_flags(self):
+        """Lazy uint8 raw flags of the selection with dimension of [T, F, B]."""
+        return FakeLazyIndexer(self._raw_dataset())
+
+    @property
+    def flags(self):
+        """Lazy flags of the selected flag types with dimension of [T, F, B]."""
+        names = FLAG_NAMES if self.flag_type is None else self.flag_type.split(',')
+        mask = sum(1 << FLAG_NAMES.index(name) for name in set(names))
+        return FakeLazyIndexer((self._raw_dataset() & mask) != 0)
+
+
+@contextlib.contextmanager
+def fake_archive(**options):
+    """
+    Make katdal.open return FakeVisibilityData objects inside the block.
+
+    Parameters:
+    -----------
+    options : dict
+        keyword arguments of FakeVisibilityData, applied to every opened file
+    """
+    original = katdal.open
+    katdal.open = lambda path, **kwargs: FakeVisibilityData(path, **options)
+    try:
+        yield
+    finally:
+        katdal.open = original
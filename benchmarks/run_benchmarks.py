@@ -0,0 +1,180 @@
+"""
+Offline benchmarks of the RFI statistics pipeline on synthetic observations.
+
+The hot functions and a whole observation run are timed on data from
+fake_katdal, so no archive access is needed. Every benchmark reports its
+best wall time, its throughput and the peak resident memory of the process
+so far. Results can be appended to a JSON lines file to compare runs.
+
+Usage:
+    python benchmarks/run_benchmarks.py --dumps 256 --channels 4096 --ants 16
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_katdal  # noqa: E402
+import kathprfi_pipeline as kp  # noqa: E402
+import kathprfi_single_file as kathp  # noqa: E402
+
+
+def peak_rss():
+    """Peak resident memory of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def timed(func, repeat):
+    """
+    Time a function, after one untimed call that compiles and warms caches.
+
+    Parameters:
+    -----------
+    func : callable
+        function without arguments
+    repeat : int
+        number of timed calls
+
+    Returns:
+    --------
+    output : tuple
+        best time in seconds and the duration of the first call
+    """
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best, first
+
+
+def report(results, name, seconds, first, items, unit):
+    """Print one benchmark result and add it to `results`."""
+    result = {'name': name, 'seconds': seconds, 'first_call_seconds': first,
+              'items': int(items), 'unit': unit, 'throughput': items / seconds,
+              'peak_rss_mb': peak_rss()}
+    results.append(result)
+    print('{:<32} {:>10.4f} s {:>12.3e} {}/s {:>10.1f} MB peak'.format(
+        name, seconds, result['throughput'], unit, result['peak_rss_mb']))
+
+
+def bench_index_builders(results, vis, repeat):
+    """Time the pointing, time, elevation, azimuth and baseline index builders."""
+    ndumps = vis.shape[0]
+    el, az = kathp.get_az_and_el(vis)
+    benches = [('get_az_and_el', lambda: kathp.get_az_and_el(vis), ndumps, 'dumps'),
+               ('get_time_idx', lambda: kathp.get_time_idx(vis), ndumps, 'dumps'),
+               ('get_el_idx', lambda: kathp.get_el_idx(el, kp.ELBINS), ndumps, 'dumps'),
+               ('get_az_idx', lambda: kathp.get_az_idx(az, kp.AZBINS), ndumps, 'dumps'),
+               ('get_bl_idx', lambda: kathp.get_bl_idx(vis, len(vis.ants)),
+                vis.shape[2], 'products')]
+    for name, func, items, unit in benches:
+        seconds, first = timed(func, repeat)
+        report(results, name, seconds, first, items, unit)
+
+
+def bench_new_flag_chunk(results, flags, repeat, factor=8):
+    """Time the reduction of a flag block by `factor` channels."""
+    wide = np.repeat(flags, factor, axis=1)
+    seconds, first = timed(lambda: kathp.NewFlagChunk(wide, factor), repeat)
+    report(results, 'NewFlagChunk x{}'.format(factor), seconds, first, wide.size, 'flags')
+
+
+def bench_update_arrays(results, flags, repeat, ncells=4):
+    """
+    Time every update kernel on boolean and bit-packed flags.
+
+    The dumps are spread over `ncells` time cells of a dense cube with a
+    single elevation and azimuth bin.
+    """
+    ntime, nchan, nprod = flags.shape
+    Time_idx = (np.arange(ntime) * ncells // ntime).astype(np.int32)
+    zeros = np.zeros(ntime, dtype=np.int32)
+    Bl_idx = np.arange(nprod, dtype=np.int32)
+    packed = np.packbits(flags, axis=1)
+    for engine, kernel in sorted(kathp.UPDATE_ENGINES.items()):
+        for is_packed, block in ((False, flags), (True, packed)):
+            master = np.zeros((ncells, nchan, nprod, 1, 1), dtype=np.uint16)
+            counter = np.zeros_like(master)
+            seconds, first = timed(lambda: kernel(Time_idx, Bl_idx, zeros, zeros, block,
+                                                  master, counter, is_packed), repeat)
+            name = '{} {}'.format(engine, 'packed' if is_packed else 'bool')
+            report(results, name, seconds, first, flags.size, 'flags')
+
+
+def bench_end_to_end(results, options, config, repeat, time_chunk, engine):
+    """Time processing a whole synthetic observation and merging it into a store."""
+    path = 'benchmark/1700000000_sdp_l0.full.rdb'
+    workdir = tempfile.mkdtemp(prefix='kathprfi_bench_')
+    runs = []
+
+    def run():
+        store = os.path.join(workdir, 'master{}.zarr'.format(len(runs)))
+        runs.append(store)
+        with fake_katdal.fake_archive(**options):
+            acc, freqs = kp.process_observation(path, config, time_chunk=time_chunk,
+                                                engine=engine)
+        kp.merge_observation(store, acc, freqs, [str(len(runs))], config)
+
+    try:
+        seconds, first = timed(run, repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    vis = fake_katdal.FakeVisibilityData(path, **options)
+    vis.select(corrprods=config['corrprod'], pol=config['pol_to_use'])
+    report(results, 'end to end ({})'.format(engine), seconds, first,
+           int(np.prod(vis.shape)), 'flags')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-d', '--dumps', type=int, default=256, help='Dumps per observation')
+    parser.add_argument('-c', '--channels', type=int, default=4096, help='Frequency channels')
+    parser.add_argument('-a', '--ants', type=int, default=16, help='Number of antennas')
+    parser.add_argument('-o', '--occupancy', type=float, default=0.05,
+                        help='Flag probability outside the RFI bands')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed calls per benchmark')
+    parser.add_argument('-t', '--time-chunk', type=int, default=32,
+                        help='Minimum number of dumps per flag block')
+    parser.add_argument('-e', '--engine', default='scatter', choices=sorted(kathp.ENGINES),
+                        help='Update kernel of the end to end run')
+    parser.add_argument('-j', '--json', help='Append the results to this JSON lines file')
+    args = parser.parse_args()
+
+    options = {'ndumps': args.dumps, 'nchan': args.channels, 'nant': args.ants,
+               'occupancy': args.occupancy}
+    config = {'corrprod': 'cross', 'scan': 'track', 'flag_type': 'cal_rfi',
+              'pol_to_use': 'HH', 'correlator_mode': '4k', 'dump_period': '8',
+              'time_frame': 'SAST', 'time_bin_minutes': '60', 'nant': str(args.ants)}
+    print('{} dumps, {} channels, {} antennas, occupancy {}'.format(
+        args.dumps, args.channels, args.ants, args.occupancy))
+
+    results = []
+    vis = fake_katdal.FakeVisibilityData(**options)
+    vis.select(corrprods='cross', pol='HH')
+    bench_index_builders(results, vis, args.repeat)
+    flags = vis.flags[:args.time_chunk]
+    bench_new_flag_chunk(results, flags, args.repeat)
+    bench_update_arrays(results, flags, args.repeat)
+    bench_end_to_end(results, options, config, args.repeat, args.time_chunk, args.engine)
+
+    if args.json:
+        with open(args.json, 'a') as output:
+            output.write(json.dumps({'time': time.time(), 'options': options,
+                                     'time_chunk': args.time_chunk,
+                                     'results': results}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Numba kernels that add flag blocks to the master and counter arrays.
+
+The kernels live apart from kathprfi_single_file so that numba is only
+imported by the processes that update arrays. They are compiled with
+cache=True, so the compiled specialisations are stored next to this module
+(or in NUMBA_CACHE_DIR) and later processes load them instead of compiling.
+warmup() compiles or loads the specialisations used by the pipeline up front.
+"""
+import logging
+import time
+
+import numpy as np
+from numba import jit
+from numba import prange
+
+
+@jit(nopython=True, nogil=True, inline='always', cache=True)
+def get_flag(Good_flags, j, k, i, factor, Packed):
+    """
+    Get the flag of output channel k, the OR of its `factor` input channels.
+
+    Packed flags hold 8 channels per byte, most significant bit first, as
+    produced by np.packbits along the channel axis. When `factor` is a
+    multiple of 8 whole bytes are tested at once.
+    """
+    if not Packed:
+        for c in range(k * factor, (k + 1) * factor):
+            if Good_flags[j, c, i]:
+                return 1
+        return 0
+    if factor % 8 == 0:
+        for b in range(k * factor // 8, (k + 1) * factor // 8):
+            if Good_flags[j, b, i]:
+                return 1
+        return 0
+    for c in range(k * factor, (k + 1) * factor):
+        if (Good_flags[j, c >> 3, i] >> (7 - (c & 7))) & 1:
+            return 1
+    return 0
+
+
+@jit(nopython=True, parallel=True, nogil=True, cache=True)
+def update_arrays(Time_idx, Bl_idx, El_idx, Az_idx, Good_flags, Master, Counter, Packed=False):
+    """
+    Update the master and counter array
+
+    Dumps with a negative time, elevation or azimuth index are skipped. If
+    the flags have `factor` times more channels than Master, every output
+    channel is flagged when any of its `factor` input channels is flagged.
+
+    Parameters:
+    -----------
+    Time_idx : numpy array
+        time indices per dump
+    Bl_idx : numpy array
+        baseline indices per correlation product
+    El_idx : numpy array
+        elevation indices per dump
+    Az_idx : numpy array
+        azimuth indices per dump
+    Good_flags : numpy array
+        flags with dimension of [T, F, B], or [T, F // 8, B] if packed
+    Master : numpy array
+       array contains the number of RFI points per voxel with dimension of [T, F, B, El, Az]
+    Counter : numpy array
+      array contains the total number of observations per voxel with dimension of [T, F, B, El, Az]
+    Packed : bool
+        the flags are bit-packed along the channel axis. default: False
+
+    Returns:
+    -------
+    output : numpy array
+      updated master and counter array
+    """
+   
+    nchan = Master.shape[1]
+    if Packed:
+        factor = 8 * Good_flags.shape[1] // nchan
+    else:
+        factor = Good_flags.shape[1] // nchan
+    cstep = 128
+    cblocks = (nchan + cstep - 1) // cstep
+    for cblock in prange(cblocks):
+        c_start = cblock * cstep
+        c_end = min(nchan, c_start + cstep)
+        for k in range(c_start, c_end):
+            for i in range(len(Bl_idx)):
+                for j in range(len(Time_idx)):
+                    if Time_idx[j] < 0 or El_idx[j] < 0 or Az_idx[j] < 0:
+                        continue
+                    flag = get_flag(Good_flags, j, k, i, factor, Packed)
+                    Master[Time_idx[j], k, Bl_idx[i], El_idx[j], Az_idx[j]] += flag
+                    Counter[Time_idx[j], k, Bl_idx[i], El_idx[j], Az_idx[j]] += 1
+    return Master, Counter
+
+
+@jit(nopython=True, parallel=True, nogil=True, cache=True)
+def update_arrays_grouped(Time_idx, Bl_idx, El_idx, Az_idx, Good_flags, Master, Counter,
+                          Packed=False):
+    """
+    Update the master and counter array, reducing over time before scattering.
+
+    The dumps are grouped by their (time, elevation, azimuth) voxel and the
+    flags of every group are summed over the time axis first. Each voxel is
+    then updated once, with the counter incremented by the number of dumps in
+    the group. Dumps with a negative index are skipped and input channels are
+    reduced to the Master channels as in update_arrays. The result is
+    identical to update_arrays.
+
+    Parameters:
+    -----------
+    Time_idx : numpy array
+        time indices per dump
+    Bl_idx : numpy array
+        baseline indices per correlation product
+    El_idx : numpy array
+        elevation indices per dump
+    Az_idx : numpy array
+        azimuth indices per dump
+    Good_flags : numpy array
+        flags with dimension of [T, F, B], or [T, F // 8, B] if packed
+    Master : numpy array
+       array contains the number of RFI points per voxel with dimension of [T, F, B, El, Az]
+    Counter : numpy array
+      array contains the total number of observations per voxel with dimension of [T, F, B, El, Az]
+    Packed : bool
+        the flags are bit-packed along the channel axis. default: False
+
+    Returns:
+    -------
+    output : numpy array
+      updated master and counter array
+    """
+    nchan = Master.shape[1]
+    if Packed:
+        factor = 8 * Good_flags.shape[1] // nchan
+    else:
+        factor = Good_flags.shape[1] // nchan
+    nbl = len(Bl_idx)
+    keys = (Time_idx.astype(np.int64) * Master.shape[3] + El_idx) * Master.shape[4] + Az_idx
+    # Dumps outside the bins are left out of the groups
+    valid = (Time_idx >= 0) & (El_idx >= 0) & (Az_idx >= 0)
+    order = np.nonzero(valid)[0][np.argsort(keys[valid])]
+    ntime = len(order)
+    # Start of every group of dumps sharing a voxel in the sorted order
+    starts = np.empty(ntime + 1, dtype=np.int64)
+    ngroups = 0
+    for jj in range(ntime):
+        if jj == 0 or keys[order[jj]] != keys[order[jj - 1]]:
+            starts[ngroups] = jj
+            ngroups += 1
+    starts[ngroups] = ntime
+    for k in prange(nchan):
+        sums = np.zeros(nbl, dtype=np.int64)
+        for g in range(ngroups):
+            sums[:] = 0
+            for jj in range(starts[g], starts[g + 1]):
+                j = order[jj]
+                for i in range(nbl):
+                    sums[i] += get_flag(Good_flags, j, k, i, factor, Packed)
+            j = order[starts[g]]
+            ndumps = starts[g + 1] - starts[g]
+            for i in range(nbl):
+                Master[Time_idx[j], k, Bl_idx[i], El_idx[j], Az_idx[j]] += sums[i]
+                Counter[Time_idx[j], k, Bl_idx[i], El_idx[j], Az_idx[j]] += ndumps
+    return Master, Counter
+
+
+# Kernels that can be selected with the `engine` argument of SparseAccumulator
+UPDATE_ENGINES = {'scatter': update_arrays, 'grouped': update_arrays_grouped}
+
+
+def warmup(engines=None, dtypes=(np.uint16, np.uint32), packed=(True, False)):
+    """
+    Compile, or load from the cache, the kernel specialisations used by the pipeline.
+
+    Every kernel is called once on a tiny block for every combination of
+    count dtype and flag layout, so the first real update does not pay for
+    the compilation.
+
+    Parameters:
+    -----------
+    engines : list
+        keys of UPDATE_ENGINES to warm up. default: all of them
+    dtypes : tuple
+        dtypes of the master and counter arrays. default: (np.uint16, np.uint32)
+    packed : tuple
+        flag layouts to warm up, True for bit-packed and False for boolean flags.
+        default: (True, False)
+
+    Returns:
+    --------
+    output : float
+        seconds taken
+    """
+    start = time.time()
+    idx = np.zeros(1, dtype=np.int32)
+    for engine in engines or sorted(UPDATE_ENGINES):
+        for dtype in dtypes:
+            master = np.zeros((1, 8, 1, 1, 1), dtype=dtype)
+            for is_packed in packed:
+                flags = np.zeros((1, 1 if is_packed else 8, 1),
+                                 dtype=np.uint8 if is_packed else np.bool_)
+                UPDATE_ENGINES[engine](idx, idx, idx, idx, flags, master, master.copy(),
+                                       is_packed)
+    elapsed = time.time() - start
+    logging.info('Update kernels are ready after {:.1f} s'.format(elapsed))
+    return elapsed
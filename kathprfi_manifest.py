@@ -0,0 +1,115 @@
+"""
+Durable job manifest of the processed, bad and in-flight observations.
+
+The manifest is a JSON lines file with one record per status change of an
+observation. The last record of a file gives its current status, so a
+restarted run can skip the completed and bad files and retry the others.
+"""
+import json
+import os
+import threading
+import time
+
+# Statuses of the observations recorded in the manifest
+STARTED = 'started'
+DONE = 'done'
+BAD = 'bad'
+FAILED = 'failed'
+
+# Statuses that are not processed again by a restarted run
+FINAL = (DONE, BAD)
+
+
+class Manifest(object):
+    """
+    Append-only JSON lines manifest of a processing job.
+
+    Every record holds the file, its status, the time of the change and the
+    number of attempts. Records that end an attempt add the elapsed time and
+    the failure reason or the output location.
+
+    Parameters:
+    -----------
+    path : str
+        path of the manifest file, created if it does not exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self._started = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    # A line cut short by a crash is ignored
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record['file']] = record
+
+    def status(self, filename):
+        """
+        Get the current status of a file, None if it was never started.
+        """
+        record = self.records.get(filename)
+        return record['status'] if record else None
+
+    def pending(self, filenames):
+        """
+        Get the files that still have to be processed.
+
+        Parameters:
+        -----------
+        filenames : list
+            all the files of the job
+
+        Returns:
+        --------
+        output : list
+            files that were never started, failed or were in flight when
+            the previous run stopped
+        """
+        return [filename for filename in filenames if self.status(filename) not in FINAL]
+
+    def files(self, status):
+        """
+        Get the files that currently have the given status.
+        """
+        return [filename for filename, record in self.records.items()
+                if record['status'] == status]
+
+    def _write(self, filename, status, **fields):
+        with self._lock:
+            record = {'file': filename, 'status': status, 'time': time.time(),
+                      'attempts': self.records.get(filename, {}).get('attempts', 0)}
+            if status == STARTED:
+                record['attempts'] += 1
+                self._started[filename] = record['time']
+            elif filename in self._started:
+                record['elapsed'] = record['time'] - self._started.pop(filename)
+            record.update(fields)
+            with open(self.path, 'a') as manifest:
+                manifest.write(json.dumps(record) + '\n')
+                manifest.flush()
+                os.fsync(manifest.fileno())
+            self.records[filename] = record
+            return record
+
+    def start(self, filename):
+        """Record that a file is being processed."""
+        return self._write(filename, STARTED)
+
+    def done(self, filename, output=None):
+        """Record that a file has been processed and where its output went."""
+        return self._write(filename, DONE, output=output)
+
+    def bad(self, filename, reason):
+        """Record that a file cannot contribute to the statistics."""
+        return self._write(filename, BAD, reason=str(reason))
+
+    def failed(self, filename, reason):
+        """Record that processing a file raised an error, so it is retried."""
+        return self._write(filename, FAILED, reason=str(reason))
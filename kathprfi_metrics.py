@@ -0,0 +1,192 @@
+"""
+Per-stage timing and memory instrumentation of the processing of observations.
+
+A StageTimer collects the wall time, number of calls and resident memory
+high-water mark of every stage of one observation, together with counters
+such as the bytes of flags fetched and the number of flags processed. The
+resident memory is sampled at the start and end of every call, since the
+peak of the process only ever grows over a run of many observations. A MetricsLog
+writes one JSON lines record per observation, so long runs can be broken
+down by stage afterwards.
+"""
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+# Stages of the processing of an observation, in the order they run
+STAGES = ('open', 'check', 'antenna screening', 'selection', 'index build', 'flag fetch',
+          'io wait', 'kernel', 'zarr write')
+
+
+def peak_rss():
+    """Peak resident memory of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def current_rss():
+    """Current resident memory of the process in MB, the peak where /proc is missing."""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return peak_rss()
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.**2
+
+
+class StageTimer(object):
+    """
+    Wall time, calls and memory of the processing stages of one observation.
+
+    Parameters:
+    -----------
+    filename : str
+        observation that is timed. default: ''
+    """
+
+    def __init__(self, filename=''):
+        self.filename = filename
+        self.start = time.time()
+        self.stages = {}
+        self.counts = {'bytes_fetched': 0, 'flags': 0}
+        self.rss = current_rss()
+
+    def sample(self):
+        """Sample the resident memory into the high-water mark of the observation."""
+        rss = current_rss()
+        self.rss = max(self.rss, rss)
+        return rss
+
+    def record(self, name, seconds, rss=0.0):
+        """Add a call of `seconds` to stage `name`, whose memory started at `rss` MB."""
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_rss_mb': 0.0})
+        stage['seconds'] += seconds
+        stage['calls'] += 1
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], rss, self.sample())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the code of the with block as a call of stage `name`.
+
+        Parameters:
+        -----------
+        name : str
+            name of the stage, preferably one of STAGES
+        """
+        rss = self.sample()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.record(name, time.perf_counter() - start, rss)
+
+    def iterate(self, name, iterable):
+        """
+        Time every step of an iterator, such as lazily fetched flag blocks.
+
+        Parameters:
+        -----------
+        name : str
+            name of the stage
+        iterable : iterable
+            iterator whose steps are timed
+
+        Returns:
+        --------
+        output : generator
+            the items of the iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            rss = self.sample()
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.record(name, time.perf_counter() - start, rss)
+            yield item
+
+    def count(self, **counts):
+        """
+        Add to the counters, e.g. count(bytes_fetched=..., flags=...).
+
+        bytes_fetched is the size of the flags as read from katdal, before
+        they are packed.
+        """
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + int(value)
+
+    def as_dict(self):
+        """
+        Get the metrics of the observation.
+
+        Returns:
+        --------
+        output : dict
+            file, total wall time, memory high-water mark of the observation
+            and peak of the process, counters, flags per second in the
+            kernel and the time, calls and memory high-water mark of every stage
+        """
+        order = {name: n for n, name in enumerate(STAGES)}
+        stages = dict(sorted(self.stages.items(), key=lambda item: order.get(item[0], len(order))))
+        kernel = stages.get('kernel', {}).get('seconds', 0)
+        record = {'file': self.filename, 'total_seconds': time.time() - self.start,
+                  'peak_rss_mb': max(self.rss, self.sample()),
+                  'process_peak_rss_mb': peak_rss(), 'stages': stages}
+        record.update(self.counts)
+        record['kernel_flags_per_second'] = self.counts['flags'] / kernel if kernel else None
+        return record
+
+
+class MetricsLog(object):
+    """
+    JSON lines file with the stage metrics of every observation of a run.
+
+    Parameters:
+    -----------
+    path : str
+        path of the metrics file, appended to if it exists
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def timer(self, filename):
+        """Get the StageTimer of an observation, starting it on first use."""
+        with self._lock:
+            if filename not in self._timers:
+                self._timers[filename] = StageTimer(filename)
+            return self._timers[filename]
+
+    def add(self, timer):
+        """Adopt a StageTimer filled elsewhere, e.g. in a worker process."""
+        with self._lock:
+            self._timers[timer.filename] = timer
+
+    def write(self, filename, **fields):
+        """
+        Write the metrics of an observation and forget its timer.
+
+        Parameters:
+        -----------
+        filename : str
+            observation whose metrics are written
+        fields : dict
+            extra fields of the record, such as the status or the error
+        """
+        with self._lock:
+            timer = self._timers.pop(filename, None) or StageTimer(filename)
+            record = timer.as_dict()
+            record.update(fields)
+            with open(self.path, 'a') as metrics:
+                metrics.write(json.dumps(record) + '\n')
+                metrics.flush()
+                os.fsync(metrics.fileno())
+            return record
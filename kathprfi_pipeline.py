@@ -0,0 +1,1768 @@
+"""
+Processing of whole observations into sparse master and counter accumulators,
+either one observation at a time, several at once in worker processes, or
+on a dask cluster.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from queue import Queue
+
+import numpy as np
+
+import kathprfi_metrics as kmetrics
+import kathprfi_single_file as kathp
+import kathprfi_store as kstore
+from kathprfi_manifest import BAD, DONE, Manifest
+
+# Number of frequency channels of every correlator mode
+CORRELATOR_CHANNELS = {'1k': 1024, '4k': 4096, '32k': 32768}
+
+# Number of channels, antennas and baselines of the accumulated cubes.
+# Observations with more channels are averaged onto NFREQ channels.
+NFREQ = 4096
+NANT = 64
+NBL = NANT * (NANT - 1) // 2
+
+# Lower edges of the elevation and azimuth bins
+ELBINS = np.linspace(10, 80, 8)
+AZBINS = np.arange(0, 360, 15)
+
+# Binnings of the baseline axis: antenna pairs, baseline length bins or antennas
+BASELINE_BINNINGS = ('raw', 'length', 'antenna')
+# Lower edges of the default baseline length bins in metres
+LENGTH_BINS = np.array([0, 50, 100, 200, 500, 1000, 2000, 4000, 8000], dtype=float)
+
+
+class BadObservation(Exception):
+    """An observation that cannot contribute to the statistics."""
+
+
+def check_observation(vis, config):
+    """
+    Check an observation against the configuration from its metadata only.
+
+    Parameters:
+    -----------
+    vis : katdal.visdatav4.VisibilityDataV4
+       katdal data object
+    config : dict
+        processing configuration with 'correlator_mode', 'dump_period' and 'scan'
+
+    Raises:
+    -------
+    BadObservation
+        if the observation does not match the configuration
+    """
+    reason = kathp.prescreen(vis, CORRELATOR_CHANNELS[config['correlator_mode']],
+                             int(config['dump_period']), config['scan'])
+    if reason is not None:
+        raise BadObservation(reason)
+
+
+def _prescreen_file(path, config):
+    """
+    Open one file and return the reason to reject it, None if it passes.
+    Files that cannot be opened pass, so that the main pass records them as failed.
+    """
+    try:
+        vis = kathp.readfile(path)
+        check_observation(vis, config)
+    except BadObservation as e:
+        return str(e)
+    except Exception as e:
+        logging.info('{} cannot be pre-screened: {}'.format(path, e))
+    return None
+
+
+def prescreen_files(paths, config, workers=8):
+    """
+    Screen many files from their metadata, opening them concurrently.
+
+    Opening a file only fetches its metadata, which is I/O bound, so the
+    files are screened in a pool of threads.
+
+    Parameters:
+    -----------
+    paths : list
+        RDB files
+    config : dict
+        processing configuration
+    workers : int
+        number of files opened concurrently. default: 8
+
+    Returns:
+    --------
+    output : tuple
+        list of accepted files and dict of rejected files with their reason
+    """
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        reasons = list(pool.map(_prescreen_file, paths, [config] * len(paths)))
+    accepted = [path for path, reason in zip(paths, reasons) if reason is None]
+    rejected = {path: reason for path, reason in zip(paths, reasons) if reason is not None}
+    return accepted, rejected
+
+
+def channel_factor(nchan, config):
+    """
+    Get the number of channels that are averaged into one accumulated channel.
+
+    Parameters:
+    -----------
+    nchan : int
+        number of channels of the observation
+    config : dict
+        processing configuration, an optional 'channel_factor' overrides the
+        default of averaging onto NFREQ channels
+
+    Returns:
+    --------
+    output : int
+        number of channels averaged together
+    """
+    if config.get('channel_factor'):
+        factor = int(config['channel_factor'])
+    else:
+        factor = max(1, nchan // NFREQ)
+    if nchan % factor:
+        raise BadObservation('{} channels cannot be averaged by {}'.format(nchan, factor))
+    return factor
+
+
+def baseline_binning(config):
+    """Get the binning of the baseline axis from an optional 'baseline_binning' entry."""
+    binning = config.get('baseline_binning') or 'raw'
+    if binning not in BASELINE_BINNINGS:
+        raise ValueError('Unknown baseline binning {!r}, expected one of {}'.format(
+            binning, BASELINE_BINNINGS))
+    return binning
+
+
+def length_bins(config):
+    """
+    Get the lower edges of the baseline length bins in metres, from an
+    optional 'baseline_edges' entry of comma separated edges that defaults
+    to LENGTH_BINS. The last bin holds all longer baselines.
+    """
+    if not config.get('baseline_edges'):
+        return LENGTH_BINS
+    edges = np.array([float(edge) for edge in config['baseline_edges'].split(',')])
+    if edges[0] != 0 or np.any(np.diff(edges) <= 0):
+        raise ValueError('Baseline length edges {} must increase from 0'.format(
+            config['baseline_edges']))
+    return edges
+
+
+def num_baselines(config):
+    """
+    Get the length of the baseline axis: the number of baselines of the
+    array, from an optional 'nant' configuration entry that defaults to NANT
+    antennas, the number of antennas or the number of length bins.
+    """
+    binning = baseline_binning(config)
+    if binning == 'length':
+        return len(length_bins(config))
+    nant = int(config.get('nant') or NANT)
+    if binning == 'antenna':
+        return nant
+    return nant * (nant - 1) // 2
+
+
+def baseline_coords(config):
+    """
+    Get the coordinate of the baseline axis, with attributes that describe the binning.
+
+    Parameters:
+    -----------
+    config : dict
+        processing configuration
+
+    Returns:
+    --------
+    output : xarray.DataArray
+        baseline index into the antenna pairs of baseline_lut, lower edge of
+        the length bin in metres or antenna number
+    """
+    import xarray as xr
+    binning = baseline_binning(config)
+    if binning == 'length':
+        return xr.DataArray(length_bins(config), dims='baseline',
+                            attrs={'binning': binning, 'units': 'm',
+                                   'description': 'lower edge of the baseline length bin'})
+    description = {'raw': 'index of the antenna pair',
+                   'antenna': 'antenna number, counting every baseline of the antenna'}
+    return xr.DataArray(np.arange(num_baselines(config)), dims='baseline',
+                        attrs={'binning': binning, 'description': description[binning]})
+
+
+def length_coords(config):
+    """Get the coordinate of the baseline length classes, from the edges of length_bins."""
+    import xarray as xr
+    return xr.DataArray(length_bins(config), dims=kstore.LENGTH,
+                        attrs={'units': 'm',
+                               'description': 'lower edge of the baseline length bin'})
+
+
+def baseline_idx(vis, config):
+    """
+    Get the baseline axis indices of the correlation products of a selection.
+
+    Parameters:
+    -----------
+    vis : katdal.visdatav4.VisibilityDataV4
+        katdal data object
+    config : dict
+        processing configuration
+
+    Returns:
+    --------
+    output : numpy array
+        index per correlation product, or the [2, B] antenna numbers of
+        every product for the antenna binning
+    """
+    binning = baseline_binning(config)
+    nant = int(config.get('nant') or NANT)
+    if binning == 'length':
+        lengths = kathp.get_pair_lengths(vis, nant)[kathp.get_bl_idx(vis, nant)]
+        return kathp.get_length_idx(lengths, length_bins(config))
+    if binning == 'antenna':
+        return kathp.get_ant_idx(vis, nant)
+    return kathp.get_bl_idx(vis, nant)
+
+
+def baseline_lengths(vis, config):
+    """
+    Get the length of every baseline of a raw baseline axis, see
+    get_pair_lengths, or None for the other binnings.
+    """
+    if baseline_binning(config) != 'raw':
+        return None
+    return kathp.get_pair_lengths(vis, int(config.get('nant') or NANT))
+
+
+def new_accumulator(config, engine='scatter', nfreq=NFREQ, lengths=None):
+    """
+    Create an empty accumulator with the layout given by the configuration.
+
+    Parameters:
+    -----------
+    config : dict
+        processing configuration
+    engine : str
+        update kernel to use. default: 'scatter'
+    nfreq : int
+        number of accumulated channels. default: NFREQ
+    lengths : numpy array
+        baseline lengths of the observation, see baseline_lengths. default: None
+
+    Returns:
+    --------
+    output : SparseAccumulator
+        empty accumulator
+    """
+    timebins = kathp.get_time_bins(int(config['time_bin_minutes']))
+    acc = kathp.SparseAccumulator(nfreq=nfreq, nbl=num_baselines(config),
+                                  cell_shape=(len(timebins), len(ELBINS), len(AZBINS)),
+                                  engine=engine)
+    if lengths is not None:
+        acc.lengths = np.array(lengths, dtype=float)
+    return acc
+
+
+def get_timer(metrics, path):
+    """
+    Get the StageTimer of an observation from a MetricsLog, or a timer that
+    is not recorded anywhere if `metrics` is None.
+    """
+    return kmetrics.StageTimer(path) if metrics is None else metrics.timer(path)
+
+
+def _open_observation(path, config, check, timer):
+    """Open and check an observation and find its clean antennas."""
+    with timer.stage('open'):
+        vis = kathp.readfile(path)
+    logging.info('{} has been read'.format(path))
+    if check:
+        with timer.stage('check'):
+            check_observation(vis, config)
+    logging.info('Removing bad antennas')
+    with timer.stage('antenna screening'):
+        clean_ants = kathp.remove_bad_ants(vis)
+    logging.info('Bad antennas has been removed.')
+    return vis, clean_ants
+
+
+def _build_indices(path, vis, config, timer):
+    """Build the time, baseline, elevation and azimuth indices of a selection."""
+    with timer.stage('index build'):
+        try:
+            Bl_idx = baseline_idx(vis, config)
+        except ValueError as error:
+            raise BadObservation('{}: {}'.format(path, error))
+        el, az = kathp.get_az_and_el(vis)
+        Time_idx = kathp.get_time_idx(vis, config['time_frame'],
+                                      int(config['time_bin_minutes']))
+        El_idx = kathp.get_el_idx(el, ELBINS)
+        Az_idx = kathp.get_az_idx(az, AZBINS)
+    nskip = np.count_nonzero((El_idx < 0) | (Az_idx < 0))
+    if nskip:
+        logging.info('{} dumps are outside the elevation/azimuth bins and are skipped'.format(nskip))
+    return Time_idx, Bl_idx, El_idx, Az_idx
+
+
+def prepare_observation(path, config, check=False, timer=None):
+    """
+    Open an observation, select its flags and build its indices.
+
+    Parameters:
+    -----------
+    path : str
+        RDB file
+    config : dict
+        processing configuration
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    timer : StageTimer
+        timer of the open, check, screening, selection and index stages. default: None
+
+    Returns:
+    --------
+    output : tuple
+        katdal data object, selected flags and the time, baseline, elevation
+        and azimuth indices
+
+    Raises:
+    -------
+    BadObservation
+        if the observation fails the checks or the selection is empty
+    """
+    if timer is None:
+        timer = kmetrics.StageTimer(path)
+    vis, clean_ants = _open_observation(path, config, check, timer)
+    with timer.stage('selection'):
+        good_flags = kathp.selection(vis, pol_to_use=config['pol_to_use'],
+                                     corrprod=config['corrprod'], scan=config['scan'],
+                                     clean_ants=clean_ants, flag_type=config['flag_type'])
+    logging.info('Good flags has been returned')
+    if good_flags.shape[0] * good_flags.shape[1] * good_flags.shape[2] == 0:
+        raise BadObservation('{} selection has a problem'.format(path))
+    Time_idx, Bl_idx, El_idx, Az_idx = _build_indices(path, vis, config, timer)
+    return vis, good_flags, Time_idx, Bl_idx, El_idx, Az_idx
+
+
+def process_observation(path, config, time_chunk=32, engine='scatter', check=False, timer=None):
+    """
+    Accumulate the RFI flags of one observation.
+
+    Parameters:
+    -----------
+    path : str
+        RDB file
+    config : dict
+        processing configuration
+    time_chunk : int
+        minimum number of dumps per flag block. default: 32
+    engine : str
+        update kernel to use. default: 'scatter'
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    timer : StageTimer
+        timer of the processing stages, which also counts the fetched
+        bytes and processed flags. default: None
+
+    Returns:
+    --------
+    output : tuple
+        accumulator of the observation and its channel frequencies
+
+    Raises:
+    -------
+    BadObservation
+        if the observation fails the checks or the selection is empty
+    """
+    if timer is None:
+        timer = kmetrics.StageTimer(path)
+    vis, good_flags, Time_idx, Bl_idx, El_idx, Az_idx = prepare_observation(path, config, check,
+                                                                          timer)
+    nchan = len(vis.freqs)
+    factor = channel_factor(nchan, config)
+    acc = new_accumulator(config, engine, nchan // factor, baseline_lengths(vis, config))
+    logging.info('Start to update the master and counter array')
+    flag_chunks = kathp.iter_flag_chunks(good_flags, time_chunk, packed=True)
+    for time_slice, flag_chunk in timer.iterate('flag fetch', flag_chunks):
+        with timer.stage('kernel'):
+            acc.update(Time_idx[time_slice], Bl_idx, El_idx[time_slice], Az_idx[time_slice],
+                       flag_chunk, packed=True)
+        flags = flag_chunk.shape[0] * nchan * flag_chunk.shape[2]
+        timer.count(bytes_fetched=flags * good_flags.dtype.itemsize, flags=flags)
+    return acc, kathp.average_freqs(vis.freqs, factor)
+
+
+def process_tiled(path, config, store, tile=512, time_chunk=32, engine='scatter', check=False,
+                  timer=None):
+    """
+    Accumulate one observation tile by tile along frequency into a store.
+
+    The observation is opened, selected and indexed once. Every tile of
+    `tile` output channels is then selected from katdal on its own, read,
+    accumulated into an accumulator of only the tile's channels and merged
+    into the store before the next tile, so the working set is proportional
+    to the tile rather than the band. If an earlier run was interrupted, the
+    tiles it merged are skipped and the rest are merged, with the same tiles.
+
+    Parameters:
+    -----------
+    path : str
+        RDB file
+    config : dict
+        processing configuration
+    store : str
+        path of the zarr store, created if needed
+    tile : int
+        number of output channels per tile, a multiple of the decimation
+        factors of the store marginals. default: 512
+    time_chunk : int
+        minimum number of dumps per flag block. default: 32
+    engine : str
+        update kernel to use. default: 'scatter'
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    timer : StageTimer
+        timer of the processing stages, which also counts the fetched
+        bytes and processed flags. default: None
+
+    Returns:
+    --------
+    output : numpy array
+        channel frequencies
+
+    Raises:
+    -------
+    BadObservation
+        if the observation fails the checks or the selection is empty
+    """
+    if timer is None:
+        timer = kmetrics.StageTimer(path)
+    if tile % max(kstore.ROLLUP_FACTORS):
+        raise ValueError('Tiles of {} channels are not a multiple of {}'.format(
+            tile, max(kstore.ROLLUP_FACTORS)))
+    vis, _, Time_idx, Bl_idx, El_idx, Az_idx = prepare_observation(path, config, check, timer)
+    nchan = len(vis.freqs)
+    factor = channel_factor(nchan, config)
+    freqs = kathp.average_freqs(vis.freqs, factor)
+    lengths = baseline_lengths(vis, config)
+    cbids = [kstore.capture_block_id(path)]
+    if cbids[0] in kstore.merged_capture_blocks(store):
+        logging.info('{} already merged into {}'.format(cbids[0], store))
+        return freqs
+    # Tiles merged before an interrupted run are not read again
+    done = kstore.merged_tiles(store, cbids)
+    for start in range(0, len(freqs), tile):
+        stop = min(start + tile, len(freqs))
+        if (start, stop) in done:
+            logging.info('Channels {} to {} are already merged into {}'.format(start, stop, store))
+            continue
+        logging.info('Updating channels {} to {}'.format(start, stop))
+        with timer.stage('selection'):
+            # Only the frequency selection is replaced, the dumps and products stay
+            vis.select(channels=slice(start * factor, stop * factor), reset='F')
+            flags = vis.flags
+        acc = new_accumulator(config, engine, stop - start, lengths)
+        flag_chunks = kathp.iter_flag_chunks(flags, time_chunk, packed=True)
+        for time_slice, flag_chunk in timer.iterate('flag fetch', flag_chunks):
+            with timer.stage('kernel'):
+                acc.update(Time_idx[time_slice], Bl_idx, El_idx[time_slice], Az_idx[time_slice],
+                           flag_chunk, packed=True)
+            tile_flags = flag_chunk.shape[0] * (stop - start) * factor * flag_chunk.shape[2]
+            timer.count(bytes_fetched=tile_flags * flags.dtype.itemsize, flags=tile_flags)
+        with timer.stage('zarr write'):
+            merge_observation(store, acc, freqs, cbids, config, offset=start)
+    return freqs
+
+
+def products(config):
+    """
+    Get the (polarisation, flag type) products accumulated by a run.
+
+    The optional 'pols' and 'flag_types' entries of the configuration are
+    comma separated lists of polarisations and flag types, and every
+    combination is accumulated into its own cube. They default to the single
+    'pol_to_use' and 'flag_type'.
+
+    Parameters:
+    -----------
+    config : dict
+        processing configuration
+
+    Returns:
+    --------
+    output : list
+        (polarisation, flag type) pairs
+    """
+    pols = [config['pol_to_use']]
+    if config.get('pols'):
+        pols = [pol.strip() for pol in config['pols'].split(',')]
+    flag_types = [config['flag_type']]
+    if config.get('flag_types'):
+        flag_types = [flag_type.strip() for flag_type in config['flag_types'].split(',')]
+    return [(pol, flag_type) for pol in pols for flag_type in flag_types]
+
+
+def output_products(config):
+    """Get the products that get their own output, [None] for a run of a single product."""
+    prods = products(config)
+    return prods if len(prods) > 1 else [None]
+
+
+def product_config(config, product):
+    """Get the single product configuration of a (polarisation, flag type) product."""
+    pol, flag_type = product
+    config = {key: value for key, value in config.items() if key not in ('pols', 'flag_types')}
+    config.update({'pol_to_use': pol, 'flag_type': flag_type})
+    return config
+
+
+def product_path(path, product):
+    """
+    Get the output path of a product, e.g. master_HH_cal_rfi.zarr for master.zarr.
+
+    Parameters:
+    -----------
+    path : str
+        output path of the run
+    product : tuple or None
+        (polarisation, flag type), None for a run of a single product
+
+    Returns:
+    --------
+    output : str
+        output path of the product
+    """
+    if product is None:
+        return path
+    name, ext = os.path.splitext(path)
+    return '{}_{}_{}{}'.format(name, product[0], product[1].replace(',', '+'), ext)
+
+
+def process_products(path, config, time_chunk=32, engine='scatter', check=False, timer=None):
+    """
+    Accumulate several polarisations and flag types of one observation in one pass.
+
+    The observation is opened, screened and selected once for all the
+    polarisations of `products(config)`, with one set of time, baseline,
+    elevation and azimuth indices. Its raw flags are read once, and every
+    block is split into the packed flags of every flag type and the
+    correlation products of every polarisation.
+
+    Parameters:
+    -----------
+    path : str
+        RDB file
+    config : dict
+        processing configuration
+    time_chunk : int
+        minimum number of dumps per flag block. default: 32
+    engine : str
+        update kernel to use. default: 'scatter'
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    timer : StageTimer
+        timer of the processing stages, which also counts the fetched
+        bytes and processed flags. default: None
+
+    Returns:
+    --------
+    output : tuple
+        accumulators by (polarisation, flag type) and the channel frequencies
+
+    Raises:
+    -------
+    BadObservation
+        if the observation fails the checks or the selection of a
+        polarisation is empty
+    """
+    if timer is None:
+        timer = kmetrics.StageTimer(path)
+    accs = dict.fromkeys(products(config))
+    pols = sorted(set(pol for pol, _ in accs))
+    flag_types = sorted(set(flag_type for _, flag_type in accs))
+    masks = tuple(kathp.flag_mask(flag_type) for flag_type in flag_types)
+    vis, clean_ants = _open_observation(path, config, check, timer)
+    with timer.stage('selection'):
+        raw_flags = kathp.selection_raw(vis, pols, corrprod=config['corrprod'],
+                                        scan=config['scan'], clean_ants=clean_ants)
+        columns = {pol: kathp.pol_columns(vis.corr_products, pol) for pol in pols}
+    logging.info('Raw flags of {} have been returned'.format(', '.join(pols)))
+    if raw_flags.shape[0] * raw_flags.shape[1] == 0 or not all(map(len, columns.values())):
+        raise BadObservation('{} selection has a problem'.format(path))
+    Time_idx, Bl_idx, El_idx, Az_idx = _build_indices(path, vis, config, timer)
+    nchan = len(vis.freqs)
+    factor = channel_factor(nchan, config)
+    lengths = baseline_lengths(vis, config)
+    for product in accs:
+        accs[product] = new_accumulator(config, engine, nchan // factor, lengths)
+    logging.info('Start to update the master and counter arrays of {} products'.format(len(accs)))
+    flag_chunks = kathp.iter_flag_chunks(raw_flags, time_chunk, masks=masks)
+    for time_slice, flag_chunk in timer.iterate('flag fetch', flag_chunks):
+        with timer.stage('kernel'):
+            for (pol, flag_type), acc in accs.items():
+                block = flag_chunk[:, :, columns[pol], flag_types.index(flag_type)]
+                acc.update(Time_idx[time_slice], Bl_idx[..., columns[pol]], El_idx[time_slice],
+                           Az_idx[time_slice], block, packed=True)
+        # The raw flags are read once for all the flag types
+        flags = flag_chunk.shape[0] * nchan * flag_chunk.shape[2]
+        timer.count(bytes_fetched=flags * raw_flags.dtype.itemsize, flags=flags * len(masks))
+    return accs, kathp.average_freqs(vis.freqs, factor)
+
+
+def _process_timed(path, config, time_chunk, engine, check):
+    """Process an observation in a worker process and return its timer too."""
+    timer = kmetrics.StageTimer(path)
+    acc, freqs = process_observation(path, config, time_chunk, engine, check, timer)
+    return acc, freqs, timer
+
+
+def _prefetch(paths, config, time_chunk, check, queue, manifest=None, metrics=None):
+    """
+    Open observations and read their flag blocks into a bounded queue.
+
+    Every observation produces a ('start', path, payload) item with its
+    averaged frequencies, indices and baseline lengths, a ('chunk', path,
+    payload) item per flag block and a final ('end', path, None) item, or an
+    ('error', path, exception) item if it fails. A None item marks the end
+    of all observations.
+    """
+    for path in paths:
+        if manifest is not None:
+            manifest.start(path)
+        timer = get_timer(metrics, path)
+        try:
+            vis, good_flags, Time_idx, Bl_idx, El_idx, Az_idx = prepare_observation(path, config,
+                                                                                  check, timer)
+            nchan = len(vis.freqs)
+            factor = channel_factor(nchan, config)
+            queue.put(('start', path, (kathp.average_freqs(vis.freqs, factor), Time_idx, Bl_idx,
+                                       El_idx, Az_idx, baseline_lengths(vis, config))))
+            flag_chunks = kathp.iter_flag_chunks(good_flags, time_chunk, packed=True)
+            for time_slice, flag_chunk in timer.iterate('flag fetch', flag_chunks):
+                flags = flag_chunk.shape[0] * nchan * flag_chunk.shape[2]
+                timer.count(bytes_fetched=flags * good_flags.dtype.itemsize, flags=flags)
+                queue.put(('chunk', path, (time_slice, flag_chunk)))
+        except Exception as e:
+            queue.put(('error', path, e))
+        else:
+            queue.put(('end', path, None))
+    queue.put(None)
+
+
+def iter_prefetched(paths, config, time_chunk=32, engine='scatter', check=False, depth=4,
+                    manifest=None, metrics=None):
+    """
+    Accumulate observations one by one while the next flag blocks are read
+    in a background thread.
+
+    The thread opens the observations and fetches their flag blocks into a
+    queue of at most `depth` blocks, so archive I/O overlaps with the
+    update kernel. The time spent waiting for blocks and the time spent in
+    the kernel are logged per observation, and recorded as the 'io wait'
+    and 'kernel' stages if `metrics` is given.
+
+    Parameters:
+    -----------
+    paths : list
+        RDB files
+    config : dict
+        processing configuration
+    time_chunk : int
+        minimum number of dumps per flag block. default: 32
+    engine : str
+        update kernel to use. default: 'scatter'
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    depth : int
+        maximum number of flag blocks held in the queue. default: 4
+    manifest : Manifest
+        job manifest in which the start of every observation is recorded. default: None
+    metrics : MetricsLog
+        metrics log that times the stages of every observation. default: None
+
+    Returns:
+    --------
+    output : generator
+        (path, accumulator, frequencies, error) per observation, where error
+        is None or the exception that made the observation fail
+    """
+    queue = Queue(maxsize=depth)
+    thread = threading.Thread(target=_prefetch,
+                              args=(paths, config, time_chunk, check, queue, manifest, metrics),
+                              daemon=True)
+    thread.start()
+    io_wait = compute = 0.0
+    acc = None
+    while True:
+        start = time.time()
+        item = queue.get()
+        wait = time.time() - start
+        io_wait += wait
+        if item is None:
+            break
+        kind, path, payload = item
+        timer = get_timer(metrics, path)
+        timer.record('io wait', wait)
+        if kind == 'start':
+            freqs, Time_idx, Bl_idx, El_idx, Az_idx, lengths = payload
+            acc = new_accumulator(config, engine, len(freqs), lengths)
+        elif kind == 'chunk':
+            time_slice, flag_chunk = payload
+            start = time.time()
+            with timer.stage('kernel'):
+                acc.update(Time_idx[time_slice], Bl_idx, El_idx[time_slice], Az_idx[time_slice],
+                           flag_chunk, packed=True)
+            compute += time.time() - start
+        else:
+            logging.info('{}: waited {:.1f} s for I/O and computed for {:.1f} s'.format(
+                path, io_wait, compute))
+            if kind == 'end':
+                yield path, acc, freqs, None
+            else:
+                yield path, None, None, payload
+            acc = None
+            io_wait = compute = 0.0
+    thread.join()
+
+
+def record_error(manifest, path, error):
+    """
+    Record a failed observation in a job manifest.
+
+    Parameters:
+    -----------
+    manifest : Manifest or None
+        job manifest, nothing is recorded if None
+    path : str
+        RDB file
+    error : Exception
+        BadObservation for unusable observations, any other error is retried
+    """
+    if manifest is None:
+        return
+    if isinstance(error, BadObservation):
+        manifest.bad(path, error)
+    else:
+        manifest.failed(path, error)
+
+
+def iter_observations(paths, config, time_chunk=32, engine='scatter', check=False, prefetch=0,
+                      manifest=None, metrics=None, tile=0, store=None):
+    """
+    Accumulate observations one by one.
+
+    Parameters:
+    -----------
+    paths : list
+        RDB files
+    config : dict
+        processing configuration
+    time_chunk : int
+        minimum number of dumps per flag block. default: 32
+    engine : str
+        update kernel to use. default: 'scatter'
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    prefetch : int
+        number of flag blocks to read ahead in a background thread, 0 to
+        read in the foreground. default: 0
+    manifest : Manifest
+        job manifest in which the start and failure of every observation is
+        recorded. default: None
+    metrics : MetricsLog
+        metrics log that times the stages of every observation. The caller
+        adds its own stages and writes the record. default: None
+    tile : int
+        number of output channels per frequency tile, 0 to accumulate the
+        whole band at once. default: 0
+    store : str
+        path of the zarr store that frequency tiles are merged into as they
+        finish, see process_tiled. default: None
+
+    Returns:
+    --------
+    output : generator
+        (path, accumulator, frequencies, error) per observation, where error
+        is None or the exception that made the observation fail. With more
+        than one of `products(config)` the accumulator is a dict of
+        accumulators by product, see process_products. With frequency
+        tiles the observation is already in `store` and the accumulator is None.
+    """
+    multi = len(products(config)) > 1
+    if multi and prefetch > 0:
+        raise ValueError('Prefetching is not supported with several products')
+    if tile and (multi or prefetch > 0 or store is None):
+        raise ValueError('Frequency tiles need a store, a single product and no prefetching')
+    if prefetch > 0:
+        for path, acc, freqs, error in iter_prefetched(paths, config, time_chunk, engine, check,
+                                                       prefetch, manifest, metrics):
+            if error is not None:
+                record_error(manifest, path, error)
+            yield path, acc, freqs, error
+        return
+    for path in paths:
+        if manifest is not None:
+            manifest.start(path)
+        process = process_products if multi else process_observation
+        try:
+            if tile:
+                acc, freqs = None, process_tiled(path, config, store, tile, time_chunk, engine,
+                                                 check, get_timer(metrics, path))
+            else:
+                acc, freqs = process(path, config, time_chunk, engine, check,
+                                     get_timer(metrics, path))
+        except Exception as e:
+            record_error(manifest, path, e)
+            yield path, None, None, e
+        else:
+            yield path, acc, freqs, None
+
+
+def write_observation(path, acc, freqs, cbids, config):
+    """
+    Write an accumulator to a new zarr output with the layout of a master store.
+
+    Only the cells the accumulator visited are written, so the output is as
+    sparse as the accumulator rather than a dense cube.
+
+    Parameters:
+    -----------
+    path : str
+        path of the new zarr output
+    acc : SparseAccumulator
+        accumulator to write
+    freqs : numpy array
+        channel frequencies
+    cbids : list
+        capture block IDs of the observations in the accumulator
+    config : dict
+        processing configuration, an optional 'zarr_chunks' entry sets the
+        chunk preset or shape
+
+    Raises:
+    -------
+    FileExistsError
+        if the output exists already
+    """
+    if os.path.exists(path):
+        raise FileExistsError('Output {} exists already'.format(path))
+    merge_observation(path, acc, freqs, cbids, config)
+
+
+def merge_observation(store, acc, freqs, cbids, config, offset=0):
+    """
+    Merge an accumulator into a master store, creating the store if needed.
+
+    An existing store has to have the time bins, channel frequencies,
+    baseline binning and pointing bins of the merge, in the same time frame.
+
+    Parameters:
+    -----------
+    store : str
+        path of the zarr store
+    acc : SparseAccumulator
+        accumulator to merge
+    freqs : numpy array
+        channel frequencies
+    cbids : list
+        capture block IDs of the observations in the accumulator
+    config : dict
+        processing configuration, an optional 'zarr_chunks' entry sets the
+        chunk preset or shape of a new store
+    offset : int
+        first channel of a frequency tile accumulator. default: 0
+
+    Returns:
+    --------
+    output : bool
+        False if all the capture blocks were merged before and nothing was done
+    """
+    coords = {'time': kathp.get_time_bins(int(config['time_bin_minutes'])),
+              'frequency': freqs, 'baseline': baseline_coords(config),
+              'elevation': ELBINS, 'azimuth': AZBINS}
+    attrs = {'units': 'hours', 'time_frame': config['time_frame']}
+    if not os.path.exists(store):
+        if baseline_binning(config) == 'raw':
+            # Marginals by baseline length class, see kstore.MARGINALS
+            coords[kstore.LENGTH] = length_coords(config)
+        kstore.create_store(store, coords, np.promote_types(acc.dtype, kstore.STORE_DTYPE),
+                            attrs=attrs, chunks=config.get('zarr_chunks') or 'cell')
+    elif kstore.baseline_binning(store) != baseline_binning(config):
+        raise ValueError('Store {} has a {} baseline axis, not {}'.format(
+            store, kstore.baseline_binning(store), baseline_binning(config)))
+    else:
+        # Counts are only added to cells with the same meaning, which for
+        # the baseline axis includes the edges of the length bins
+        kstore.check_coords(store, coords, attrs)
+    return kstore.merge_into_store(store, acc, cbids, offset)
+
+
+class TreeReducer(object):
+    """
+    Pairwise tree reduction of partial accumulators.
+
+    Partials are merged like the carries of a binary counter: level n holds
+    at most one accumulator built from 2**n partials. Merges therefore pair
+    accumulators of similar size, and at most log2(N) partials stay resident.
+    Once the resident partials outgrow `max_bytes` the reduction is `full`,
+    and flush merges them and hands them to `spill`, which writes them to
+    disk, together with the labels of the partials they hold.
+
+    Parameters:
+    -----------
+    max_bytes : int or None
+        bytes of resident partials that trigger a spill, None for no limit. default: None
+    spill : callable
+        function of a merged accumulator and the list of its labels. default: None
+    """
+
+    def __init__(self, max_bytes=None, spill=None):
+        self.levels = []
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.labels = []
+        self.spilled = []
+
+    @property
+    def nbytes(self):
+        """Number of bytes held by the resident partials."""
+        return sum(acc.nbytes for acc in self.levels if acc is not None)
+
+    @property
+    def full(self):
+        """Whether the resident partials outgrow `max_bytes` and should be spilled."""
+        return self.max_bytes is not None and self.spill is not None and \
+            self.nbytes > self.max_bytes
+
+    def add(self, acc, label=None):
+        """
+        Add a partial accumulator to the reduction.
+
+        Parameters:
+        -----------
+        acc : SparseAccumulator
+            partial accumulator
+        label : str
+            label of the partial, such as its file, passed to `spill`. default: None
+
+        Raises:
+        -------
+        ValueError
+            if the partial has another layout than the partials added before,
+            in which case the reduction is left unchanged
+        """
+        level = 0
+        while level < len(self.levels) and self.levels[level] is not None:
+            acc = self.levels[level].merge(acc)
+            self.levels[level] = None
+            level += 1
+        if level == len(self.levels):
+            self.levels.append(None)
+        self.levels[level] = acc
+        if label is not None:
+            self.labels.append(label)
+
+    def flush(self):
+        """Merge the resident partials and spill them, freeing their memory."""
+        total = self.result()
+        if total is None:
+            return
+        logging.info('Spilling {} partials of {:.1f} MB'.format(len(self.labels),
+                                                               total.nbytes / 1024**2))
+        self.spill(total, self.labels)
+        self.spilled.extend(self.labels)
+        self.labels = []
+        self.levels = []
+
+    def result(self):
+        """
+        Merge the remaining partials into the total.
+
+        Returns:
+        --------
+        output : SparseAccumulator or None
+            total accumulator, None if no partial was added
+        """
+        total = None
+        for acc in self.levels:
+            if acc is not None:
+                total = acc if total is None else acc.merge(total)
+        self.levels = [total]
+        return total
+
+
+def observation_memory(time_chunk, nchan=NFREQ, ncells=8, nbl=NBL, prefetch=0, nfreq=NFREQ,
+                       native_chunk=1):
+    """
+    Estimate the peak memory used to process one observation.
+
+    Parameters:
+    -----------
+    time_chunk : int
+        minimum number of dumps per flag block
+    nchan : int
+        number of channels of the flags. default: NFREQ
+    ncells : int
+        expected number of (time, elevation, azimuth) cells per observation. default: 8
+    nbl : int
+        number of baselines. default: NBL
+    prefetch : int
+        number of flag blocks read ahead. default: 0
+    nfreq : int
+        number of channels of the accumulator, fewer for a frequency tile. default: NFREQ
+    native_chunk : int
+        number of dumps per dask chunk of the flags, which are read whole. default: 1
+
+    Returns:
+    --------
+    output : int
+        estimated number of bytes
+    """
+    # Blocks are made of whole dask chunks, see iter_flag_chunks
+    block = -(-time_chunk // native_chunk) * native_chunk
+    # A bit-packed flag block is held twice while dask assembles it, and
+    # every chunk is unpacked before it is packed
+    flag_bytes = (2 + prefetch) * block * nchan * nbl // 8
+    if time_chunk:
+        flag_bytes += native_chunk * nchan * nbl
+    # uint16 master and counter blocks, with room for the capacity doubling
+    acc_bytes = 2 * 2 * ncells * nfreq * nbl * 2
+    return flag_bytes + acc_bytes
+
+
+def native_time_chunk(path):
+    """
+    Get the number of dumps per dask chunk of the flags of an observation.
+
+    Parameters:
+    -----------
+    path : str
+        RDB file
+
+    Returns:
+    --------
+    output : int
+        largest number of dumps of a dask chunk, 1 if the flags are not dask backed
+    """
+    dataset = getattr(kathp.readfile(path).flags, 'dataset', None)
+    if dataset is None or not hasattr(dataset, 'chunks'):
+        return 1
+    return int(max(dataset.chunks[0]))
+
+
+class MemoryPlan(object):
+    """
+    Sizes of the processing that fit a memory budget.
+
+    Parameters:
+    -----------
+    workers : int
+        number of observations processed concurrently
+    time_chunk : int
+        minimum number of dumps per flag block
+    prefetch : int
+        number of flag blocks read ahead
+    spill_bytes : int or None
+        bytes of partial accumulators held before they are spilled to a
+        store on disk, None for no limit
+    tile : int
+        number of output channels per frequency tile, 0 for the whole band. default: 0
+    """
+
+    def __init__(self, workers, time_chunk, prefetch, spill_bytes=None, tile=0):
+        self.workers = workers
+        self.time_chunk = time_chunk
+        self.prefetch = prefetch
+        self.spill_bytes = spill_bytes
+        self.tile = tile
+
+    def __repr__(self):
+        return ('MemoryPlan(workers={}, time_chunk={}, prefetch={}, spill_bytes={}, '
+                'tile={})'.format(self.workers, self.time_chunk, self.prefetch,
+                                  self.spill_bytes, self.tile))
+
+
+def memory_plan(config, max_memory, workers=1, time_chunk=32, prefetch=0, tile=0,
+                native_chunk=1):
+    """
+    Choose the frequency tiles, flag block size, read-ahead and number of
+    concurrent observations that fit a memory budget.
+
+    With frequency tiles, the tile is halved until the accumulator of one
+    tile fits half of the budget. The flag blocks of all the workers get at
+    most a quarter of the budget, so `time_chunk` and `prefetch` are lowered
+    next, although a flag block always holds at least one dask chunk of
+    `native_chunk` dumps. Then as many workers as fit are kept, with room
+    for at least one observation worth of partial accumulators, and whatever
+    is left of the budget bounds the partials held before they are spilled
+    to disk.
+
+    Parameters:
+    -----------
+    config : dict
+        processing configuration
+    max_memory : float or None
+        memory budget in GB, None for no limit
+    workers : int
+        requested number of concurrent observations. default: 1
+    time_chunk : int
+        requested minimum number of dumps per flag block. default: 32
+    prefetch : int
+        requested number of flag blocks to read ahead. default: 0
+    tile : int
+        requested number of output channels per frequency tile, 0 for the
+        whole band. default: 0
+    native_chunk : int
+        number of dumps per dask chunk of the flags, see native_time_chunk. default: 1
+
+    Returns:
+    --------
+    output : MemoryPlan
+        sizes that fit the budget, the requested ones if there is no budget
+    """
+    if max_memory is None:
+        return MemoryPlan(workers, time_chunk, prefetch, tile=tile)
+    budget = int(max_memory * 1024**3)
+    nbl = num_baselines(config)
+    minimum = max(kstore.ROLLUP_FACTORS)
+    while tile > minimum and observation_memory(0, nbl=nbl, nfreq=tile) > budget // 2:
+        tile = max(minimum, tile // 2 // minimum * minimum)
+    nfreq = tile or NFREQ
+    # The flags of a tile have the tile's share of the correlator channels
+    nchan = CORRELATOR_CHANNELS.get(config.get('correlator_mode'), NFREQ) * nfreq // NFREQ
+    acc_bytes = observation_memory(0, nchan, nbl=nbl, nfreq=nfreq)
+
+    def flag_bytes(time_chunk, prefetch):
+        return observation_memory(time_chunk, nchan, nbl=nbl, prefetch=prefetch, nfreq=nfreq,
+                                  native_chunk=native_chunk) - acc_bytes
+
+    # Blocks smaller than a dask chunk would not use less memory
+    while (time_chunk > native_chunk or prefetch > 0) and \
+            workers * flag_bytes(time_chunk, prefetch) > budget // 4:
+        if prefetch > 0:
+            prefetch -= 1
+        else:
+            time_chunk = max(1, time_chunk // 2)
+    per_worker = observation_memory(time_chunk, nchan, nbl=nbl, prefetch=prefetch, nfreq=nfreq,
+                                    native_chunk=native_chunk)
+    workers = max(1, min(workers, (budget - acc_bytes) // per_worker))
+    spill_bytes = max(acc_bytes, budget - workers * per_worker)
+    if workers * per_worker + acc_bytes > budget:
+        logging.warning('A budget of {} GB is too small for one observation of {} GB'.format(
+            max_memory, (per_worker + acc_bytes) / 1024**3))
+    return MemoryPlan(int(workers), time_chunk, prefetch, int(spill_bytes), tile)
+
+
+def _init_worker(nthreads):
+    """Share the cores of the node between the worker processes."""
+    import numba
+    numba.set_num_threads(nthreads)
+
+
+def run_parallel(paths, config, workers, max_memory=None, time_chunk=32, engine='scatter',
+                 check=False, manifest=None, metrics=None, spill=None, native_chunk=1):
+    """
+    Process observations concurrently and reduce them into one total.
+
+    Each worker process accumulates one observation into a partial
+    accumulator. At most `workers` observations are in flight, and finished
+    partials are tree-reduced in this process as they arrive. The number of
+    workers and the flag block size follow memory_plan, and if the partials
+    outgrow the rest of the budget they are merged into the `spill` store.
+
+    Parameters:
+    -----------
+    paths : list
+        RDB files
+    config : dict
+        processing configuration
+    workers : int
+        number of worker processes
+    max_memory : float or None
+        memory budget in GB, None for no limit. default: None
+    time_chunk : int
+        minimum number of dumps per flag block. default: 32
+    engine : str
+        update kernel to use. default: 'scatter'
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    manifest : Manifest
+        job manifest in which the start and failure of every observation is
+        recorded. default: None
+    metrics : MetricsLog
+        metrics log to which the stage metrics of every observation are
+        written as soon as its worker finishes. default: None
+    spill : str
+        path of a zarr store that partials are merged into when they do not
+        fit the budget, None to keep them all in memory. default: None
+    native_chunk : int
+        number of dumps per dask chunk of the flags, see native_time_chunk. default: 1
+
+    Returns:
+    --------
+    output : tuple
+        total accumulator (None if no file was good, or if partials were
+        spilled, in which case the total is in the `spill` store), channel
+        frequencies, list of good files and list of bad files
+    """
+    plan = memory_plan(config, max_memory, workers, time_chunk, native_chunk=native_chunk)
+    workers, time_chunk = plan.workers, plan.time_chunk
+    nthreads = max(1, (os.cpu_count() or 1) // workers)
+    logging.info('Processing {} files with {} workers of {} threads, {}'.format(
+        len(paths), workers, nthreads, plan))
+    freqs = None
+
+    def spill_partials(acc, labels):
+        merge_observation(spill, acc, freqs, [kstore.capture_block_id(path) for path in labels],
+                          config)
+
+    reducer = TreeReducer(plan.spill_bytes, spill_partials if spill is not None else None)
+    goodfiles = []
+    badfiles = []
+    pending = {}
+    todo = iter(paths)
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=ctx,
+                                                initializer=_init_worker,
+                                                initargs=(nthreads,)) as pool:
+        while True:
+            for path in todo:
+                if manifest is not None:
+                    manifest.start(path)
+                pending[pool.submit(_process_timed, path, config, time_chunk, engine,
+                                    check)] = path
+                if len(pending) >= workers:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    acc, observation_freqs, timer = future.result()
+                    if freqs is not None and (len(observation_freqs) != len(freqs) or
+                                              not np.allclose(observation_freqs, freqs)):
+                        raise BadObservation('{} has other channel frequencies than the first '
+                                             'observation'.format(path))
+                    try:
+                        reducer.add(acc, path)
+                    except ValueError as e:
+                        raise BadObservation('{} cannot be merged: {}'.format(path, e))
+                except BadObservation as e:
+                    logging.info(e)
+                    record_error(manifest, path, e)
+                    badfiles.append(path)
+                    if metrics is not None:
+                        metrics.write(path, status='bad', error=str(e))
+                except Exception as e:
+                    logging.info('{}: {}'.format(path, e))
+                    record_error(manifest, path, e)
+                    if metrics is not None:
+                        metrics.write(path, status='failed', error=str(e))
+                else:
+                    logging.info('{} has been added'.format(path))
+                    freqs = observation_freqs
+                    goodfiles.append(path)
+                    if metrics is not None:
+                        metrics.add(timer)
+                        metrics.write(path, status='done')
+                    if reducer.full:
+                        reducer.flush()
+    if reducer.spilled:
+        # Part of the total is on disk already, so the rest goes there too
+        reducer.flush()
+        return None, freqs, goodfiles, badfiles
+    return reducer.result(), freqs, goodfiles, badfiles
+
+
+def _reduce_partials(*accs):
+    """Tree-reduce partial accumulators on a dask worker."""
+    reducer = TreeReducer()
+    for acc in accs:
+        reducer.add(acc)
+    return reducer.result()
+
+
+def _partial_summary(result):
+    """Get the frequencies and timer of a processed observation, without its accumulator."""
+    acc, freqs, timer = result
+    return freqs, timer
+
+
+def _partial_accumulator(result):
+    """Get the accumulator of a processed observation."""
+    acc, freqs, timer = result
+    return acc
+
+
+def _warmup_worker(engine, nthreads=None):
+    """Load the cached kernels on a dask worker and share its cores between the workers."""
+    if nthreads is not None:
+        _init_worker(nthreads)
+    kathp.warmup(engines=[engine])
+
+
+def run_distributed(paths, config, scheduler='local', workers=1, max_memory=None, time_chunk=32,
+                    engine='scatter', check=False, manifest=None, metrics=None, fanin=4,
+                    native_chunk=1):
+    """
+    Process observations on a dask cluster and tree-reduce them into one total.
+
+    Each observation is a task that produces a partial accumulator on a
+    worker. Partials stay on the workers, where every `fanin` finished ones
+    are merged by a reduction task, so only the total is sent back. The
+    frequencies and timers of the observations are gathered as they finish,
+    and observations whose frequencies differ from the first are bad.
+
+    Parameters:
+    -----------
+    paths : list
+        RDB files
+    config : dict
+        processing configuration
+    scheduler : str
+        address of a dask scheduler, or 'local' for a LocalCluster on this
+        node. default: 'local'
+    workers : int
+        number of worker processes of a LocalCluster. default: 1
+    max_memory : float or None
+        memory budget of a LocalCluster in GB, None for no limit. default: None
+    time_chunk : int
+        minimum number of dumps per flag block. default: 32
+    engine : str
+        update kernel to use. default: 'scatter'
+    check : bool
+        check the channel count and dump period before the selection. default: False
+    manifest : Manifest
+        job manifest in which the start and failure of every observation is
+        recorded. default: None
+    metrics : MetricsLog
+        metrics log to which the stage metrics of every observation are
+        written as soon as its task finishes. default: None
+    fanin : int
+        number of partials merged by every reduction task. default: 4
+    native_chunk : int
+        number of dumps per dask chunk of the flags, see native_time_chunk. default: 1
+
+    Returns:
+    --------
+    output : tuple
+        total accumulator (None if no file was good), channel frequencies,
+        list of good files and list of bad files
+    """
+    from dask.distributed import Client, LocalCluster, as_completed
+    if scheduler == 'local':
+        plan = memory_plan(config, max_memory, workers, time_chunk, native_chunk=native_chunk)
+        workers, time_chunk = plan.workers, plan.time_chunk
+        nthreads = max(1, (os.cpu_count() or 1) // workers)
+        # Dask workers spill their partials to disk as they near the limit
+        memory_limit = 'auto' if max_memory is None else '{}GB'.format(max_memory / workers)
+        cluster = LocalCluster(n_workers=workers, threads_per_worker=1,
+                               memory_limit=memory_limit)
+    else:
+        cluster, nthreads = None, None
+    client = Client(scheduler if cluster is None else cluster)
+    logging.info('Processing {} files on {}'.format(len(paths), client))
+    freqs = None
+    goodfiles = []
+    badfiles = []
+    ready = []
+    reductions = set()
+    try:
+        client.run(_warmup_worker, engine, nthreads)
+        tasks = {}
+        summaries = {}
+        for path in paths:
+            if manifest is not None:
+                manifest.start(path)
+            tasks[client.submit(_process_timed, path, config, time_chunk, engine, check,
+                                pure=False)] = path
+        futures = as_completed(tasks)
+        # Finished futures come in batches, and the small summaries of a batch
+        # are gathered in one round trip instead of one per observation
+        for batch in futures.batches():
+            done = [future for future in batch if future in summaries]
+            for future, (observation_freqs, timer) in zip(done, client.gather(done)):
+                path, task = summaries.pop(future)
+                if freqs is None:
+                    freqs = observation_freqs
+                elif len(observation_freqs) != len(freqs) or \
+                        not np.allclose(observation_freqs, freqs):
+                    error = BadObservation('{} has other channel frequencies than the first '
+                                           'observation'.format(path))
+                    logging.info(error)
+                    record_error(manifest, path, error)
+                    badfiles.append(path)
+                    if metrics is not None:
+                        metrics.write(path, status='bad', error=str(error))
+                    continue
+                # Dropping the task future lets the worker free all but the partial
+                ready.append(client.submit(_partial_accumulator, task))
+                logging.info('{} has been added'.format(path))
+                goodfiles.append(path)
+                if metrics is not None:
+                    metrics.add(timer)
+                    metrics.write(path, status='done')
+            for future in batch:
+                if future in done:
+                    continue
+                if future in reductions:
+                    # A reduction of partials has finished
+                    reductions.discard(future)
+                    ready.append(future)
+                elif future.status == 'error':
+                    path = tasks.pop(future)
+                    error = future.exception()
+                    logging.info(error if isinstance(error, BadObservation)
+                                 else '{}: {}'.format(path, error))
+                    record_error(manifest, path, error)
+                    if isinstance(error, BadObservation):
+                        badfiles.append(path)
+                    if metrics is not None:
+                        metrics.write(path, status='bad' if isinstance(error, BadObservation)
+                                      else 'failed', error=str(error))
+                else:
+                    # The frequencies and timer are fetched without waiting here
+                    path = tasks.pop(future)
+                    summary = client.submit(_partial_summary, future)
+                    summaries[summary] = (path, future)
+                    futures.add(summary)
+            while len(ready) >= fanin:
+                reduction = client.submit(_reduce_partials, *ready[:fanin])
+                reductions.add(reduction)
+                futures.add(reduction)
+                ready = ready[fanin:]
+        total = None
+        if ready:
+            total = client.submit(_reduce_partials, *ready).result()
+    finally:
+        client.close()
+        if cluster is not None:
+            cluster.close()
+    return total, freqs, goodfiles, badfiles
+
+
+def add_driver_arguments(parser, output):
+    """
+    Add the processing options shared by the command line drivers.
+
+    Parameters:
+    -----------
+    parser : argparse.ArgumentParser
+        parser of a driver
+    output : str
+        default path of the zarr output
+    """
+    parser.add_argument('-b', '--bad', action='store', type=str,
+                        help='Path to save list of bad files')
+    parser.add_argument('-g', '--good', action='store', type=str, default='\tmp',
+                        help='Path to save bad files')
+    parser.add_argument('-t', '--time-chunk', action='store', type=int, default=32,
+                        help='Minimum number of dumps to read per flag block')
+    parser.add_argument('-e', '--engine', action='store', type=str, default='scatter',
+                        choices=sorted(kathp.ENGINES),
+                        help='Kernel used to update the master and counter array')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=1,
+                        help='Number of observations processed concurrently. With more than '
+                             'one worker a single merged zarr file is saved')
+    parser.add_argument('-m', '--max-memory', action='store', type=float, default=None,
+                        help='Memory budget in GB that sets the flag block size, read-ahead '
+                             'and number of workers. Partials beyond it are spilled to the '
+                             '--store, if given')
+    parser.add_argument('-p', '--prefetch', action='store', type=int, default=0,
+                        help='Number of flag blocks to read ahead in a background thread')
+    parser.add_argument('-s', '--store', action='store', type=str, default=None,
+                        help='Path of a master zarr store to accumulate into instead of '
+                             'saving one zarr file per observation')
+    parser.add_argument('-j', '--manifest', action='store', type=str, default=None,
+                        help='Path of a JSON lines job manifest. A restarted run skips the '
+                             'files it records as done or bad')
+    parser.add_argument('-P', '--prescreen', action='store', type=int, default=0,
+                        help='Number of files to open concurrently for a metadata-only '
+                             'pre-screen before processing, 0 to skip it')
+    parser.add_argument('-M', '--metrics', action='store', type=str, default=None,
+                        help='Path of a JSON lines file that receives the time, memory and '
+                             'flag counts of every processing stage per observation')
+    parser.add_argument('-C', '--chunks', action='store', type=str, default='cell',
+                        help='Chunk preset of the zarr output [cell or baseline] or five '
+                             'comma separated chunk sizes, -1 for a whole axis')
+    parser.add_argument('-o', '--pols', action='store', type=str, default=None,
+                        help='Comma separated polarisations, such as HH,VV,HV,VH, each '
+                             'accumulated into its own output in one pass over the data')
+    parser.add_argument('-f', '--flag-types', action='store', type=str, default=None,
+                        help='Comma separated flag types, such as cal_rfi,ingest_rfi, each '
+                             'accumulated into its own output in one pass over the data')
+    parser.add_argument('-T', '--tile', action='store', type=int, default=0,
+                        help='Number of output channels per frequency tile. Every tile is '
+                             'read and merged into --store on its own, 0 for the whole band')
+    parser.add_argument('-B', '--baselines', action='store', type=str, default='raw',
+                        choices=BASELINE_BINNINGS,
+                        help='Binning of the baseline axis: raw antenna pairs, physical '
+                             'baseline length bins or antennas')
+    parser.add_argument('-E', '--baseline-edges', action='store', type=str, default=None,
+                        help='Comma separated lower edges in metres of the baseline length '
+                             'bins, or of the length marginals of a raw store, starting at 0')
+    parser.add_argument('-D', '--scheduler', action='store', type=str, default=None,
+                        help='Address of a dask scheduler to process the observations on, '
+                             'or local for a LocalCluster of --workers workers')
+    parser.add_argument('-F', '--time-frame', action='store', type=str, default='SAST',
+                        choices=sorted(kathp.TIME_FRAMES) + ['LST'],
+                        help='Time frame of the time-of-day bins: UTC, South African or '
+                             'local sidereal time')
+    parser.add_argument('-N', '--time-bin-minutes', action='store', type=int, default=60,
+                        help='Width of the time-of-day bins in minutes, which must divide a day')
+    parser.add_argument('-z', '--zarr', action='store', type=str, default=output,
+                        help='path to save output zarr file')
+
+
+def driver_config(parser, args, config):
+    """
+    Add the options of a driver to its processing configuration.
+
+    Parameters:
+    -----------
+    parser : argparse.ArgumentParser
+        parser of the driver, which reports invalid combinations of options
+    args : argparse.Namespace
+        parsed options, see add_driver_arguments
+    config : dict
+        processing configuration of the driver, updated in place
+
+    Returns:
+    --------
+    output : dict
+        the updated configuration
+    """
+    config['time_frame'] = args.time_frame
+    config['time_bin_minutes'] = str(args.time_bin_minutes)
+    try:
+        kathp.get_time_bins(args.time_bin_minutes)
+    except ValueError as error:
+        parser.error(str(error))
+    config['zarr_chunks'] = args.chunks
+    if args.pols:
+        config['pols'] = args.pols
+    if args.flag_types:
+        config['flag_types'] = args.flag_types
+    config['baseline_binning'] = args.baselines
+    if args.baseline_edges:
+        config['baseline_edges'] = args.baseline_edges
+        try:
+            length_bins(config)
+        except ValueError as error:
+            parser.error(str(error))
+    products = output_products(config)
+    if products != [None] and (args.workers > 1 or args.scheduler or args.prefetch):
+        parser.error('Several polarisations or flag types are only processed sequentially, '
+                     'without --workers, --scheduler or --prefetch')
+    if args.tile and (args.store is None or products != [None] or args.workers > 1 or
+                      args.scheduler or args.prefetch):
+        parser.error('Frequency tiles need --store and sequential processing of a single '
+                     'product, without --workers, --scheduler or --prefetch')
+    # A merged output is only written at the end of the run, so refuse it before starting
+    if args.store is None and (args.workers > 1 or args.scheduler) and os.path.exists(args.zarr):
+        parser.error('Output {} exists already, give another --zarr or a --store'.format(
+            args.zarr))
+    return config
+
+
+def observation_output(zarr, path):
+    """
+    Path of the zarr output of a single observation.
+
+    Parameters:
+    -----------
+    zarr : str
+        path of the zarr output of the driver
+    path : str
+        RDB file of the observation
+
+    Returns:
+    --------
+    output : str
+        `zarr` with the capture block of the observation before its extension
+    """
+    name, ext = os.path.splitext(zarr)
+    return name+str(path[46:56])+ext
+
+
+def run_driver(args, config, paths, check=False):
+    """
+    Process the observations of a driver into its outputs and save the
+    lists of good and bad files.
+
+    Parameters:
+    -----------
+    args : argparse.Namespace
+        parsed options, see add_driver_arguments
+    config : dict
+        processing configuration, see driver_config
+    paths : list
+        RDB files to process
+    check : bool
+        check the channel count and dump period before the selection. default: False
+
+    Raises:
+    -------
+    FileExistsError
+        if the zarr output of an observation exists already, before any is processed
+    """
+    products = output_products(config)
+    badfiles = []
+    goodfiles = []
+
+    npaths = len(paths)
+    if args.store is not None:
+        # An interrupted merge is finished first, so that its observations count as merged
+        for product in products:
+            kstore.finish_merge(product_path(args.store, product))
+        merged = set.intersection(*[kstore.merged_capture_blocks(product_path(args.store,
+                                                                             product))
+                                    for product in products])
+        paths = [path for path in paths if kstore.capture_block_id(path) not in merged]
+        logging.info('{} files have already been merged into {}'.format(npaths - len(paths),
+                                                                        args.store))
+
+    manifest = None
+    if args.manifest is not None:
+        manifest = Manifest(args.manifest)
+        npaths = len(paths)
+        paths = manifest.pending(paths)
+        goodfiles = manifest.files(DONE)
+        badfiles = manifest.files(BAD)
+        logging.info('{} files are done or bad according to {}'.format(npaths - len(paths),
+                                                                       args.manifest))
+
+    if args.prescreen > 0:
+        logging.info('Pre-screening {} files'.format(len(paths)))
+        paths, rejected = prescreen_files(paths, config, args.prescreen)
+        for path, reason in rejected.items():
+            logging.info('{}: {}'.format(path, reason))
+            badfiles.append(path)
+            if manifest is not None:
+                manifest.bad(path, reason)
+        np.save(args.bad, badfiles)
+
+    # Flag blocks hold whole dask chunks, so the plan has to know their size
+    native_chunk = native_time_chunk(paths[0]) if args.max_memory and paths else 1
+    plan = memory_plan(config, args.max_memory, args.workers, args.time_chunk, args.prefetch,
+                       args.tile, native_chunk)
+    logging.info('Memory plan: {}'.format(plan))
+
+    if args.store is None and args.scheduler is None and args.workers <= 1:
+        existing = [product_path(observation_output(args.zarr, path), product)
+                    for path in paths for product in products]
+        existing = [output for output in existing if os.path.exists(output)]
+        if existing:
+            raise FileExistsError('Outputs {} exist already'.format(', '.join(existing)))
+
+    metrics = kmetrics.MetricsLog(args.metrics) if args.metrics is not None else None
+
+    if paths:
+        # Compile or load the cached kernels once, before any worker needs them
+        kathp.warmup(engines=[args.engine])
+
+    if args.scheduler is not None or args.workers > 1:
+        if args.scheduler is not None:
+            acc, freqs, newfiles, newbad = run_distributed(paths, config, args.scheduler,
+                                                           args.workers,
+                                                           max_memory=args.max_memory,
+                                                           time_chunk=args.time_chunk,
+                                                           engine=args.engine, check=check,
+                                                           manifest=manifest, metrics=metrics,
+                                                           native_chunk=native_chunk)
+        else:
+            acc, freqs, newfiles, newbad = run_parallel(paths, config, args.workers,
+                                                        max_memory=args.max_memory,
+                                                        time_chunk=args.time_chunk,
+                                                        engine=args.engine, check=check,
+                                                        manifest=manifest, metrics=metrics,
+                                                        spill=args.store,
+                                                        native_chunk=native_chunk)
+        if acc is not None and args.store is not None:
+            logging.info('Merging into store')
+            merge_observation(args.store, acc, freqs,
+                              [kstore.capture_block_id(path) for path in newfiles], config)
+            logging.info('Store has been updated')
+        elif acc is not None:
+            logging.info('Saving dataset')
+            write_observation(args.zarr, acc, freqs,
+                              [kstore.capture_block_id(path) for path in newfiles], config)
+            logging.info('Dataset has been saved')
+        if manifest is not None:
+            for path in newfiles:
+                manifest.done(path, output=args.store or args.zarr)
+        goodfiles += newfiles
+        badfiles += newbad
+        np.save(args.good, goodfiles)
+        np.save(args.bad, badfiles)
+        return
+
+    s = time.time()
+    observations = iter_observations(paths, config, time_chunk=plan.time_chunk,
+                                     engine=args.engine, check=check, prefetch=plan.prefetch,
+                                     manifest=manifest, metrics=metrics, tile=plan.tile,
+                                     store=args.store)
+    for i, (path, acc, freqs, error) in enumerate(observations):
+        timer = get_timer(metrics, path)
+        elapsed, s = time.time() - s, time.time()
+        logging.info('Added file {} : {}'.format(i, path))
+        if isinstance(error, BadObservation):
+            logging.info(error)
+            badfiles.append(path)
+            if metrics is not None:
+                metrics.write(path, status='bad', error=str(error))
+        elif error is not None:
+            logging.info(error)
+            if metrics is not None:
+                metrics.write(path, status='failed', error=str(error))
+            continue
+        else:
+            logging.info('{} s has been taken to update file number {}'.format(elapsed, i))
+            # Several products give a dict of accumulators, each with its own output,
+            # and frequency tiles are merged into the store as they are processed
+            accs = acc if isinstance(acc, dict) else {} if acc is None else {None: acc}
+            output = args.store
+            try:
+                for product, acc in accs.items():
+                    product_conf = config if product is None else product_config(config, product)
+                    if args.store is not None:
+                        logging.info('Merging into store')
+                        with timer.stage('zarr write'):
+                            merge_observation(product_path(args.store, product), acc, freqs,
+                                              [kstore.capture_block_id(path)], product_conf)
+                        logging.info('Store has been updated')
+                        output = args.store
+                    else:
+                        logging.info('Saving dataset')
+                        flname = observation_output(args.zarr, path)
+                        with timer.stage('zarr write'):
+                            write_observation(product_path(flname, product), acc, freqs,
+                                              [kstore.capture_block_id(path)], product_conf)
+                        logging.info('Dataset has been saved')
+                        output = flname
+            except Exception as e:
+                logging.info(e)
+                if manifest is not None:
+                    manifest.failed(path, e)
+                if metrics is not None:
+                    metrics.write(path, status='failed', error=str(e))
+                continue
+            goodfiles.append(path)
+            if manifest is not None:
+                manifest.done(path, output=output)
+            if metrics is not None:
+                metrics.write(path, status='done', output=output)
+        np.save(args.good, goodfiles)
+        np.save(args.bad, badfiles)
+        logging.info('File has been saved')
@@ -0,0 +1,207 @@
+"""
+Probability of RFI queries over a master zarr store.
+
+The probability of RFI in a set of voxels is the number of flagged samples
+divided by the number of samples, master / counter, both summed over the
+voxels. Queries select ranges of the time, frequency, baseline, elevation
+and azimuth axes and keep any of them in the result. The cube is opened
+lazily and reduced chunk by chunk, and queries that only involve the axes of
+a precomputed marginal are answered from the marginal without touching the
+cube. Stores with a raw baseline axis also answer queries over baseline
+length classes, from their length marginals only.
+
+Usage:
+    python kathprfi_query.py master.zarr -k frequency -s elevation=30:60 -o spectrum.csv
+"""
+import argparse
+import logging
+
+import numpy as np
+import xarray as xr
+
+import kathprfi_store as kstore
+
+# Axes of the queries, the length classes only being in marginals
+AXES = kstore.DIMS + (kstore.LENGTH,)
+
+
+def parse_selection(text):
+    """
+    Parse a command line selection such as 'frequency=1.0e9:1.1e9' or 'baseline=12'.
+
+    Returns:
+    --------
+    output : tuple
+        dimension and either a (start, stop) tuple or a single value
+    """
+    dim, _, value = text.partition('=')
+    if dim not in AXES or not value:
+        raise ValueError('Selection {!r} is not of the form dim=value or dim=start:stop with '
+                         'dim one of {}'.format(text, AXES))
+    if ':' in value:
+        start, stop = value.split(':')
+        return dim, (float(start) if start else None, float(stop) if stop else None)
+    return dim, float(value)
+
+
+class RFIStore(object):
+    """
+    Lazy view of a master store that answers probability queries.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+    partial : bool
+        query a cube that holds part of an unfinished merge, only warning
+        about it, instead of refusing it. default: False
+
+    Raises:
+    -------
+    ValueError
+        if the cube holds part of an unfinished merge and `partial` is False
+    """
+
+    def __init__(self, path, partial=False):
+        self.path = path
+        self.cube = xr.open_zarr(path, group=kstore.GROUP)
+        pending = self.cube.attrs.get('pending_capture_blocks') or []
+        if pending or (self.cube.attrs.get('merge_progress') or {}).get('offset') is not None:
+            message = ('{} holds part of an unfinished merge of {}, which kstore.finish_merge '
+                       'or running the merge again completes'.format(path, ', '.join(pending)))
+            if not partial:
+                raise ValueError(message)
+            logging.warning(message)
+        self.merged = set(self.cube.attrs.get('merged_capture_blocks', []))
+        self.nfreq = self.cube.sizes['frequency']
+        self.marginals = {}
+        for dims, factor in kstore.rollups(self.nfreq):
+            try:
+                marginal = xr.open_zarr(path, group=kstore.marginal_group(dims, factor))
+            except (FileNotFoundError, KeyError, ValueError):
+                continue
+            # A marginal that misses later merges would give wrong answers
+            if (set(marginal.attrs.get('merged_capture_blocks', [])) == self.merged
+                    and not marginal.attrs.get('pending_capture_blocks')):
+                self.marginals[dims, factor] = marginal
+
+    def source(self, dims, channels=None):
+        """
+        Get the smallest dataset that holds all of the given dimensions.
+
+        Parameters:
+        -----------
+        dims : iterable
+            dimensions that are kept or selected by a query
+        channels : int
+            number of frequency channels of a decimated marginal, None for the
+            full resolution. default: None
+
+        Returns:
+        --------
+        output : xarray.Dataset
+            an up to date marginal, or the full cube if none holds the dimensions
+        """
+        dims = set(dims)
+        factor = 1 if channels is None else self.nfreq // channels
+        fits = [key for key in self.marginals if key[1] == factor and dims.issubset(key[0])]
+        if fits:
+            return self.marginals[min(fits, key=lambda key: self.marginals[key]['master'].size)]
+        if factor != 1 or kstore.LENGTH in dims:
+            raise ValueError('No up to date marginal with {} channels holds {}'.format(
+                channels or self.nfreq, sorted(dims)))
+        return self.cube
+
+    def select(self, ds, selection):
+        """
+        Apply label selections, ranges as slices and single values as nearest.
+        The nearest label is selected as a list of one, so that a kept
+        dimension stays in the result.
+        """
+        ranges = {}
+        points = {}
+        for dim, value in selection.items():
+            if isinstance(value, slice):
+                ranges[dim] = value
+            elif isinstance(value, tuple):
+                ranges[dim] = slice(*value)
+            else:
+                points[dim] = [value]
+        if ranges:
+            ds = ds.sel(ranges)
+        if points:
+            ds = ds.sel(points, method='nearest')
+        return ds
+
+    def probability(self, keep=(), channels=None, **selection):
+        """
+        Get the probability of RFI over a selection, keeping some dimensions.
+
+        Parameters:
+        -----------
+        keep : tuple
+            dimensions kept in the result, all others are summed over. default: ()
+        channels : int
+            number of frequency channels of a decimated marginal to answer
+            from, such as 1024 or 256, None for the full resolution. default: None
+        selection : dict
+            label selection per dimension, a (start, stop) tuple or slice for
+            a range and a single value for the nearest label
+
+        Returns:
+        --------
+        output : xarray.Dataset
+            probability, master and counter over the kept dimensions, with a
+            NaN probability where there are no samples
+        """
+        keep = tuple(keep)
+        unknown = set(keep).union(selection).difference(AXES)
+        if unknown:
+            raise ValueError('Unknown dimensions {}, expected some of {}'.format(
+                sorted(unknown), AXES))
+        ds = self.select(self.source(set(keep).union(selection), channels), selection)
+        ds = ds[['master', 'counter']]
+        ds = ds.astype(np.uint64).sum([dim for dim in ds.dims if dim not in keep])
+        ds = ds.compute()
+        counter = ds['counter'].where(ds['counter'] > 0)
+        ds['probability'] = ds['master'] / counter
+        return ds.transpose(*[dim for dim in AXES if dim in keep])
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Probability of RFI from a master zarr store')
+    parser.add_argument('store', type=str, help='Path of the master zarr store')
+    parser.add_argument('-k', '--keep', action='store', nargs='*', default=[],
+                        choices=AXES, help='Dimensions kept in the result')
+    parser.add_argument('-s', '--select', action='append', default=[],
+                        help='Selection as dim=value or dim=start:stop, repeatable')
+    parser.add_argument('-n', '--channels', action='store', type=int, default=None,
+                        help='Answer from the marginals decimated to this many channels')
+    parser.add_argument('-o', '--output', action='store', type=str, default=None,
+                        help='Path of a CSV file for the result, printed if not given')
+    parser.add_argument('-b', '--build-marginals', action='store_true',
+                        help='Compute the marginals of the store before the query')
+    parser.add_argument('-p', '--partial', action='store_true',
+                        help='Query a store that holds part of an unfinished merge')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    args = create_parser().parse_args()
+    if args.build_marginals:
+        kstore.build_marginals(args.store)
+    selection = dict(parse_selection(text) for text in args.select)
+    result = RFIStore(args.store, args.partial).probability(args.keep, args.channels, **selection)
+    if args.keep:
+        table = result.to_dataframe()
+    else:
+        table = result.to_pandas()
+    if args.output is not None:
+        table.to_csv(args.output)
+    else:
+        print(table)
+
+
+if __name__ == '__main__':
+    main()
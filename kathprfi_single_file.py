@@ -1,11 +1,9 @@
-import datetime
 
-import katdal
+import functools
+import logging
+import re
+
 import numpy as np
-import pandas as pd
-from numba import jit
-from numba import prange
-from skimage.measure import block_reduce
 
 
 
@@ -23,6 +21,8 @@ def readfile(path):
     output_file : katdal.visdatav4.VisibilityDataV4
        katdal data object
     """
+    # katdal is only imported by the tasks that open files
+    import katdal
     vis = katdal.open(path)
     return vis
 
@@ -94,6 +94,76 @@ def remove_bad_ants(vis):
     return AntList
 
 
+# Target tags of observations that went through imaging, so the cal flags are valid
+GOOD_TAGS = set(["target", "bpcal", "delaycal", "fluxcal", "gaincal", "polcal"])
+
+
+def get_good_targets(vis):
+    """
+    Get the targets of the observation that carry one of the GOOD_TAGS.
+
+    Parameters:
+    -----------
+    vis : katdal.visdatav4.VisibilityDataV4
+       katdal data object
+
+    Returns:
+    --------
+    output : python list
+        list of katpoint targets
+    """
+    good_targets = []
+    for tar in vis.target_indices:
+        target = vis.catalogue.targets[tar]
+        if len(GOOD_TAGS.intersection(target.tags)) > 0:
+            good_targets.append(target)
+    return good_targets
+
+
+def prescreen(vis, freq_chan, dump_rate, scan='track'):
+    """
+    Decide from metadata only whether an observation is worth processing.
+
+    Only the header, sensors and catalogue are used: the channel count, the
+    dump period, the target tags, the antenna activity and the number of
+    dumps left by the scan and target selection. No flags or visibilities
+    are read.
+
+    Parameters:
+    -----------
+    vis : katdal.visdatav4.VisibilityDataV4
+       katdal data object
+    freq_chan : int
+        expected number of channels
+    dump_rate : int
+        the dump period has to be in (dump_rate - 1, dump_rate] seconds
+    scan : str
+        type of a scan to use [track or slew]. default: 'track'
+
+    Returns:
+    --------
+    output : str or None
+        reason to reject the observation, None if it passes
+    """
+    if len(vis.freqs) != freq_chan:
+        return 'Channel count {} is not {}'.format(len(vis.freqs), freq_chan)
+    if not (dump_rate - 1) < vis.dump_period <= dump_rate:
+        return 'Dump period {:.3f} s does not match {} s'.format(vis.dump_period, dump_rate)
+    good_targets = get_good_targets(vis)
+    if not good_targets:
+        return 'No target is tagged as one of {}'.format(', '.join(sorted(GOOD_TAGS)))
+    if len(remove_bad_ants(vis)) < 2:
+        return 'Fewer than two antennas are active'
+    try:
+        vis.select(scans=scan, targets=good_targets)
+        ndumps = vis.shape[0]
+    finally:
+        vis.select()
+    if ndumps == 0:
+        return 'No {} dumps on the good targets'.format(scan)
+    return None
+
+
 def selection(vis, pol_to_use, corrprod, scan, clean_ants, flag_type):
     """
     Do subselection of the dataset based on the given parameters.
@@ -120,39 +190,140 @@ def selection(vis, pol_to_use, corrprod, scan, clean_ants, flag_type):
     output : katdal.lazy_indexer.DaskLazyIndexer
         sub selected katdal lazy indexer of RFI flags
     """
-    good_tags = set(["target", "bpcal", "delaycal","fluxcal","gaincal","polcal"])
-    good_targets = []
-    target = vis.catalogue.targets[vis.target_indices[2]]
-    for tar in vis.target_indices:
-        target = vis.catalogue.targets[tar]
-        if len(good_tags.intersection(target.tags))>0:
-                good_targets.append(target)
+    good_targets = get_good_targets(vis)
     vis.select(corrprods=corrprod, pol=pol_to_use, scans=scan, ants=clean_ants,
                flags=flag_type, targets = good_targets)
     flag = vis.flags
     return flag
 
-def NewFlagChunk(flag_chunk):
+
+# Bits of the katdal raw flags, in the order of katdal.flags.NAMES
+FLAG_NAMES = ('reserved0', 'static', 'cam', 'data_lost', 'ingest_rfi', 'predicted_rfi',
+              'cal_rfi', 'postproc')
+
+
+def flag_mask(flag_type):
+    """
+    Get the bit mask of the raw flags of one or more flag types.
+
+    Parameters:
+    -----------
+    flag_type : str
+        comma separated flag types, such as 'cal_rfi' or 'cal_rfi,ingest_rfi'
+
+    Returns:
+    --------
+    output : int
+        mask of the raw flag bits, a sample is flagged if any of them is set
+    """
+    names = set(name.strip() for name in flag_type.split(','))
+    unknown = names.difference(FLAG_NAMES)
+    if unknown:
+        raise ValueError('Unknown flag types {}, expected some of {}'.format(
+            sorted(unknown), FLAG_NAMES))
+    return sum(1 << FLAG_NAMES.index(name) for name in names)
+
+
+def pol_columns(corr_products, pol):
+    """
+    Get the indices of the correlation products of one polarisation.
+
+    Parameters:
+    -----------
+    corr_products : numpy array
+        correlator input pairs such as ('m000h', 'm001v')
+    pol : str
+        polarisation product [HH or VV or HV or VH]
+
+    Returns:
+    --------
+    output : numpy array
+        indices of the correlation products of `pol`
+    """
+    corr_products = np.asarray(corr_products).astype(str)
+    first = np.char.endswith(corr_products[:, 0], pol[0].lower())
+    second = np.char.endswith(corr_products[:, 1], pol[1].lower())
+    return np.flatnonzero(first & second)
+
+
+def selection_raw(vis, pols, corrprod, scan, clean_ants):
+    """
+    Do the subselection of `selection` for several polarisations at once.
+
+    All the flag types are kept in the raw flags, so that one read of the
+    data serves every polarisation and flag type.
+
+    Parameters:
+    -----------
+    vis : katdal.visdatav4.VisibilityDataV4
+       katdal data object
+    pols : python list
+        polarization products to use [HH, VV, HV and/or VH]
+    corrprod : str
+        type of correlation product, either 'cross' or 'auto'
+    scan : str
+        type of a scan to use [track or slew]
+    clean_ants : python list
+        list of clean antennas
+
+    Returns:
+    --------
+    output : katdal.lazy_indexer.DaskLazyIndexer
+        sub selected katdal lazy indexer of raw uint8 flags
+    """
+    good_targets = get_good_targets(vis)
+    vis.select(corrprods=corrprod, pol=list(pols), scans=scan, ants=clean_ants,
+               targets=good_targets)
+    return vis.raw_flags
+
+def NewFlagChunk(flag_chunk, factor=8):
     """
     Reduce 32k flag array to 4k flag array.
     
     NB: If any of the averaged samples is TRUE then
         the average becomes true.
+
+    The channel axis is viewed as [F // factor, factor] without a copy, so
+    only the reduced array is allocated. The update kernels do the same
+    reduction on the fly and do not need this.
     
     Paramaters:
     -----------
-    flag : numpy array
-        flags array
+    flag_chunk : numpy array
+        flags array with dimension of [T, F, B]
+    factor : int
+        number of channels averaged together. default: 8
         
     Returns:
     --------
     output : numpy array
         average numpy array
     """
-    averaged_chunk = block_reduce(flag_chunk, block_size=(1, 8, 1), func=np.any)
+    ntime, nchan, nbl = flag_chunk.shape
+    averaged_chunk = flag_chunk.reshape(ntime, nchan // factor, factor, nbl).any(axis=2)
     return averaged_chunk 
 
 
+def average_freqs(freqs, factor):
+    """
+    Get the centre frequencies of channels averaged in groups of `factor`.
+
+    Parameters:
+    -----------
+    freqs : numpy array
+        channel frequencies
+    factor : int
+        number of channels averaged together
+
+    Returns:
+    --------
+    output : numpy array
+        averaged channel frequencies
+    """
+    freqs = np.asarray(freqs)
+    return freqs.reshape(-1, factor).mean(axis=1)
+
+
 def get_az_and_el(vis):
     """
     Get the telescope pointings (i.e. elevation and azimuth).
@@ -173,40 +344,82 @@ def get_az_and_el(vis):
     return elmean, azmean
 
 
-def get_time_idx(vis):
+# UTC offsets in seconds of the supported civil time frames
+TIME_FRAMES = {'UTC': 0, 'SAST': 2 * 3600}
+
+# East longitude of the MeerKAT array reference position in degrees
+MEERKAT_LONGITUDE = 21.44389
+
+
+def get_time_bins(bin_minutes=60):
     """
-    Convert unix time to hour of a day.
+    Get the start of every time-of-day bin.
+
+    Parameters:
+    -----------
+    bin_minutes : int
+        width of the time bins in minutes, must divide a day. default: 60
+
+    Returns:
+    --------
+    output: numpy array
+       start of every bin in hours
+    """
+    if bin_minutes <= 0 or 1440 % bin_minutes:
+        raise ValueError('Time bin of {} minutes does not divide a day'.format(bin_minutes))
+    return np.arange(1440 // bin_minutes) * bin_minutes / 60.
+
+
+def get_time_idx(vis, time_frame='SAST', bin_minutes=60, longitude=MEERKAT_LONGITUDE):
+    """
+    Convert unix time to time-of-day bin.
+
+    Every dump falls in the bin that contains its time of day, so with hourly
+    bins 23:40 is in bin 23. The time of day is taken in a fixed time frame,
+    which makes the result independent of the timezone of the processing node.
 
     Parameters:
     -----------
     vis : katdal.visdatav4.VisibilityDataV4
        katdal data object
+    time_frame : str
+        time frame of the time of day [UTC, SAST or LST]. default: 'SAST'
+    bin_minutes : int
+        width of the time bins in minutes, must divide a day. default: 60
+    longitude : float
+        east longitude in degrees used for local sidereal time. default: MEERKAT_LONGITUDE
 
     Returns:
     --------
     output: numpy array
-       numpy array with time dumps converted to hour of a day
-    """
-    unix = vis.timestamps
-    local_time = []
-    for i in range(len(unix)):
-        local_time.append(datetime.datetime.fromtimestamp((unix[i])).strftime('%H:%M:%S'))
-    # Converting time to hour of a day
-    hour = []
-    for i in range(len(local_time)):
-        h = int(round(int(local_time[i][:2]) + int(local_time[i][3:5])/60 + float(
-            local_time[i][-2:])/3600))
-        if h == 24:
-            hour.append(0)
-        else:
-            hour.append(h)
-    return np.array(hour, dtype=np.int32)
+       numpy array with time dumps converted to time-of-day bins
+    """
+    nbins = len(get_time_bins(bin_minutes))
+    unix = np.asarray(vis.timestamps, dtype=np.float64)
+    if time_frame == 'LST':
+        # Greenwich mean sidereal time in seconds, from days since J2000.0
+        days = unix / 86400. - 10957.5
+        seconds = (18.697374558 + 24.06570982441908 * days) * 3600 + longitude * 240
+    elif time_frame in TIME_FRAMES:
+        seconds = unix + TIME_FRAMES[time_frame]
+    else:
+        raise ValueError('Unknown time frame {!r}, expected one of {}'.format(
+            time_frame, sorted(TIME_FRAMES) + ['LST']))
+    seconds = np.mod(seconds, 86400)
+    time_idx = (seconds // (bin_minutes * 60)).astype(np.int32)
+    # np.mod can round tiny negative values up to a full day
+    time_idx[time_idx >= nbins] = 0
+    return time_idx
 
 
 def get_az_idx(azimuth, azbins):
     """
     Get the azimuth angle indices.
 
+    The bins are given by their lower edges and the last bin extends to 360
+    degrees. Angles are wrapped into [0, 360), so 360 degrees falls in the first
+    bin. Angles that fall in no bin get the index -1.
+
     Parameters:
     -----------
     azimuth : numpy array
@@ -217,37 +430,40 @@ def get_az_idx(azimuth, azbins):
     Returns:
     --------
     output : numpy array
-     array of elevation indices
+     array of azimuth indices
     """
-    az_idx = []
-    for az in azimuth:
-        for j in range(len(azbins)-1):
-            if azbins[j] <= az < azbins[j+1]:
-                az_idx.append(j)
-    return np.array(az_idx)
+    az = np.mod(np.asarray(azimuth, dtype=np.float64), 360)
+    # np.mod can round tiny negative angles up to exactly 360
+    az[az >= 360] -= 360
+    az_idx = np.searchsorted(azbins, az, side='right') - 1
+    az_idx[~(az >= azbins[0])] = -1
+    return az_idx.astype(np.int32)
 
 
-def get_el_idx(elevation, elbins):
+def get_el_idx(elevation, elbins, width=10):
     """
     Get the elevation angle indices.
 
+    Angles outside all the bins, i.e. below the lowest bin or above the last bin
+    edge plus the bin width, get the index -1.
+
     Parameters:
     -----------
     elevation : numpy array
         array of elevation angles
-    azbins : numpy array
+    elbins : numpy array
         array of elevation bins
+    width : float
+        width of the elevation bins in degrees. default: 10
 
     output : numpy array
        array of elevation indices
     """
-    el_idx = []
-
-    for el in elevation:
-        for j in range(len(elbins)):
-            if elbins[j] <= el < elbins[j]+10:
-                el_idx.append(j)
-    return np.array(el_idx, dtype=np.int32)
+    el = np.asarray(elevation, dtype=np.float64)
+    el_idx = np.searchsorted(elbins, el, side='right') - 1
+    valid = (el_idx >= 0) & (el < elbins[np.maximum(el_idx, 0)] + width)
+    el_idx[~valid] = -1
+    return el_idx.astype(np.int32)
 
 
 def get_corrprods(vis):
@@ -271,7 +487,72 @@ def get_corrprods(vis):
     return np.array(bl_idx)
 
 
-def get_bl_idx(vis, nant):
+# First antenna number of every antenna name prefix: the 64 MeerKAT dishes
+# m000-m063, then the SKA dishes s0000-s0063 of MeerKAT+
+ANTENNA_OFFSETS = {'m': 0, 's': 64}
+
+
+@functools.lru_cache(maxsize=None)
+def baseline_lut(nant):
+    """
+    Get the lookup table from antenna pairs to baseline indices.
+
+    Baselines are numbered in the order of np.triu_indices(nant, 1). The
+    table is symmetric, so reversed pairs get the same index, and the
+    autocorrelations on the diagonal get -1. It is built once per antenna
+    count and shared, so it must not be modified.
+
+    Parameters:
+    -----------
+    nant : int
+       number of antennas
+
+    Returns:
+    --------
+    output : numpy array
+       baseline indices with dimension of [nant, nant]
+    """
+    A1, A2 = np.triu_indices(nant, 1)
+    lut = np.full((nant, nant), -1, dtype=np.int32)
+    lut[A1, A2] = np.arange(len(A1))
+    lut[A2, A1] = np.arange(len(A1))
+    lut.flags.writeable = False
+    return lut
+
+
+def antenna_numbers(inputs):
+    """
+    Parse the antenna numbers out of antenna or correlator input names such
+    as 'm012' or 'm012h'. The number of a name is the offset of its prefix
+    in ANTENNA_OFFSETS plus its digits, so that 'm000' and 's0000' differ.
+
+    Parameters:
+    -----------
+    inputs : array-like
+       antenna or correlator input names
+
+    Returns:
+    --------
+    output : numpy array
+       antenna number of every input
+
+    Raises:
+    -------
+    ValueError
+       if a name does not start with one of the prefixes of ANTENNA_OFFSETS
+    """
+    names, inverse = np.unique(np.asarray(inputs), return_inverse=True)
+    numbers = []
+    for name in names:
+        match = re.match(r'([a-z]+)(\d+)', name)
+        if match is None or match.group(1) not in ANTENNA_OFFSETS:
+            raise ValueError('Antenna {!r} does not start with one of the prefixes {}'.format(
+                name, sorted(ANTENNA_OFFSETS)))
+        numbers.append(ANTENNA_OFFSETS[match.group(1)] + int(match.group(2)))
+    return np.array(numbers, dtype=np.int32)[inverse.ravel()]
+
+
+def get_bl_idx(vis, nant=64):
     """
     Get the indices of the correlation products.
 
@@ -280,57 +561,486 @@ def get_bl_idx(vis, nant):
     vis : katdal.visdatav4.VisibilityDataV4
        katdal data object
     nant : int
-       number of antennas
+       number of antennas of the array. default: 64
 
     Returns:
     --------
     output : numpy array
        array of baseline indices
     """
-    nant = nant
-    A1, A2 = np.triu_indices(nant, 1)
-    # Creating baseline antenna combinations
-    corr_products = np.array(['m{:03d}m{:03d}'.format(A1[i], A2[i]) for i in range(len(A1))])
-    df = pd.DataFrame(data=np.arange(len(A1)), index=corr_products).T
-    corr_prods = get_corrprods(vis)
-    bl_idx = df[corr_prods].values[0].astype(np.int32)
+    corr_products = np.asarray(vis.corr_products)
+    A1 = antenna_numbers(corr_products[:, 0])
+    A2 = antenna_numbers(corr_products[:, 1])
+    if len(A1) and max(A1.max(), A2.max()) >= nant:
+        raise ValueError('Antenna number {} is out of range for {} antennas'.format(
+            max(A1.max(), A2.max()), nant))
+    bl_idx = baseline_lut(nant)[A1, A2]
+    if np.any(bl_idx < 0):
+        raise ValueError('Autocorrelations have no baseline index')
     return bl_idx
 
 
-@jit(nopython=True, parallel=True)
-def update_arrays(Time_idx, Bl_idx, El_idx, Az_idx, Good_flags, Master, Counter):
+def get_pair_lengths(vis, nant=64):
     """
-    Update the master and counter array
+    Get the physical length of every baseline of the raw baseline axis.
 
     Parameters:
     -----------
     vis : katdal.visdatav4.VisibilityDataV4
        katdal data object
-    azbins : numpy array
-        array of azimuthal bins
-    elbins : numpy array
-        array of elevation bins
-    Good_flags : katdal.lazy_indexer.DaskLazyIndexer
-        sub selected katdal lazy indexer of RFI flags
-    Master : numpy array
-       array contains the number of RFI points per voxel with dimension of [T, F, B, Az, El]
-    Counter : numpy array
-      array contains the total number of observations per voxel with dimension of [T, F, B, Az, El]
+    nant : int
+       number of antennas of the array. default: 64
 
     Returns:
-    -------
+    --------
+    output : numpy array
+       length in metres per baseline index of baseline_lut, NaN for the
+       baselines of antennas that are not in the observation
+    """
+    numbers = antenna_numbers([ant.name for ant in vis.ants])
+    positions = np.array([ant.position_enu for ant in vis.ants], dtype=float).reshape(-1, 3)
+    keep = numbers < nant
+    numbers, positions = numbers[keep], positions[keep]
+    A1, A2 = np.triu_indices(len(numbers), 1)
+    lengths = np.full(nant * (nant - 1) // 2, np.nan)
+    lengths[baseline_lut(nant)[numbers[A1], numbers[A2]]] = np.linalg.norm(
+        positions[A1] - positions[A2], axis=1)
+    return lengths
+
+
+def get_length_idx(lengths, edges):
+    """
+    Get the baseline length bin of every correlation product.
+
+    Parameters:
+    -----------
+    lengths : numpy array
+       baseline lengths in metres
+    edges : numpy array
+       increasing lower edges of the bins in metres, the first one 0
+
+    Returns:
+    --------
     output : numpy array
-      updated master and counter array
-    """
-   
-    cstep = 128
-    cblocks = (4096 + cstep - 1) // cstep
-    for cblock in prange(cblocks):
-        c_start = cblock * cstep
-        c_end = min(4096, c_start + cstep)
-        for k in range(c_start, c_end):
-            for i in range(len(Bl_idx)):
-                for j in range(len(Time_idx)):
-                    Master[Time_idx[j], k, Bl_idx[i], El_idx[j], Az_idx[j]] += Good_flags[j, k, i]
-                    Counter[Time_idx[j], k, Bl_idx[i], El_idx[j], Az_idx[j]] += 1
-    return Master, Counter
+       array of length bin indices
+    """
+    return (np.searchsorted(edges, lengths, side='right') - 1).astype(np.int32)
+
+
+def get_ant_idx(vis, nant=64):
+    """
+    Get the two antenna indices of every correlation product.
+
+    Parameters:
+    -----------
+    vis : katdal.visdatav4.VisibilityDataV4
+       katdal data object
+    nant : int
+       number of antennas of the array. default: 64
+
+    Returns:
+    --------
+    output : numpy array
+       antenna numbers with dimension of [2, B], so that every flag counts
+       for both of its antennas
+    """
+    corr_products = np.asarray(vis.corr_products)
+    ant_idx = np.stack([antenna_numbers(corr_products[:, 0]),
+                        antenna_numbers(corr_products[:, 1])]).astype(np.int32)
+    if ant_idx.size and ant_idx.max() >= nant:
+        raise ValueError('Antenna number {} is out of range for {} antennas'.format(
+            ant_idx.max(), nant))
+    return ant_idx
+
+
+# Update kernels that can be selected with the `engine` argument of SparseAccumulator.
+# The kernels themselves are in kathprfi_kernels, which imports numba.
+ENGINES = ('scatter', 'grouped')
+
+# Names re-exported from kathprfi_kernels on first use
+_KERNEL_NAMES = ('get_flag', 'update_arrays', 'update_arrays_grouped', 'UPDATE_ENGINES', 'warmup')
+
+
+def __getattr__(name):
+    if name in _KERNEL_NAMES:
+        import kathprfi_kernels
+        return getattr(kathprfi_kernels, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+# Unsigned dtypes that the master and counter arrays are promoted through
+COUNT_DTYPES = (np.uint16, np.uint32, np.uint64)
+
+
+def promote_dtype(dtype, maximum):
+    """
+    Get the narrowest count dtype, at least as wide as `dtype`, that holds `maximum`.
+
+    Parameters:
+    -----------
+    dtype : numpy dtype
+        current dtype of the counts
+    maximum : int
+        largest count that has to be represented
+
+    Returns:
+    --------
+    output : numpy dtype
+        `dtype` itself if it is wide enough, otherwise the next wide enough COUNT_DTYPES entry
+    """
+    dtype = np.dtype(dtype)
+    if maximum <= np.iinfo(dtype).max:
+        return dtype
+    for candidate in COUNT_DTYPES:
+        candidate = np.dtype(candidate)
+        if candidate.itemsize > dtype.itemsize and maximum <= np.iinfo(candidate).max:
+            return candidate
+    raise OverflowError('{} counts do not fit in any of the count dtypes'.format(maximum))
+
+
+class SparseAccumulator(object):
+    """
+    Block-sparse master and counter accumulator.
+
+    Only the (time, elevation, azimuth) cells that an observation actually
+    visits get storage. Every visited cell owns a dense [frequency, baseline]
+    block in the `master` and `counter` arrays, and `cells` maps the cell
+    coordinates to the position of its block.
+
+    `bounds` holds an upper bound of the counter values of every block, and
+    so of its master values too. Before an update or merge could wrap the
+    counts, both arrays are promoted to the next wider of COUNT_DTYPES and
+    the change is recorded in `promotions`.
+
+    `lengths` holds the length in metres of every baseline of the raw
+    baseline axis whose antennas were seen, NaN for the others, so that the
+    counts can be summed by baseline length class later.
+
+    Parameters:
+    -----------
+    nfreq : int
+        number of frequency channels per block. default: 4096
+    nbl : int
+        number of baselines per block. default: 2016
+    cell_shape : tuple
+        number of (time, elevation, azimuth) bins of the full cube. default: (24, 8, 24)
+    dtype : numpy dtype
+        dtype of the master and counter blocks. default: np.uint16
+    engine : str
+        update kernel to use, one of ENGINES [scatter or grouped]. default: 'scatter'
+    """
+
+    def __init__(self, nfreq=4096, nbl=2016, cell_shape=(24, 8, 24), dtype=np.uint16,
+                 engine='scatter'):
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine {!r}, expected one of {}'.format(
+                engine, sorted(ENGINES)))
+        self.engine = engine
+        self.nfreq = nfreq
+        self.nbl = nbl
+        self.cell_shape = tuple(cell_shape)
+        self.dtype = np.dtype(dtype)
+        self.cells = {}
+        self.promotions = []
+        self.lengths = np.full(nbl, np.nan)
+        self.bounds = np.zeros(0, dtype=np.uint64)
+        self.master = np.zeros((0, nfreq, nbl), dtype=self.dtype)
+        self.counter = np.zeros((0, nfreq, nbl), dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getstate__(self):
+        # Only pickle the blocks in use, not the spare capacity
+        state = self.__dict__.copy()
+        state['master'] = self.master[:len(self.cells)]
+        state['counter'] = self.counter[:len(self.cells)]
+        return state
+
+    @property
+    def nbytes(self):
+        """Number of bytes held by the allocated blocks."""
+        return self.master.nbytes + self.counter.nbytes
+
+    def _grow(self, nblocks):
+        """
+        Make room for at least `nblocks` blocks, doubling the capacity
+        so that repeated growth stays amortised.
+        """
+        if len(self.bounds) < nblocks:
+            self.bounds = np.concatenate(
+                [self.bounds, np.zeros(nblocks - len(self.bounds), dtype=np.uint64)])
+        capacity = self.master.shape[0]
+        if nblocks <= capacity:
+            return
+        capacity = max(nblocks, 2 * capacity)
+        for name in ('master', 'counter'):
+            old = getattr(self, name)
+            new = np.zeros((capacity, self.nfreq, self.nbl), dtype=self.dtype)
+            new[:old.shape[0]] = old
+            setattr(self, name, new)
+
+    def block_idx(self, Time_idx, El_idx, Az_idx):
+        """
+        Map every dump onto the block of its (time, elevation, azimuth) cell,
+        allocating blocks for cells that have not been seen before. Dumps
+        with a negative index get the block index -1.
+
+        Parameters:
+        -----------
+        Time_idx : numpy array
+            time indices per dump
+        El_idx : numpy array
+            elevation indices per dump
+        Az_idx : numpy array
+            azimuth indices per dump
+
+        Returns:
+        --------
+        output : numpy array
+            block indices per dump
+        """
+        valid = (Time_idx >= 0) & (El_idx >= 0) & (Az_idx >= 0)
+        keys = np.ravel_multi_index((Time_idx[valid], El_idx[valid], Az_idx[valid]),
+                                    self.cell_shape)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        blocks = np.empty(len(unique_keys), dtype=np.int32)
+        for n, key in enumerate(unique_keys):
+            cell = tuple(int(c) for c in np.unravel_index(key, self.cell_shape))
+            if cell not in self.cells:
+                self.cells[cell] = len(self.cells)
+            blocks[n] = self.cells[cell]
+        self._grow(len(self.cells))
+        Block_idx = np.full(len(Time_idx), -1, dtype=np.int32)
+        Block_idx[valid] = blocks[inverse.ravel()]
+        return Block_idx
+
+    def promote(self, dtype, reason=''):
+        """
+        Widen the master and counter blocks to `dtype` and record the promotion.
+
+        Parameters:
+        -----------
+        dtype : numpy dtype
+            new dtype, wider than the current one
+        reason : str
+            what triggered the promotion, kept in `promotions`. default: ''
+        """
+        dtype = np.dtype(dtype)
+        if dtype == self.dtype:
+            return
+        logging.info('Promoting the accumulator from {} to {} ({})'.format(
+            self.dtype, dtype, reason))
+        self.promotions.append({'from': self.dtype.name, 'to': dtype.name, 'reason': reason})
+        self.master = self.master.astype(dtype)
+        self.counter = self.counter.astype(dtype)
+        self.dtype = dtype
+
+    def _reserve(self, bounds, reason):
+        """Promote the blocks if any of the new count bounds would overflow them."""
+        if len(bounds):
+            self.promote(promote_dtype(self.dtype, int(bounds.max())), reason)
+        self.bounds = bounds
+
+    def update(self, Time_idx, Bl_idx, El_idx, Az_idx, Good_flags, packed=False):
+        """
+        Add a chunk of flags to the accumulator.
+
+        Parameters:
+        -----------
+        Time_idx : numpy array
+            time indices per dump
+        Bl_idx : numpy array
+            baseline indices per correlation product, or rows of them that
+            every flag is added to, such as the two antennas of a product
+        El_idx : numpy array
+            elevation indices per dump
+        Az_idx : numpy array
+            azimuth indices per dump
+        Good_flags : numpy array
+            flags with dimension of [T, F, B], where F is a multiple of nfreq.
+            Groups of F // nfreq channels are averaged by the kernel.
+        packed : bool
+            the flags are bit-packed along the channel axis, [T, F // 8, B]. default: False
+        """
+        nchan = 8 * Good_flags.shape[1] if packed else Good_flags.shape[1]
+        if nchan % self.nfreq:
+            raise ValueError('{} flag channels cannot be averaged to {} channels'.format(
+                nchan, self.nfreq))
+        Block_idx = self.block_idx(Time_idx, El_idx, Az_idx)
+        Bl_idx = np.atleast_2d(Bl_idx)
+        # Every dump adds at most one count per correlation product of a baseline
+        products = np.bincount(Bl_idx.ravel()).max() if Bl_idx.size else 0
+        dumps = np.bincount(Block_idx[Block_idx >= 0], minlength=len(self.bounds))
+        self._reserve(self.bounds + dumps.astype(np.uint64) * np.uint64(products), 'update')
+        zeros = np.zeros(len(Block_idx), dtype=np.int32)
+        # The blocks form a cube with singleton elevation and azimuth axes, which
+        # lets the kernels scatter into them with the block index as time index.
+        shape = self.master.shape + (1, 1)
+        from kathprfi_kernels import UPDATE_ENGINES
+        kernel = UPDATE_ENGINES[self.engine]
+        for row in Bl_idx:
+            kernel(Block_idx, row, zeros, zeros, Good_flags,
+                   self.master.reshape(shape), self.counter.reshape(shape), packed)
+
+    def merge(self, other):
+        """
+        Add the master and counter blocks of another accumulator to this one.
+
+        Parameters:
+        -----------
+        other : SparseAccumulator
+            accumulator with the same frequency, baseline and cell layout
+
+        Returns:
+        --------
+        output : SparseAccumulator
+            this accumulator, updated
+        """
+        if (other.nfreq, other.nbl, other.cell_shape) != (self.nfreq, self.nbl, self.cell_shape):
+            raise ValueError('Cannot merge accumulators with different layouts')
+        for cell in other.cells:
+            if cell not in self.cells:
+                self.cells[cell] = len(self.cells)
+        self._grow(len(self.cells))
+        self.promotions.extend(other.promotions)
+        self.lengths = np.fmax(self.lengths, other.lengths)
+        bounds = self.bounds.copy()
+        for cell, blk in other.cells.items():
+            bounds[self.cells[cell]] += other.bounds[blk]
+        self.promote(np.promote_types(self.dtype, other.dtype), 'merge')
+        self._reserve(bounds, 'merge')
+        for cell, blk in other.cells.items():
+            self.master[self.cells[cell]] += other.master[blk]
+            self.counter[self.cells[cell]] += other.counter[blk]
+        return self
+
+    def to_dense(self):
+        """
+        Expand the blocks into the full [T, F, B, El, Az] master and counter arrays.
+
+        Returns:
+        --------
+        output : numpy arrays
+            dense master and counter arrays
+        """
+        shape = (self.cell_shape[0], self.nfreq, self.nbl) + self.cell_shape[1:]
+        master = np.zeros(shape, dtype=self.dtype)
+        counter = np.zeros(shape, dtype=self.dtype)
+        for (t, e, a), blk in self.cells.items():
+            master[t, :, :, e, a] = self.master[blk]
+            counter[t, :, :, e, a] = self.counter[blk]
+        return master, counter
+
+
+def _byte_aligned(dataset):
+    """Rechunk the channel axis so that every chunk starts on a byte boundary."""
+    if any(size % 8 for size in dataset.chunks[1][:-1]):
+        size = 8 * max(1, dataset.chunks[1][0] // 8)
+        dataset = dataset.rechunk({1: size})
+    return dataset
+
+
+def pack_flags(dataset):
+    """
+    Bit-pack a dask array of flags along the channel axis, chunk by chunk.
+
+    Every dask chunk is packed as soon as it is read, so a fetched block
+    only ever holds one bit per flag.
+
+    Parameters:
+    -----------
+    dataset : dask.array.Array
+        boolean flags with dimension of [T, F, B]
+
+    Returns:
+    --------
+    output : dask.array.Array
+        uint8 flags with dimension of [T, ceil(F / 8), B]
+    """
+    dataset = _byte_aligned(dataset)
+    chunks = (dataset.chunks[0], tuple((size + 7) // 8 for size in dataset.chunks[1]),
+              dataset.chunks[2])
+    return dataset.map_blocks(np.packbits, axis=1, dtype=np.uint8, chunks=chunks)
+
+
+def split_raw_flags(raw_flags, masks):
+    """Bit-pack the flags of every mask of a block of raw flags, stacked on a last axis."""
+    return np.stack([np.packbits((raw_flags & mask) != 0, axis=1) for mask in masks], axis=-1)
+
+
+def pack_raw_flags(dataset, masks):
+    """
+    Split a dask array of raw flags into bit-packed flags per mask, chunk by chunk.
+
+    Parameters:
+    -----------
+    dataset : dask.array.Array
+        uint8 raw flags with dimension of [T, F, B]
+    masks : tuple
+        raw flag bit masks, see flag_mask
+
+    Returns:
+    --------
+    output : dask.array.Array
+        uint8 flags with dimension of [T, ceil(F / 8), B, len(masks)]
+    """
+    dataset = _byte_aligned(dataset)
+    chunks = (dataset.chunks[0], tuple((size + 7) // 8 for size in dataset.chunks[1]),
+              dataset.chunks[2], (len(masks),))
+    return dataset.map_blocks(split_raw_flags, tuple(masks), dtype=np.uint8, chunks=chunks,
+                              new_axis=3)
+
+
+def iter_flag_chunks(flags, time_chunk, packed=False, masks=None):
+    """
+    Read flags in large time blocks aligned to the dask chunking.
+
+    Consecutive dask chunks along the time axis are grouped until a block
+    holds at least `time_chunk` dumps, so that every block is fetched with a
+    single dask compute and no chunk is read twice.
+
+    Parameters:
+    -----------
+    flags : katdal.lazy_indexer.DaskLazyIndexer
+        sub selected katdal lazy indexer of RFI flags
+    time_chunk : int
+        minimum number of dumps per block
+    packed : bool
+        bit-pack the flags along the channel axis. default: False
+    masks : tuple
+        raw flag bit masks. If given, `flags` are raw flags that are split
+        into bit-packed flags per mask. default: None
+
+    Returns:
+    --------
+    output : generator
+        (time_slice, flag_chunk) pairs with flag_chunk a numpy array of
+        [T, F, B], of [T, F // 8, B] if packed, or of [T, F // 8, B, M] for
+        M masks
+    """
+    ntime = flags.shape[0]
+    dataset = getattr(flags, 'dataset', None)
+    if dataset is not None and hasattr(dataset, 'chunks'):
+        bounds = np.cumsum(dataset.chunks[0])
+        if masks is not None:
+            dataset = pack_raw_flags(dataset, masks)
+        elif packed:
+            dataset = pack_flags(dataset)
+    else:
+        dataset = None
+        bounds = np.arange(1, ntime + 1)
+    start = 0
+    for stop in bounds:
+        if stop - start >= time_chunk or stop == ntime:
+            time_slice = slice(start, int(stop))
+            if dataset is not None and (packed or masks is not None):
+                flag_chunk = dataset[time_slice].compute()
+            elif masks is not None:
+                flag_chunk = split_raw_flags(np.asarray(flags[time_slice]), masks)
+            elif packed:
+                flag_chunk = np.packbits(np.asarray(flags[time_slice]), axis=1)
+            else:
+                flag_chunk = np.asarray(flags[time_slice])
+            yield time_slice, flag_chunk
+            start = int(stop)
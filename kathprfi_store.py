@@ -0,0 +1,1083 @@
+"""
+Master zarr store that accumulates observations incrementally.
+
+The store holds the dense [time, frequency, baseline, elevation, azimuth]
+master and counter arrays in the 'arr' group, chunked per (time, elevation,
+azimuth) cell by default. Merging an observation only reads and rewrites the
+chunks of the cells it visited, and the capture block IDs that have been
+merged are recorded in the group attributes so that re-runs skip them.
+Every write of a merge goes through a redo journal, so that a merge that
+was interrupted is resumed by running it again.
+Chunks are compressed with Blosc zstd and bit-shuffle, and chunks that only
+hold zeros are never written.
+
+Merged totals are kept in a wider dtype than the per-file partials. When a
+merge would still overflow the store dtype, both arrays are rewritten in the
+next wider dtype and the promotion is recorded in the group attributes. The
+rewritten arrays replace the old ones by renaming directories, so stores that
+may need a promotion have to be in a local directory.
+"""
+import logging
+import os
+import re
+import shutil
+
+import numpy as np
+import zarr
+from zarr.codecs import BloscCodec
+
+import kathprfi_single_file as kathp
+
+GROUP = 'arr'
+DIMS = ('time', 'frequency', 'baseline', 'elevation', 'azimuth')
+# Baseline length classes of the marginals of a store with a raw baseline axis
+LENGTH = 'length'
+# Narrowest dtype of the merged totals in a store
+STORE_DTYPE = np.uint32
+
+# Chunk shapes per query pattern, with -1 for a whole axis:
+#   cell      the spectra of all baselines of one (time, elevation, azimuth) cell.
+#             Suits incremental stores, a merge only rewrites the visited cells.
+#   baseline  all cells of one baseline, in blocks of 256 channels. Suits files
+#             written once, every chunk holds cells that any merge visits.
+CHUNK_PRESETS = {'cell': (1, -1, -1, 1, 1),
+                 'baseline': (-1, 256, 1, -1, -1)}
+
+# Largest region of a store array read and written at once when merging, in bytes
+REGION_BYTES = 64 * 1024**2
+
+# Bit-shuffle puts the mostly zero high bits of the counts together, which zstd
+# then compresses to almost nothing at a low level
+COMPRESSION = {'cname': 'zstd', 'clevel': 3, 'shuffle': 'bitshuffle'}
+
+# Array of the store holding the new values of the last journaled write of a merge
+JOURNAL = 'journal'
+# Group of the store holding the accumulator of the merge in progress
+MERGING = 'merging'
+# Suffixes of the copies of the arrays of a promotion, and of the arrays they replace
+PROMOTED = '_promoted'
+REPLACED = '_replaced'
+
+
+def chunk_shape(shape, chunks='cell'):
+    """
+    Get the chunk shape of a master or counter array.
+
+    Parameters:
+    -----------
+    shape : tuple
+        shape of the [time, frequency, baseline, elevation, azimuth] array
+    chunks : str or tuple
+        key of CHUNK_PRESETS, a tuple of five chunk sizes or the same as a
+        comma separated string, with -1 for a whole axis. default: 'cell'
+
+    Returns:
+    --------
+    output : tuple
+        chunk size per axis
+    """
+    if isinstance(chunks, str):
+        if chunks in CHUNK_PRESETS:
+            chunks = CHUNK_PRESETS[chunks]
+        else:
+            try:
+                chunks = tuple(int(size) for size in chunks.split(','))
+            except ValueError:
+                raise ValueError('Unknown chunk preset {!r}, expected one of {} or five '
+                                 'comma separated sizes'.format(chunks, sorted(CHUNK_PRESETS)))
+    if len(chunks) != len(DIMS):
+        raise ValueError('Chunks {} do not have one size per axis of {}'.format(chunks, DIMS))
+    return tuple(n if size == -1 else max(1, min(size, n)) for size, n in zip(chunks, shape))
+
+
+def encoding(ds, chunks='cell'):
+    """
+    Get the zarr encoding of the master and counter arrays of a dataset.
+
+    Parameters:
+    -----------
+    ds : xarray.Dataset
+        dataset with master and counter arrays
+    chunks : str or tuple
+        chunk preset or shape, see chunk_shape. default: 'cell'
+
+    Returns:
+    --------
+    output : dict
+        encoding argument of xarray.Dataset.to_zarr
+    """
+    return {name: {'chunks': chunk_shape(ds[name].shape, chunks),
+                   'compressors': [BloscCodec(**COMPRESSION)]}
+            for name in ('master', 'counter')}
+
+
+def capture_block_id(path):
+    """
+    Get the capture block ID of an RDB file from its path or URL.
+
+    Parameters:
+    -----------
+    path : str
+        RDB file
+
+    Returns:
+    --------
+    output : str
+        the ten digit capture block ID, or the file name if there is none
+    """
+    name = os.path.basename(path.split('?')[0])
+    match = re.search(r'\d{10}', name) or re.search(r'\d{10}', path)
+    return match.group(0) if match else name
+
+
+def chunk_regions(shape, chunks):
+    """
+    Iterate over the regions of an array covered by its chunks.
+
+    Parameters:
+    -----------
+    shape : tuple
+        shape of the array
+    chunks : tuple
+        chunk shape of the array
+
+    Returns:
+    --------
+    output : generator
+        tuple of slices per chunk
+    """
+    starts = [range(0, n, size) for n, size in zip(shape, chunks)]
+    for corner in np.ndindex(*[len(axis) for axis in starts]):
+        yield tuple(slice(axis[i], min(axis[i] + size, n))
+                    for axis, i, size, n in zip(starts, corner, chunks, shape))
+
+
+class MergeJournal(object):
+    """
+    Redo journal that lets an interrupted merge be resumed.
+
+    The writes of a merge to the cube and the marginals are numbered steps.
+    Before a step is written, its new values are saved in the JOURNAL array
+    of the store, together with the step number, and then the number is
+    recorded in the 'merge_progress' attribute of the cube group. A merge
+    that is run again after a crash skips the steps before the recorded one
+    and writes the journaled values of that step again, so that no count is
+    added twice. If the journal already holds a later step, the recorded
+    step was written in full before the crash and is skipped too.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+    group : zarr.Group
+        cube group of the store
+    progress : dict
+        progress of the merge, with the last journaled 'step'
+    """
+
+    def __init__(self, path, group, progress):
+        self.root = zarr.open_group(path, mode='r+', use_consolidated=False)
+        self.group = group
+        self.progress = dict(progress)
+        self.resume = self.progress.get('step', -1)
+        self.step = -1
+
+    def write(self, array, selection, compute):
+        """
+        Write the next step of the merge.
+
+        Parameters:
+        -----------
+        array : zarr.Array
+            array that is written
+        selection : tuple
+            region of the array
+        compute : callable
+            function without arguments that computes the new values of the
+            region, only called for steps that were not journaled before
+        """
+        self.step += 1
+        if self.step < self.resume:
+            return
+        if self.step == self.resume:
+            journal = self.root[JOURNAL] if JOURNAL in self.root else None
+            # The journal of the next step only replaces this one once it is written
+            if journal is not None and journal.attrs.get('step') == self.step:
+                array[selection] = journal[...]
+            return
+        values = np.asarray(compute())
+        journal = self.root.create_array(JOURNAL, shape=values.shape, dtype=values.dtype,
+                                         chunks=values.shape,
+                                         compressors=[BloscCodec(**COMPRESSION)],
+                                         attributes={'step': self.step}, overwrite=True)
+        journal[...] = values
+        self.save(self.step)
+        array[selection] = values
+
+    def save(self, step):
+        """Record in the cube group that the values of `step` are journaled."""
+        self.progress['step'] = step
+        self.group.attrs['merge_progress'] = self.progress
+
+    def close(self):
+        """Remove the journal of a finished merge."""
+        # A merge that is run again from here on has no step left to replay
+        self.save(self.step + 1)
+        if JOURNAL in self.root:
+            del self.root[JOURNAL]
+
+
+def save_merging(path, acc, cbids, offset=0):
+    """
+    Save the accumulator of a merge that is about to start in the store, so
+    that an interrupted merge can be finished with the same accumulator and
+    so the same steps, see finish_merge.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+    acc : SparseAccumulator
+        accumulator of the merge
+    cbids : list
+        capture block IDs of the observations in the accumulator
+    offset : int
+        first channel of the store covered by the accumulator. default: 0
+    """
+    root = zarr.open_group(path, mode='r+', use_consolidated=False)
+    group = root.create_group(MERGING, overwrite=True)
+    nblocks = len(acc.cells)
+    arrays = {'master': acc.master[:nblocks], 'counter': acc.counter[:nblocks],
+              'bounds': acc.bounds[:nblocks], 'lengths': acc.lengths}
+    for name, values in arrays.items():
+        # One chunk per [frequency, baseline] block
+        chunks = (1,) + values.shape[1:] if values.ndim == 3 else (max(1, len(values)),)
+        array = group.create_array(name, shape=values.shape, dtype=values.dtype, chunks=chunks,
+                                   compressors=[BloscCodec(**COMPRESSION)])
+        array[...] = values
+    group.attrs.update({'capture_blocks': list(cbids), 'offset': offset,
+                        'cells': [[int(i) for i in cell] for cell in
+                                  sorted(acc.cells, key=acc.cells.get)],
+                        'cell_shape': list(acc.cell_shape), 'engine': acc.engine,
+                        'promotions': list(acc.promotions)})
+
+
+def load_merging(path):
+    """
+    Load the accumulator of the merge in progress, see save_merging.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+
+    Returns:
+    --------
+    output : tuple or None
+        accumulator, capture block IDs and first channel of the merge, None
+        if no accumulator is saved
+    """
+    root = zarr.open_group(path, mode='r', use_consolidated=False)
+    if MERGING not in root:
+        return None
+    group = root[MERGING]
+    master = group['master'][...]
+    acc = kathp.SparseAccumulator(nfreq=master.shape[1], nbl=master.shape[2],
+                                  cell_shape=group.attrs['cell_shape'], dtype=master.dtype,
+                                  engine=group.attrs['engine'])
+    acc.cells = {tuple(cell): blk for blk, cell in enumerate(group.attrs['cells'])}
+    acc.master, acc.counter = master, group['counter'][...]
+    acc.bounds, acc.lengths = group['bounds'][...], group['lengths'][...]
+    acc.promotions = list(group.attrs['promotions'])
+    return acc, list(group.attrs['capture_blocks']), group.attrs['offset']
+
+
+def drop_merging(path):
+    """Remove the accumulator of a finished merge, see save_merging."""
+    root = zarr.open_group(path, mode='r+', use_consolidated=False)
+    if MERGING in root:
+        del root[MERGING]
+
+
+def _write(array, selection, compute, journal=None):
+    """Write the values computed by `compute` to a region, through `journal` if given."""
+    if journal is None:
+        array[selection] = compute()
+    else:
+        journal.write(array, selection, compute)
+
+
+def add_cells(array, cells, blocks, offset=0, journal=None):
+    """
+    Add the [frequency, baseline] blocks of cells to a store array.
+
+    The cells are grouped by the chunks they fall in, and every chunk is
+    read and written once, whatever the chunk shape. Neighbouring chunks
+    along the baseline and frequency axes are read together in regions of
+    up to REGION_BYTES. Blocks of a frequency tile only touch the channels
+    from `offset` on. The regions are written in a fixed order, so that a
+    merge resumed through its journal makes the same steps.
+
+    Parameters:
+    -----------
+    array : zarr.Array
+        [time, frequency, baseline, elevation, azimuth] array of the store
+    cells : dict
+        block index per (time, elevation, azimuth) cell
+    blocks : numpy array
+        [frequency, baseline] blocks to add
+    offset : int
+        first channel of the store covered by the blocks. default: 0
+    journal : MergeJournal
+        journal that every region is written through, None to write the
+        regions directly. default: None
+    """
+    ct, cf, cb, ce, ca = array.chunks
+    nfreq, nbl = array.shape[1:3]
+    # Number of chunks per region, taken along the baselines first
+    nchunks = max(1, REGION_BYTES // (ct * cf * cb * ce * ca * array.dtype.itemsize))
+    bspan = cb * min(nchunks, -(-nbl // cb))
+    fspan = cf * min(max(1, nchunks // (bspan // cb)), -(-nfreq // cf))
+    groups = {}
+    for (t, e, a), blk in cells.items():
+        groups.setdefault((t // ct, e // ce, a // ca), []).append((t, e, a, blk))
+
+    def added(selection, tile, members):
+        """Read a region and add the blocks of its cells."""
+        ts, _, bs, es, azs = selection
+        region = array[selection]
+        for t, e, a, blk in members:
+            region[t - ts.start, :, :, e - es.start, a - azs.start] += blocks[blk, tile, bs]
+        return region
+
+    for tc, ec, ac in sorted(groups):
+        members = groups[tc, ec, ac]
+        ts = slice(tc * ct, min((tc + 1) * ct, array.shape[0]))
+        es = slice(ec * ce, min((ec + 1) * ce, array.shape[3]))
+        azs = slice(ac * ca, min((ac + 1) * ca, array.shape[4]))
+        for _, fs, bs, _, _ in chunk_regions((1, nfreq, nbl, 1, 1), (1, fspan, bspan, 1, 1)):
+            fs = slice(max(fs.start, offset), min(fs.stop, offset + blocks.shape[1]))
+            if fs.start >= fs.stop:
+                continue
+            selection = (ts, fs, bs, es, azs)
+            tile = slice(fs.start - offset, fs.stop - offset)
+            _write(array, selection, lambda: added(selection, tile, members), journal)
+
+
+def create_store(path, coords, dtype=STORE_DTYPE, attrs=None, chunks='cell'):
+    """
+    Create an empty master store.
+
+    Only the metadata and coordinates are written, with empty marginals.
+    Chunks that are never merged into stay absent and read as zeros.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+    coords : dict
+        coordinates of the time, frequency, baseline, elevation and azimuth
+        axes, as arrays or as DataArrays with attributes. An optional LENGTH
+        entry with the lower edges of baseline length classes adds the
+        marginals over them and a 'baseline_length' coordinate of the raw
+        baseline axis, which the merges fill in.
+    dtype : numpy dtype
+        dtype of the master and counter arrays. default: np.uint32
+    attrs : dict
+        attributes of the time coordinate. default: None
+    chunks : str or tuple
+        chunk preset or shape, see chunk_shape. default: 'cell'
+    """
+    import dask.array as da
+    import xarray as xr
+    shape = tuple(len(coords[dim]) for dim in DIMS)
+    zeros = da.zeros(shape, dtype=dtype, chunks=chunk_shape(shape, chunks))
+    ds = xr.Dataset({'master': (DIMS, zeros), 'counter': (DIMS, zeros)},
+                    {dim: coords[dim] for dim in DIMS})
+    if LENGTH in coords:
+        ds.coords['baseline_length'] = xr.DataArray(
+            np.full(shape[2], np.nan), dims='baseline',
+            attrs={'units': 'm', 'edges': [float(edge) for edge in np.asarray(coords[LENGTH])]})
+    if attrs:
+        ds['time'].attrs.update(attrs)
+    ds.attrs['merged_capture_blocks'] = []
+    ds.attrs['dtype_promotions'] = []
+    ds.to_zarr(path, group=GROUP, compute=False, encoding=encoding(ds, chunks),
+               write_empty_chunks=False)
+    create_marginals(path, coords)
+
+
+def merged_capture_blocks(path):
+    """
+    Get the capture block IDs already merged into a store.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+
+    Returns:
+    --------
+    output : set
+        merged capture block IDs, empty if the store does not exist
+    """
+    if not os.path.exists(path):
+        return set()
+    group = zarr.open_group(path, path=GROUP, mode='r')
+    return set(group.attrs.get('merged_capture_blocks', []))
+
+
+def merged_tiles(path, cbids):
+    """
+    Get the frequency tiles of an interrupted merge of `cbids` that are already in a store.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+    cbids : list
+        capture block IDs of the merge
+
+    Returns:
+    --------
+    output : set
+        (start, stop) channels of the merged tiles, empty if `cbids` are not pending
+    """
+    if not os.path.exists(path):
+        return set()
+    group = zarr.open_group(path, path=GROUP, mode='r', use_consolidated=False)
+    progress = group.attrs.get('merge_progress') or {}
+    if sorted(group.attrs.get('pending_capture_blocks') or []) != sorted(cbids) or \
+            sorted(progress.get('capture_blocks') or []) != sorted(cbids):
+        return set()
+    return set(tuple(tile) for tile in progress.get('tiles', []))
+
+
+def length_classes(lengths, edges):
+    """Get the length class of every baseline, -1 where its length is not known."""
+    classes = kathp.get_length_idx(np.nan_to_num(lengths), edges)
+    return np.where(np.isnan(lengths), -1, classes)
+
+
+def bin_lengths(data, axis, lengths, edges):
+    """
+    Sum the baseline axis of marginal sums into baseline length classes.
+
+    Parameters:
+    -----------
+    data : numpy array
+        sums with a raw baseline axis
+    axis : int
+        position of the baseline axis
+    lengths : numpy array
+        length of every baseline in metres, NaN where it is not known
+    edges : numpy array
+        lower edges of the length classes in metres
+
+    Returns:
+    --------
+    output : numpy array
+        sums with a length class axis in place of the baseline axis
+
+    Raises:
+    -------
+    ValueError
+        if baselines of unknown length have counts
+    """
+    classes = length_classes(lengths, edges)
+    known = classes >= 0
+    if np.take(data, np.flatnonzero(~known), axis=axis).any():
+        raise ValueError('Counts of {} baselines of unknown length cannot be binned by '
+                         'length'.format(np.count_nonzero(~known)))
+    onehot = np.zeros((len(classes), len(edges)), dtype=data.dtype)
+    onehot[np.flatnonzero(known), classes[known]] = 1
+    return np.moveaxis(np.tensordot(data, onehot, axes=([axis], [0])), -1, axis)
+
+
+def check_coords(path, coords, attrs=None):
+    """
+    Check that the coordinates of a store match those of a merge.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+    coords : dict
+        coordinates of the merge by dimension, as arrays or as DataArrays
+        whose attributes are compared too
+    attrs : dict
+        attributes of the time coordinate of the merge. default: None
+
+    Raises:
+    -------
+    ValueError
+        if a coordinate or one of its attributes differs from the store
+    """
+    group = zarr.open_group(path, path=GROUP, mode='r', use_consolidated=False)
+    for dim, coord in coords.items():
+        values = np.asarray(coord)
+        stored = group[dim][...]
+        if stored.shape != values.shape or not np.allclose(stored, values, rtol=1e-9, atol=0):
+            raise ValueError('Store {} has a {} coordinate of {} values from {} to {}, not {} '
+                             'values from {} to {}'.format(path, dim, len(stored), stored[0],
+                                                           stored[-1], len(values), values[0],
+                                                           values[-1]))
+        expected = dict(getattr(coord, 'attrs', {}))
+        if dim == 'time' and attrs:
+            expected.update(attrs)
+        for key, value in expected.items():
+            if group[dim].attrs.get(key) != value:
+                raise ValueError('Store {} has a {} coordinate with {} {!r}, not {!r}'.format(
+                    path, dim, key, group[dim].attrs.get(key), value))
+
+
+def baseline_binning(path):
+    """Get the binning of the baseline axis of a store, 'raw' for stores without it."""
+    group = zarr.open_group(path, path=GROUP, mode='r')
+    return group['baseline'].attrs.get('binning', 'raw')
+
+
+def promote_store(path, dtype, reason=''):
+    """
+    Rewrite the master and counter arrays of a store in a wider dtype.
+
+    Only the chunks holding counts are copied, the others stay absent. Both
+    arrays are copied under new names before either old array is replaced,
+    and the state of the promotion is kept in the 'promotion' attribute of
+    the group, so that finish_promotion completes or undoes a promotion that
+    was interrupted without losing an array. Arrays are replaced by renaming
+    their directories, so only stores in a local directory can be promoted.
+
+    Parameters:
+    -----------
+    path : str
+        path of an existing zarr store
+    dtype : numpy dtype
+        new dtype of the arrays
+    reason : str
+        what triggered the promotion, kept in the group attributes. default: ''
+
+    Raises:
+    -------
+    ValueError
+        if the store is not in a local directory
+    """
+    if not os.path.isdir(os.path.join(path, GROUP)):
+        raise ValueError('{} is not a store in a local directory, which a promotion to {} '
+                         'needs'.format(path, np.dtype(dtype)))
+    group = zarr.open_group(path, path=GROUP, mode='r+', use_consolidated=False)
+    dtype = np.dtype(dtype)
+    old_dtype = group['master'].dtype
+    logging.info('Promoting {} from {} to {} ({})'.format(path, old_dtype, dtype, reason))
+    promotion = {'from': np.dtype(old_dtype).name, 'to': dtype.name, 'reason': reason,
+                 'copied': False}
+    group.attrs['promotion'] = promotion
+    for name in ('master', 'counter'):
+        old = group[name]
+        new = group.create_array(name + PROMOTED, shape=old.shape, chunks=old.chunks,
+                                 dtype=dtype, fill_value=0, compressors=old.compressors,
+                                 dimension_names=old.metadata.dimension_names,
+                                 attributes=old.attrs.asdict(), overwrite=True)
+        for region in chunk_regions(old.shape, old.chunks):
+            block = old[region]
+            if block.any():
+                new[region] = block
+    group.attrs['promotion'] = dict(promotion, copied=True)
+    finish_promotion(path)
+
+
+def finish_promotion(path):
+    """
+    Complete or undo an interrupted promotion of a store, see promote_store.
+
+    A promotion whose copies are complete replaces the arrays that are left
+    with their copies, one that was interrupted while copying drops the
+    copies and leaves the store in its old dtype.
+
+    Parameters:
+    -----------
+    path : str
+        path of an existing zarr store
+
+    Returns:
+    --------
+    output : bool
+        True if there was a promotion to finish
+    """
+    group = zarr.open_group(path, path=GROUP, mode='r+', use_consolidated=False)
+    promotion = group.attrs.get('promotion')
+    if not promotion:
+        return False
+    directory = os.path.join(path, GROUP)
+    for name in ('master', 'counter'):
+        current = os.path.join(directory, name)
+        new = os.path.join(directory, name + PROMOTED)
+        old = os.path.join(directory, name + REPLACED)
+        # zarr cannot rename arrays, but the store is a plain directory. Every
+        # array is in one of the three directories at any time
+        if promotion['copied'] and os.path.isdir(new):
+            if os.path.isdir(current):
+                os.rename(current, old)
+            os.rename(new, current)
+        shutil.rmtree(old if promotion['copied'] else new, ignore_errors=True)
+    if promotion['copied']:
+        promotions = list(group.attrs.get('dtype_promotions', []))
+        promotions.append({key: promotion[key] for key in ('from', 'to', 'reason')})
+        group.attrs['dtype_promotions'] = promotions
+    else:
+        logging.warning('Undid the interrupted promotion of {} to {}'.format(path,
+                                                                           promotion['to']))
+    del group.attrs['promotion']
+    zarr.consolidate_metadata(path)
+    return True
+
+
+def finish_merge(path):
+    """
+    Finish an interrupted merge with the accumulator saved when it started.
+
+    The accumulator of a merge is saved in the store before its first write,
+    see save_merging, so the merge is finished with the same cells and steps
+    however the observations are grouped or ordered when they are processed
+    again.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+
+    Returns:
+    --------
+    output : tuple or None
+        capture block IDs and first channel of the finished merge, None if
+        there was no merge to finish
+    """
+    if not os.path.exists(path):
+        return None
+    finish_promotion(path)
+    group = zarr.open_group(path, path=GROUP, mode='r', use_consolidated=False)
+    pending = list(group.attrs.get('pending_capture_blocks') or [])
+    saved = load_merging(path) if pending else None
+    finished = None
+    if saved is not None and sorted(saved[1]) == sorted(pending):
+        acc, cbids, offset = saved
+        logging.info('Finishing the interrupted merge of {} into {}'.format(', '.join(cbids),
+                                                                           path))
+        if _merge_into_store(path, acc, cbids, offset):
+            finished = cbids, offset
+    drop_merging(path)
+    return finished
+
+
+def merge_into_store(path, acc, cbids, offset=0):
+    """
+    Add the blocks of an accumulator to a master store.
+
+    An accumulator of a frequency tile covers the channels from `offset` on.
+    The tiles of an observation are merged in order: the first one checks
+    the counter bound and marks the capture blocks as pending, and the one
+    that reaches the last channel marks them as merged.
+
+    The progress of the merge is kept in the group attributes and its writes
+    go through a MergeJournal, so merging the same accumulator again after
+    a crash resumes the merge instead of adding its counts twice. The
+    channel ranges of the tiles merged so far are kept too, and a tile that
+    is merged again is skipped. An interrupted merge is finished first from
+    its saved accumulator, see finish_merge, as is an interrupted dtype
+    promotion.
+
+    Parameters:
+    -----------
+    path : str
+        path of an existing zarr store
+    acc : SparseAccumulator
+        accumulator with the same layout as the store
+    cbids : list
+        capture block IDs of the observations in the accumulator
+    offset : int
+        first channel of the store covered by the accumulator. default: 0
+
+    Returns:
+    --------
+    output : bool
+        False if all the capture blocks, or this tile of them, were merged
+        before and nothing was done
+    """
+    finished = finish_merge(path)
+    if finished is not None and sorted(finished[0]) == sorted(cbids) and finished[1] == offset:
+        return True
+    return _merge_into_store(path, acc, cbids, offset)
+
+
+def _merge_into_store(path, acc, cbids, offset=0):
+    """Add the blocks of an accumulator to a master store, see merge_into_store."""
+    finish_promotion(path)
+    group = zarr.open_group(path, path=GROUP, mode='r+')
+    merged = list(group.attrs.get('merged_capture_blocks', []))
+    done = set(cbids).intersection(merged)
+    if done == set(cbids):
+        logging.info('{} already merged into {}'.format(', '.join(sorted(done)), path))
+        return False
+    if done:
+        raise ValueError('Capture blocks {} are already merged into {}'.format(
+            ', '.join(sorted(done)), path))
+    master, counter = group['master'], group['counter']
+    expected = (acc.cell_shape[0], master.shape[1], acc.nbl) + acc.cell_shape[1:]
+    if master.shape != expected or offset + acc.nfreq > master.shape[1]:
+        raise ValueError('Store shape {} does not match the accumulator shape {} at channel '
+                         '{}'.format(master.shape, (acc.cell_shape[0], acc.nfreq, acc.nbl) +
+                                     acc.cell_shape[1:], offset))
+    first = offset == 0
+    last = offset + acc.nfreq == master.shape[1]
+    pending = list(group.attrs.get('pending_capture_blocks') or [])
+    progress = dict(group.attrs.get('merge_progress') or {})
+    if pending and sorted(pending) != sorted(cbids):
+        raise ValueError('{} holds an interrupted merge of {}, which has to be run again '
+                         'first'.format(path, ', '.join(pending)))
+    # The order of the capture blocks of a resumed merge is the recorded one
+    cbids = pending or list(cbids)
+    tiles = [tuple(tile) for tile in progress.get('tiles', [])] if pending else []
+    tile = (offset, offset + acc.nfreq)
+    if tile in tiles:
+        logging.info('Channels {} to {} of {} are already merged into {}'.format(
+            tile[0], tile[1], ', '.join(cbids), path))
+        return False
+    if any(start < tile[1] and tile[0] < stop for start, stop in tiles):
+        raise ValueError('Channels {} to {} overlap the tiles {} of the interrupted merge of {} '
+                         'in {}, which has to be run again with the same tiles'.format(
+                             tile[0], tile[1], tiles, ', '.join(cbids), path))
+    if pending and (sorted(progress.get('capture_blocks') or []) != sorted(cbids) or
+                    progress.get('offset') not in (None, offset) or
+                    progress.get('cells', len(acc.cells)) != len(acc.cells)):
+        raise ValueError('{} holds a partial merge of {} that cannot be resumed'.format(
+            path, ', '.join(pending)))
+    if progress.get('offset') == offset:
+        logging.info('Resuming the merge of {} into {} after step {}'.format(
+            ', '.join(cbids), path, progress['step']))
+    else:
+        progress = {'capture_blocks': list(cbids), 'offset': offset, 'cells': len(acc.cells),
+                    'step': -1, 'marginals': current_marginals(path, merged),
+                    'tiles': [list(t) for t in tiles]}
+        save_merging(path, acc, cbids, offset)
+    group.attrs.update({'pending_capture_blocks': list(cbids), 'merge_progress': progress})
+    # Readers of the consolidated metadata see the merge as pending, even if it crashes
+    zarr.consolidate_metadata(path)
+    # `counter_bound` is an upper bound of all the counts in the store. Only when
+    # it could overflow are the touched counters read to find the exact maximum.
+    # The tiles of an observation share their counts, so only the first adds them.
+    dtype = np.promote_types(master.dtype, acc.dtype)
+    bound = group.attrs.get('counter_bound', 0) + (int(acc.bounds.max(initial=0)) if first else 0)
+    if bound > np.iinfo(dtype).max:
+        exact = 0
+        for (t, e, a), blk in acc.cells.items():
+            exact = max(exact, int(counter[t, :, :, e, a].max()) + int(acc.counter[blk].max()))
+        bound = max(group.attrs.get('counter_bound', 0), exact)
+        dtype = kathp.promote_dtype(dtype, bound)
+    if dtype != master.dtype:
+        promote_store(path, dtype, 'merge of {}'.format(', '.join(cbids)))
+        group = zarr.open_group(path, path=GROUP, mode='r+')
+        master, counter = group['master'], group['counter']
+    if 'baseline_length' in group:
+        # Idempotent, so it needs no journal
+        lengths = group['baseline_length']
+        stored = lengths[...]
+        moved = np.abs(stored - acc.lengths) > 1
+        if moved.any():
+            logging.warning('{} baselines of {} are more than 1 m longer or shorter than in {}, '
+                            'which rebuilt length marginals do not reflect'.format(
+                                np.count_nonzero(moved), ', '.join(cbids), path))
+        lengths[...] = np.fmax(stored, acc.lengths)
+    journal = MergeJournal(path, group, progress)
+    add_cells(master, acc.cells, acc.master, offset, journal)
+    add_cells(counter, acc.cells, acc.counter, offset, journal)
+    update_marginals(path, acc, merged, cbids, offset=offset, last=last, journal=journal)
+    journal.close()
+    promotions = list(group.attrs.get('dtype_promotions', []))
+    promotions.extend(dict(p, capture_blocks=list(cbids)) for p in acc.promotions)
+    # The next tile of the observation starts from a fresh progress, and a
+    # merge that is run again after a crash skips the tiles merged so far
+    attrs = {'counter_bound': bound, 'dtype_promotions': promotions,
+             'merge_progress': {'capture_blocks': list(cbids), 'offset': None,
+                                'tiles': [list(t) for t in tiles + [tile]]}}
+    if last:
+        attrs.update({'merged_capture_blocks': merged + list(cbids),
+                      'pending_capture_blocks': [], 'merge_progress': {}})
+    group.attrs.update(attrs)
+    drop_merging(path)
+    zarr.consolidate_metadata(path)
+    return True
+
+
+# Marginal sums kept next to the cube, by the dimensions they keep. The
+# LENGTH marginals sum the baselines of a raw baseline axis by length class
+MARGINALS = (('time',), ('frequency',), ('baseline',), ('elevation',), ('azimuth',),
+             ('time', 'frequency'), ('frequency', 'elevation'), ('elevation', 'azimuth'),
+             ('frequency', 'elevation', 'azimuth'), (LENGTH,), ('frequency', LENGTH))
+MARGINAL_GROUP = 'marginals'
+# Frequency decimations of the marginals that keep frequency, 4k -> 1k -> 256 channels
+ROLLUP_FACTORS = (4, 16)
+
+
+def marginal_group(dims, factor=1):
+    """Get the zarr group of the marginal that keeps `dims`, decimated by `factor`."""
+    name = '_'.join(dims)
+    if factor > 1:
+        name += '_x{}'.format(factor)
+    return '{}/{}'.format(MARGINAL_GROUP, name)
+
+
+def rollups(nfreq, marginals=MARGINALS):
+    """
+    Get every marginal of a store with its frequency decimations.
+
+    Parameters:
+    -----------
+    nfreq : int
+        number of frequency channels of the store
+    marginals : tuple
+        dimensions kept by every marginal. default: MARGINALS
+
+    Returns:
+    --------
+    output : list
+        (dims, factor) pairs, with factor 1 for the full resolution
+    """
+    levels = []
+    for dims in marginals:
+        levels.append((tuple(dims), 1))
+        if 'frequency' in dims:
+            levels.extend((tuple(dims), factor) for factor in ROLLUP_FACTORS
+                          if factor < nfreq and nfreq % factor == 0)
+    return levels
+
+
+def baseline_dims(dims):
+    """Get the dimensions of the sums that a marginal over `dims` is binned from."""
+    return tuple('baseline' if dim == LENGTH else dim for dim in dims)
+
+
+def decimate(data, axis, factor):
+    """Sum groups of `factor` neighbouring channels along the frequency axis."""
+    shape = data.shape[:axis] + (data.shape[axis] // factor, factor) + data.shape[axis + 1:]
+    return data.reshape(shape).sum(axis=axis + 1)
+
+
+def _write_marginal(path, dims, factor, ds, merged):
+    """Write a marginal, decimating its frequency axis, with the capture blocks it covers."""
+    if factor > 1:
+        # Channel sums with the mean frequency of every group of channels
+        ds = ds.coarsen(frequency=factor).sum()
+    ds.attrs['merged_capture_blocks'] = list(merged)
+    ds.attrs['pending_capture_blocks'] = []
+    ds.to_zarr(path, group=marginal_group(dims, factor), mode='w')
+
+
+def create_marginals(path, coords, marginals=MARGINALS):
+    """
+    Write empty marginals for a new store, to be updated by every merge.
+
+    Parameters:
+    -----------
+    path : str
+        path of the zarr store
+    coords : dict
+        coordinates of the time, frequency, baseline, elevation and azimuth
+        axes, and of the LENGTH classes if the store has them
+    marginals : tuple
+        dimensions kept by every marginal. default: MARGINALS
+    """
+    import xarray as xr
+    for dims, factor in rollups(len(coords['frequency']), marginals):
+        if not set(dims).issubset(coords):
+            continue
+        zeros = np.zeros([len(coords[dim]) for dim in dims], dtype=np.uint64)
+        ds = xr.Dataset({'master': (dims, zeros), 'counter': (dims, zeros)},
+                        {dim: coords[dim] for dim in dims})
+        _write_marginal(path, dims, factor, ds, [])
+    zarr.consolidate_metadata(path)
+
+
+def build_marginals(path, marginals=MARGINALS):
+    """
+    Compute the marginal sums of a store in one streaming pass over its chunks.
+
+    Every marginal holds the master and counter arrays summed as uint64 over
+    all the dimensions it does not keep, in its own group of the store, and
+    the marginals that keep frequency are also written decimated by every
+    factor of ROLLUP_FACTORS. It records the capture blocks it covers, so
+    that a marginal left behind by later merges is not used by queries.
+    Merges keep the marginals up to date, so this is only needed for stores
+    without marginals or whose marginals are stale. The LENGTH marginals
+    are only built for stores with baseline lengths.
+
+    Parameters:
+    -----------
+    path : str
+        path of an existing zarr store
+    marginals : tuple
+        dimensions kept by every marginal. default: MARGINALS
+    """
+    import dask
+    import xarray as xr
+    ds = xr.open_zarr(path, group=GROUP)
+    if 'baseline_length' not in ds.coords:
+        marginals = tuple(dims for dims in marginals if LENGTH not in dims)
+    cube = ds[['master', 'counter']].reset_coords(drop=True).astype(np.uint64)
+    bases = list(dict.fromkeys(baseline_dims(dims) for dims in marginals))
+    sums = [cube.sum([dim for dim in DIMS if dim not in dims]) for dims in bases]
+    # Computing the marginals together reads every chunk of the cube only once
+    sums = dict(zip(bases, dask.compute(*sums)))
+    merged = ds.attrs.get('merged_capture_blocks', [])
+    for dims, factor in rollups(ds.sizes['frequency'], marginals):
+        total = sums[baseline_dims(dims)]
+        if LENGTH in dims:
+            lengths = ds['baseline_length']
+            edges = np.asarray(lengths.attrs['edges'])
+            axis = total['master'].dims.index('baseline')
+            total = xr.Dataset({name: (dims, bin_lengths(total[name].values, axis,
+                                                         lengths.values, edges))
+                                for name in ('master', 'counter')},
+                               {dim: total[dim] if dim != LENGTH else edges for dim in dims})
+        _write_marginal(path, dims, factor, total, merged)
+    zarr.consolidate_metadata(path)
+    logging.info('Marginals over {} have been written to {}'.format(
+        ', '.join('_'.join(dims) for dims in marginals), path))
+
+
+def marginal_sums(acc, dims, cache=None, edges=None):
+    """
+    Sum the blocks of an accumulator over all the dimensions but `dims`.
+
+    Parameters:
+    -----------
+    acc : SparseAccumulator
+        accumulator with the layout of a store
+    dims : tuple
+        dimensions kept, in the order of DIMS, LENGTH in place of baseline
+        to sum the baselines by length class
+    cache : dict
+        block sums shared between calls for the same accumulator. default: None
+    edges : numpy array
+        lower edges of the LENGTH classes in metres. default: None
+
+    Returns:
+    --------
+    output : tuple
+        master and counter sums as uint64 arrays over `dims`
+    """
+    if LENGTH in dims:
+        base = baseline_dims(dims)
+        return tuple(bin_lengths(total, base.index('baseline'), acc.lengths, edges)
+                     for total in marginal_sums(acc, base, cache))
+    nblocks = len(acc.cells)
+    cells = np.array(list(acc.cells), dtype=np.intp).reshape(nblocks, 3)
+    blocks = np.fromiter(acc.cells.values(), dtype=np.intp, count=nblocks)
+    cell_dims = [dim for dim in ('time', 'elevation', 'azimuth') if dim in dims]
+    block_dims = [dim for dim in ('frequency', 'baseline') if dim in dims]
+    shape = {'time': acc.cell_shape[0], 'frequency': acc.nfreq, 'baseline': acc.nbl,
+             'elevation': acc.cell_shape[1], 'azimuth': acc.cell_shape[2]}
+    index = tuple(cells[:, ('time', 'elevation', 'azimuth').index(dim)] for dim in cell_dims)
+    axes = tuple(n + 1 for n, dim in enumerate(('frequency', 'baseline'))
+                 if dim not in block_dims)
+    cache = {} if cache is None else cache
+    # Sum each block first, then scatter the block sums onto their cells
+    sums = []
+    for name in ('master', 'counter'):
+        if (name, axes) not in cache:
+            data = getattr(acc, name)[:nblocks]
+            cache[name, axes] = data.sum(axis=axes, dtype=np.uint64)[blocks]
+        per_block = cache[name, axes]
+        total = np.zeros([shape[dim] for dim in cell_dims + block_dims], dtype=np.uint64)
+        if cell_dims:
+            np.add.at(total, index, per_block)
+        else:
+            total += per_block.sum(axis=0, dtype=np.uint64)
+        order = [(cell_dims + block_dims).index(dim) for dim in dims]
+        sums.append(total.transpose(order))
+    return tuple(sums)
+
+
+def current_marginals(path, merged, marginals=MARGINALS):
+    """
+    Get the marginal groups of a store that cover exactly the capture blocks
+    `merged`, which are the ones that merges keep up to date.
+    """
+    root = zarr.open_group(path, mode='r', use_consolidated=False)
+    names = []
+    for dims, factor in rollups(root[GROUP]['master'].shape[1], marginals):
+        name = marginal_group(dims, factor)
+        if name not in root:
+            continue
+        if list(root[name].attrs.get('merged_capture_blocks', [])) != list(merged):
+            logging.warning('Marginal {} of {} is stale, run build_marginals'.format(name, path))
+            continue
+        names.append(name)
+    return names
+
+
+def update_marginals(path, acc, merged, cbids, marginals=MARGINALS, offset=0, last=True,
+                     journal=None):
+    """
+    Add the blocks of an accumulator to the marginals of a store.
+
+    Only the marginals that cover exactly the capture blocks merged so far
+    are updated, so stale or missing marginals stay out of date until
+    build_marginals is run. The accumulator of a frequency tile is added
+    from channel `offset` on, and the capture blocks are marked as merged
+    by the last tile.
+
+    Parameters:
+    -----------
+    path : str
+        path of an existing zarr store
+    acc : SparseAccumulator
+        accumulator with the same layout as the store
+    merged : list
+        capture block IDs merged into the store before `acc`
+    cbids : list
+        capture block IDs of the observations in the accumulator
+    marginals : tuple
+        dimensions kept by every marginal. default: MARGINALS
+    offset : int
+        first channel of the store covered by the accumulator. default: 0
+    last : bool
+        whether the accumulator reaches the last channel of the store. default: True
+    journal : MergeJournal
+        journal of the merge, which also fixes the marginals that are
+        updated. default: None
+    """
+    names = journal.progress.get('marginals') if journal is not None else None
+    if names is None:
+        names = current_marginals(path, merged, marginals)
+    # The consolidated metadata of the root is only refreshed after the merge
+    root = zarr.open_group(path, mode='r+', use_consolidated=False)
+    sums = {}
+    cache = {}
+    for dims, factor in rollups(root[GROUP]['master'].shape[1], marginals):
+        name = marginal_group(dims, factor)
+        if name not in names:
+            continue
+        group = root[name]
+        if dims not in sums:
+            edges = None
+            if LENGTH in dims:
+                edges = np.asarray(root[GROUP]['baseline_length'].attrs['edges'])
+            sums[dims] = marginal_sums(acc, dims, cache, edges)
+        group.attrs['pending_capture_blocks'] = list(cbids)
+        index = [slice(None)] * len(dims)
+        if 'frequency' in dims:
+            axis = dims.index('frequency')
+            if offset % factor or acc.nfreq % factor:
+                raise ValueError('A tile of {} channels at channel {} cannot be decimated by '
+                                 '{}'.format(acc.nfreq, offset, factor))
+            index[axis] = slice(offset // factor, (offset + acc.nfreq) // factor)
+        for array, total in zip((group['master'], group['counter']), sums[dims]):
+            if factor > 1:
+                total = decimate(total, axis, factor)
+            _write(array, tuple(index), lambda: array[tuple(index)] + total, journal)
+    # Only marked once all the marginals are written, so that a resumed merge
+    # goes through the same steps
+    if last:
+        for name in names:
+            root[name].attrs.update({'merged_capture_blocks': list(merged) + list(cbids),
+                                     'pending_capture_blocks': []})
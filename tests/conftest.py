@@ -0,0 +1,31 @@
+"""
+Shared fixtures of the tests, which run on synthetic observations from
+benchmarks/fake_katdal and need katdal, numba, dask, xarray and zarr.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+# Small observations: 24 dumps of 256 channels and 4 antennas, 6 baselines
+OPTIONS = {'ndumps': 24, 'nchan': 256, 'nant': 4, 'time_chunk': 8, 'chan_chunk': 64}
+PATHS = ['archive/1700000001_sdp_l0.full.rdb', 'archive/1700000002_sdp_l0.full.rdb']
+
+
+@pytest.fixture
+def config():
+    """Processing configuration of the synthetic observations."""
+    return {'corrprod': 'cross', 'scan': 'track', 'flag_type': 'cal_rfi', 'pol_to_use': 'HH',
+            'correlator_mode': '4k', 'dump_period': '8', 'time_frame': 'SAST',
+            'time_bin_minutes': '60', 'nant': str(OPTIONS['nant'])}
+
+
+@pytest.fixture
+def archive():
+    """Make katdal.open return synthetic observations."""
+    fake_katdal = pytest.importorskip('fake_katdal')
+    with fake_katdal.fake_archive(**OPTIONS):
+        yield PATHS
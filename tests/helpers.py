@@ -0,0 +1,89 @@
+"""Store access, comparisons and simulated crashes shared by the tests."""
+import numpy as np
+import zarr
+
+import kathprfi_pipeline as kp
+import kathprfi_store as kstore
+
+
+def assert_same_accumulator(got, expected):
+    assert got.cells == expected.cells
+    for blk in expected.cells.values():
+        np.testing.assert_array_equal(got.master[blk], expected.master[blk])
+        np.testing.assert_array_equal(got.counter[blk], expected.counter[blk])
+
+
+def read_cube(path):
+    """Master and counter arrays and the group attributes of a store."""
+    group = zarr.open_group(path, path=kstore.GROUP, mode='r', use_consolidated=False)
+    return group['master'][...], group['counter'][...], group.attrs.asdict()
+
+
+def read_marginals(path):
+    """Master and counter arrays of every marginal of a store."""
+    root = zarr.open_group(path, mode='r', use_consolidated=False)
+    marginals = {}
+    for dims, factor in kstore.rollups(root[kstore.GROUP]['master'].shape[1]):
+        if kstore.marginal_group(dims, factor) not in root:
+            continue
+        group = root[kstore.marginal_group(dims, factor)]
+        marginals[dims, factor] = (group['master'][...], group['counter'][...])
+    return marginals
+
+
+def merge_all(store, paths, config, time_chunk=8):
+    for path in paths:
+        acc, freqs = kp.process_observation(path, config, time_chunk=time_chunk)
+        assert kp.merge_observation(store, acc, freqs, [kstore.capture_block_id(path)], config)
+
+
+class Crash(Exception):
+    """Simulated crash of a merge."""
+
+
+class BrokenArray(object):
+    """Array whose writes crash, as if the process died while writing it."""
+
+    def __setitem__(self, selection, values):
+        raise Crash()
+
+
+def crash_at(monkeypatch, limit, journaled):
+    """Make the merge crash at step `limit`, before or after its values are journaled."""
+    write = kstore.MergeJournal.write
+
+    def crashing(self, array, selection, compute):
+        if self.step + 1 == limit:
+            if journaled:
+                write(self, BrokenArray(), selection, compute)
+            raise Crash()
+        write(self, array, selection, compute)
+
+    monkeypatch.setattr(kstore.MergeJournal, 'write', crashing)
+
+
+def count_steps(monkeypatch, store, acc, freqs, cbids, config):
+    """Merge an accumulator and count the steps of the merge."""
+    steps = []
+    write = kstore.MergeJournal.write
+
+    def counting(self, array, selection, compute):
+        steps.append(self.step)
+        write(self, array, selection, compute)
+
+    monkeypatch.setattr(kstore.MergeJournal, 'write', counting)
+    kp.merge_observation(store, acc, freqs, cbids, config)
+    monkeypatch.undo()
+    return len(steps)
+
+
+def assert_same_store(got, expected):
+    for got_data, data in zip(read_cube(got), read_cube(expected)):
+        if isinstance(data, dict):
+            assert got_data == data
+        else:
+            np.testing.assert_array_equal(got_data, data)
+    got_marginals = read_marginals(got)
+    for key, (master, counter) in read_marginals(expected).items():
+        np.testing.assert_array_equal(got_marginals[key][0], master)
+        np.testing.assert_array_equal(got_marginals[key][1], counter)
@@ -0,0 +1,92 @@
+"""Interrupted merges into the master store, resumed through their journal."""
+import pytest
+
+pytest.importorskip('xarray')
+zarr = pytest.importorskip('zarr')
+
+import kathprfi_pipeline as kp  # noqa: E402
+import kathprfi_store as kstore  # noqa: E402
+from helpers import (Crash, assert_same_store, count_steps, crash_at, merge_all,  # noqa: E402
+                     read_cube)
+
+
+@pytest.mark.parametrize('where', [0, 0.5, 1])
+@pytest.mark.parametrize('journaled', [False, True])
+def test_interrupted_merge_resumes(archive, config, tmp_path, monkeypatch, where, journaled):
+    expected = str(tmp_path / 'expected.zarr')
+    merge_all(expected, archive[:1], config)
+    acc, freqs = kp.process_observation(archive[1], config, time_chunk=8)
+    cbids = [kstore.capture_block_id(archive[1])]
+    nsteps = count_steps(monkeypatch, expected, acc, freqs, cbids, config)
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive[:1], config)
+    crash_at(monkeypatch, int(where * (nsteps - 1)), journaled)
+    with pytest.raises(Crash):
+        kp.merge_observation(store, acc, freqs, cbids, config)
+    monkeypatch.undo()
+    assert read_cube(store)[2]['pending_capture_blocks'] == cbids
+    # The merge is finished with the accumulator saved when it started
+    empty = kp.new_accumulator(config, nfreq=acc.nfreq)
+    assert kp.merge_observation(store, empty, freqs, cbids, config)
+    assert_same_store(store, expected)
+    root = zarr.open_group(store, mode='r', use_consolidated=False)
+    assert kstore.JOURNAL not in root and kstore.MERGING not in root
+
+
+def test_interrupted_merge_resumes_in_other_order(archive, config, tmp_path, monkeypatch):
+    def accumulate(paths):
+        accs = [kp.process_observation(path, config, time_chunk=8) for path in paths]
+        return accs[0][0].merge(accs[1][0]), accs[0][1], [kstore.capture_block_id(path)
+                                                           for path in paths]
+    expected = str(tmp_path / 'expected.zarr')
+    acc, freqs, cbids = accumulate(archive)
+    nsteps = count_steps(monkeypatch, expected, acc, freqs, cbids, config)
+    store = str(tmp_path / 'master.zarr')
+    crash_at(monkeypatch, nsteps // 2, True)
+    with pytest.raises(Crash):
+        kp.merge_observation(store, acc, freqs, cbids, config)
+    monkeypatch.undo()
+    # Partials reduced in another order give the cells in another order
+    acc, freqs, cbids = accumulate(archive[::-1])
+    assert kp.merge_observation(store, acc, freqs, cbids, config)
+    assert_same_store(store, expected)
+    assert kstore.merged_capture_blocks(store) == set(cbids)
+
+
+def test_merge_resumes_before_journaled_step_is_recorded(archive, config, tmp_path,
+                                                         monkeypatch):
+    expected = str(tmp_path / 'expected.zarr')
+    merge_all(expected, archive[:1], config)
+    acc, freqs = kp.process_observation(archive[1], config, time_chunk=8)
+    cbids = [kstore.capture_block_id(archive[1])]
+    nsteps = count_steps(monkeypatch, expected, acc, freqs, cbids, config)
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive[:1], config)
+    save = kstore.MergeJournal.save
+
+    def crashing(self, step):
+        # The values of the next step replace the journal, but its number is not recorded
+        if step == nsteps // 2:
+            raise Crash()
+        save(self, step)
+
+    monkeypatch.setattr(kstore.MergeJournal, 'save', crashing)
+    with pytest.raises(Crash):
+        kp.merge_observation(store, acc, freqs, cbids, config)
+    monkeypatch.undo()
+    assert read_cube(store)[2]['merge_progress']['step'] == nsteps // 2 - 1
+    assert kp.merge_observation(store, acc, freqs, cbids, config)
+    assert_same_store(store, expected)
+
+
+def test_partial_merge_without_progress_is_refused(archive, config, tmp_path):
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive[:1], config)
+    acc, freqs = kp.process_observation(archive[1], config, time_chunk=8)
+    cbids = [kstore.capture_block_id(archive[1])]
+    # A merge that crashed without recording its progress, as by older versions
+    group = zarr.open_group(store, path=kstore.GROUP, mode='r+')
+    kstore.add_cells(group['counter'], acc.cells, acc.counter)
+    group.attrs['pending_capture_blocks'] = cbids
+    with pytest.raises(ValueError, match='cannot be resumed'):
+        kp.merge_observation(store, acc, freqs, cbids, config)
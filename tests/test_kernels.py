@@ -0,0 +1,77 @@
+"""The update kernels, the sparse accumulator and the baseline indices."""
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+import kathprfi_single_file as kathp  # noqa: E402
+
+
+def random_update(seed=1, ndumps=16, nchan=64, nprod=10, nbl=6):
+    """Indices and flags of one update, with skipped dumps and repeated baselines."""
+    rng = np.random.default_rng(seed)
+    Time_idx = rng.integers(0, 3, ndumps).astype(np.int32)
+    El_idx = rng.integers(-1, 2, ndumps).astype(np.int32)
+    Az_idx = rng.integers(0, 2, ndumps).astype(np.int32)
+    Bl_idx = rng.integers(0, nbl, nprod).astype(np.int32)
+    flags = rng.random((ndumps, nchan, nprod)) < 0.2
+    return Time_idx, Bl_idx, El_idx, Az_idx, flags
+
+
+def blocks(acc):
+    """Master and counter blocks of an accumulator by cell."""
+    return {cell: (acc.master[blk], acc.counter[blk]) for cell, blk in acc.cells.items()}
+
+
+@pytest.mark.parametrize('packed', [False, True])
+@pytest.mark.parametrize('nfreq', [64, 16])
+def test_grouped_matches_scatter(packed, nfreq):
+    Time_idx, Bl_idx, El_idx, Az_idx, flags = random_update()
+    if packed:
+        flags = np.packbits(flags, axis=1)
+    results = []
+    for engine in sorted(kathp.ENGINES):
+        acc = kathp.SparseAccumulator(nfreq=nfreq, nbl=6, cell_shape=(3, 2, 2), engine=engine)
+        acc.update(Time_idx, Bl_idx, El_idx, Az_idx, flags, packed=packed)
+        results.append(blocks(acc))
+    first = results[0]
+    for other in results[1:]:
+        assert first.keys() == other.keys()
+        for cell in first:
+            np.testing.assert_array_equal(first[cell][0], other[cell][0])
+            np.testing.assert_array_equal(first[cell][1], other[cell][1])
+
+
+def test_update_matches_dense_sum():
+    Time_idx, Bl_idx, El_idx, Az_idx, flags = random_update()
+    acc = kathp.SparseAccumulator(nfreq=64, nbl=6, cell_shape=(3, 2, 2))
+    acc.update(Time_idx, Bl_idx, El_idx, Az_idx, flags)
+    master = np.zeros((3, 64, 6, 2, 2), dtype=int)
+    counter = np.zeros_like(master)
+    for j in np.flatnonzero(El_idx >= 0):
+        for i, b in enumerate(Bl_idx):
+            master[Time_idx[j], :, b, El_idx[j], Az_idx[j]] += flags[j, :, i]
+            counter[Time_idx[j], :, b, El_idx[j], Az_idx[j]] += 1
+    dense_master, dense_counter = acc.to_dense()
+    np.testing.assert_array_equal(dense_master, master)
+    np.testing.assert_array_equal(dense_counter, counter)
+
+
+def test_merge_matches_single_update():
+    Time_idx, Bl_idx, El_idx, Az_idx, flags = random_update()
+    whole = kathp.SparseAccumulator(nfreq=64, nbl=6, cell_shape=(3, 2, 2))
+    whole.update(Time_idx, Bl_idx, El_idx, Az_idx, flags)
+    first = kathp.SparseAccumulator(nfreq=64, nbl=6, cell_shape=(3, 2, 2))
+    second = kathp.SparseAccumulator(nfreq=64, nbl=6, cell_shape=(3, 2, 2))
+    first.update(Time_idx[:8], Bl_idx, El_idx[:8], Az_idx[:8], flags[:8])
+    second.update(Time_idx[8:], Bl_idx, El_idx[8:], Az_idx[8:], flags[8:])
+    merged = first.merge(second)
+    for got, expected in zip(merged.to_dense(), whole.to_dense()):
+        np.testing.assert_array_equal(got, expected)
+
+
+def test_antenna_numbers_keep_the_prefix():
+    numbers = kathp.antenna_numbers(['m000h', 's0000h', 'm063v', 's0001', 'm000'])
+    assert numbers.tolist() == [0, 64, 63, 65, 0]
+    with pytest.raises(ValueError, match='prefixes'):
+        kathp.antenna_numbers(['ant1'])
@@ -0,0 +1,41 @@
+"""Marginal sums and rollups kept next to the master cube."""
+import numpy as np
+import pytest
+
+pytest.importorskip('xarray')
+zarr = pytest.importorskip('zarr')
+
+import kathprfi_store as kstore  # noqa: E402
+from helpers import merge_all, read_cube, read_marginals  # noqa: E402
+from kathprfi_query import RFIStore  # noqa: E402
+
+
+def test_incremental_marginals_match_rebuild(archive, config, tmp_path):
+    # Few chunks keep the rebuild quick
+    config['zarr_chunks'] = 'baseline'
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive, config)
+    incremental = read_marginals(store)
+    kstore.build_marginals(store)
+    rebuilt = read_marginals(store)
+    assert incremental.keys() == rebuilt.keys()
+    for key in rebuilt:
+        np.testing.assert_array_equal(incremental[key][0], rebuilt[key][0])
+        np.testing.assert_array_equal(incremental[key][1], rebuilt[key][1])
+
+
+def test_length_marginals_match_length_binning(archive, config, tmp_path):
+    raw = str(tmp_path / 'raw.zarr')
+    binned = str(tmp_path / 'length.zarr')
+    merge_all(raw, archive, config)
+    merge_all(binned, archive, dict(config, baseline_binning='length'))
+    marginals = read_marginals(raw)
+    expected = read_marginals(binned)
+    assert (kstore.LENGTH,) not in expected
+    for got, want in zip(marginals[(kstore.LENGTH,), 1], expected[('baseline',), 1]):
+        np.testing.assert_array_equal(got, want)
+    for got, want in zip(marginals[('frequency', kstore.LENGTH), 1], read_cube(binned)[:2]):
+        np.testing.assert_array_equal(got, want.sum(axis=(0, 3, 4), dtype=np.uint64))
+    assert np.count_nonzero(expected[('baseline',), 1][1]) > 1
+    probability = RFIStore(raw).probability(keep=[kstore.LENGTH])
+    np.testing.assert_array_equal(probability['counter'], expected[('baseline',), 1][1])
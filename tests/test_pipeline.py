@@ -0,0 +1,112 @@
+"""Processing of whole observations."""
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+import kathprfi_pipeline as kp  # noqa: E402
+from helpers import assert_same_accumulator  # noqa: E402
+
+
+@pytest.mark.parametrize('engine', ['scatter', 'grouped'])
+def test_engines_match(archive, config, engine):
+    expected, _ = kp.process_observation(archive[0], config, time_chunk=8)
+    got, _ = kp.process_observation(archive[0], config, time_chunk=8, engine=engine)
+    assert_same_accumulator(got, expected)
+
+
+def test_metrics_count_unpacked_flags(archive, config):
+    import kathprfi_metrics as kmetrics
+    timer = kmetrics.StageTimer(archive[0])
+    kp.process_observation(archive[0], config, time_chunk=8, timer=timer)
+    record = timer.as_dict()
+    # One byte per boolean flag as read, not the packed bits handed to the kernel
+    assert record['flags'] > 0
+    assert record['bytes_fetched'] == record['flags']
+    assert record['peak_rss_mb'] > 0 and record['process_peak_rss_mb'] > 0
+    assert all(stage['peak_rss_mb'] <= record['peak_rss_mb'] for stage in record['stages'].values())
+
+
+def test_memory_plan_keeps_whole_dask_chunks(archive, config):
+    native = kp.native_time_chunk(archive[0])
+    assert native == 8
+    # A budget far too small for any block only lowers the blocks to one dask chunk
+    plan = kp.memory_plan(config, 1e-6, time_chunk=32, native_chunk=native)
+    assert plan.time_chunk == native
+    assert kp.observation_memory(1, native_chunk=native) > kp.observation_memory(native)
+
+
+def test_distributed_matches_sequential(archive, config):
+    distributed = pytest.importorskip('distributed')
+    # Threads in this process see the fake archive
+    with distributed.LocalCluster(n_workers=2, threads_per_worker=1, processes=False,
+                                  dashboard_address=None) as cluster:
+        total, freqs, good, bad = kp.run_distributed(archive, config, cluster.scheduler_address,
+                                                     time_chunk=8, fanin=2)
+    assert sorted(good) == sorted(archive) and bad == []
+    expected, expected_freqs = kp.process_observation(archive[0], config, time_chunk=8)
+    expected.merge(kp.process_observation(archive[1], config, time_chunk=8)[0])
+    np.testing.assert_allclose(freqs, expected_freqs)
+    for cell, blk in expected.cells.items():
+        np.testing.assert_array_equal(total.master[total.cells[cell]], expected.master[blk])
+        np.testing.assert_array_equal(total.counter[total.cells[cell]], expected.counter[blk])
+    assert total.cells.keys() == expected.cells.keys()
+
+
+def test_tree_reducer_refuses_other_layout(archive, config):
+    import kathprfi_single_file as kathp
+    acc, _ = kp.process_observation(archive[0], config, time_chunk=8)
+    reducer = kp.TreeReducer()
+    reducer.add(acc, archive[0])
+    with pytest.raises(ValueError):
+        reducer.add(kathp.SparseAccumulator(nfreq=64, nbl=6, cell_shape=(3, 2, 2)), archive[1])
+    assert reducer.labels == archive[:1]
+    assert_same_accumulator(reducer.result(), acc)
+
+
+def driver_parser(tmp_path):
+    import argparse
+    parser = argparse.ArgumentParser()
+    kp.add_driver_arguments(parser, str(tmp_path / 'out.zarr'))
+    return parser
+
+
+def driver_args(tmp_path, *options):
+    options = ['-b', str(tmp_path / 'bad.npy'), '-g', str(tmp_path / 'good.npy')] + list(options)
+    return driver_parser(tmp_path).parse_args(options)
+
+
+def test_driver_lists_only_written_files(archive, config, tmp_path, monkeypatch):
+    write_observation = kp.write_observation
+    calls = []
+
+    def broken_write(*args):
+        calls.append(args[0])
+        if len(calls) == 1:
+            raise OSError('disk full')
+        return write_observation(*args)
+    monkeypatch.setattr(kp, 'write_observation', broken_write)
+    kp.run_driver(driver_args(tmp_path), config, archive)
+    # The first write fails, so only the second file counts as good
+    assert len(calls) == 2
+    assert list(np.load(tmp_path / 'good.npy')) == archive[1:]
+    assert list(np.load(tmp_path / 'bad.npy')) == []
+
+
+def test_driver_refuses_existing_output(archive, config, tmp_path):
+    os.makedirs(kp.observation_output(str(tmp_path / 'out.zarr'), archive[0]))
+    with pytest.raises(SystemExit):
+        kp.driver_config(driver_parser(tmp_path), driver_args(tmp_path, '-w', '2'), config)
+    with pytest.raises(FileExistsError):
+        kp.run_driver(driver_args(tmp_path), config, archive)
+    assert not os.path.exists(tmp_path / 'good.npy')
+
+
+def test_driver_time_options(config, tmp_path):
+    args = driver_args(tmp_path, '-F', 'LST', '-N', '30')
+    kp.driver_config(driver_parser(tmp_path), args, config)
+    assert (config['time_frame'], config['time_bin_minutes']) == ('LST', '30')
+    with pytest.raises(SystemExit):
+        kp.driver_config(driver_parser(tmp_path), driver_args(tmp_path, '-N', '7'), config)
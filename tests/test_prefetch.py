@@ -0,0 +1,14 @@
+"""Reading flag blocks ahead of the accumulation."""
+import pytest
+
+pytest.importorskip('numba')
+
+import kathprfi_pipeline as kp  # noqa: E402
+from helpers import assert_same_accumulator  # noqa: E402
+
+
+def test_prefetch_matches_foreground(archive, config):
+    foreground = {path: acc for path, acc, _, _ in kp.iter_observations(archive, config, 8)}
+    for path, acc, _, error in kp.iter_observations(archive, config, 8, prefetch=2):
+        assert error is None
+        assert_same_accumulator(acc, foreground[path])
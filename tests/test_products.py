@@ -0,0 +1,19 @@
+"""Several polarisations and flag types accumulated in one pass over the data."""
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+import kathprfi_pipeline as kp  # noqa: E402
+from helpers import assert_same_accumulator  # noqa: E402
+
+
+def test_products_match_single_product(archive, config):
+    config.update({'pols': 'HH,VV,HV', 'flag_types': 'cal_rfi,ingest_rfi'})
+    accs, freqs = kp.process_products(archive[0], config, time_chunk=8)
+    assert sorted(accs) == sorted(kp.products(config))
+    for product, acc in accs.items():
+        expected, expected_freqs = kp.process_observation(
+            archive[0], kp.product_config(config, product), time_chunk=8)
+        assert_same_accumulator(acc, expected)
+        np.testing.assert_allclose(freqs, expected_freqs)
@@ -0,0 +1,44 @@
+"""Probability queries over a master store."""
+import numpy as np
+import pytest
+
+pytest.importorskip('xarray')
+zarr = pytest.importorskip('zarr')
+
+import kathprfi_pipeline as kp  # noqa: E402
+import kathprfi_store as kstore  # noqa: E402
+from kathprfi_query import RFIStore  # noqa: E402
+
+
+@pytest.fixture
+def store(archive, config, tmp_path):
+    path = str(tmp_path / 'master.zarr')
+    for rdb in archive:
+        acc, freqs = kp.process_observation(rdb, config, time_chunk=8)
+        kp.merge_observation(path, acc, freqs, [kstore.capture_block_id(rdb)], config)
+    return path
+
+
+@pytest.mark.parametrize('keep', [(), ('elevation',), ('frequency', 'elevation')])
+def test_point_selection_keeps_the_dimension(store, keep):
+    rfi = RFIStore(store)
+    elevation = float(rfi.cube['elevation'][3])
+    result = rfi.probability(keep, elevation=elevation + 0.1)
+    expected = rfi.probability(keep, elevation=(elevation, elevation))
+    assert result['counter'].dims == expected['counter'].dims
+    np.testing.assert_array_equal(result['counter'], expected['counter'])
+    if 'elevation' in keep:
+        assert result['elevation'].values.tolist() == [elevation]
+
+
+def test_unfinished_merge_is_refused(store, archive, config):
+    acc, freqs = kp.process_observation(archive[0], config, time_chunk=8)
+    cbids = ['1700000003']
+    # A merge that stopped after its first region, as seen by readers
+    group = zarr.open_group(store, path=kstore.GROUP, mode='r+')
+    kstore.add_cells(group['counter'], dict(list(acc.cells.items())[:1]), acc.counter)
+    group.attrs['pending_capture_blocks'] = cbids
+    zarr.consolidate_metadata(store)
+    with pytest.raises(ValueError, match='unfinished merge of 1700000003'):
+        RFIStore(store)
+    assert RFIStore(store, partial=True).probability()['counter'] > 0
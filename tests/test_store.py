@@ -0,0 +1,127 @@
+"""Merges into the master store, the merges it refuses and its dtype promotions."""
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('xarray')
+zarr = pytest.importorskip('zarr')
+
+import kathprfi_pipeline as kp  # noqa: E402
+import kathprfi_store as kstore  # noqa: E402
+from helpers import Crash, merge_all, read_cube  # noqa: E402
+
+
+def test_merge_matches_dense_sum(archive, config, tmp_path):
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive, config)
+    master, counter, attrs = read_cube(store)
+    expected_master = expected_counter = 0
+    for path in archive:
+        acc, _ = kp.process_observation(path, config, time_chunk=8)
+        dense_master, dense_counter = acc.to_dense()
+        expected_master = expected_master + dense_master.astype(np.uint64)
+        expected_counter = expected_counter + dense_counter.astype(np.uint64)
+    np.testing.assert_array_equal(master, expected_master)
+    np.testing.assert_array_equal(counter, expected_counter)
+    assert attrs['merged_capture_blocks'] == [kstore.capture_block_id(p) for p in archive]
+    assert attrs['counter_bound'] >= counter.max()
+
+
+def test_written_observation_is_sparse(archive, config, tmp_path):
+    path = str(tmp_path / 'output.zarr')
+    acc, freqs = kp.process_observation(archive[0], config, time_chunk=8)
+    kp.write_observation(path, acc, freqs, [kstore.capture_block_id(archive[0])], config)
+    master, counter, attrs = read_cube(path)
+    dense_master, dense_counter = acc.to_dense()
+    np.testing.assert_array_equal(master, dense_master)
+    np.testing.assert_array_equal(counter, dense_counter)
+    # Only the visited cells are written with the default cell chunks
+    chunks = zarr.open_group(path, path=kstore.GROUP, mode='r')['master'].nchunks_initialized
+    assert chunks == len(acc.cells)
+    with pytest.raises(FileExistsError):
+        kp.write_observation(path, acc, freqs, [kstore.capture_block_id(archive[0])], config)
+
+
+def test_merge_is_skipped_when_merged(archive, config, tmp_path):
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive[:1], config)
+    acc, freqs = kp.process_observation(archive[0], config, time_chunk=8)
+    assert not kp.merge_observation(store, acc, freqs, [kstore.capture_block_id(archive[0])],
+                                    config)
+    master, _, _ = read_cube(store)
+    np.testing.assert_array_equal(master, acc.to_dense()[0])
+
+
+@pytest.mark.parametrize('change, match', [
+    ({'time_bin_minutes': 30}, 'time coordinate of 24 values'),
+    ({'time_frame': 'UTC'}, "time_frame 'SAST'"),
+    ({'frequency': 1e6}, 'frequency coordinate'),
+])
+def test_merge_with_other_coordinates_is_refused(archive, config, tmp_path, change, match):
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive[:1], config)
+    acc, freqs = kp.process_observation(archive[1], config, time_chunk=8)
+    other = dict(config, **{key: value for key, value in change.items() if key != 'frequency'})
+    with pytest.raises(ValueError, match=match):
+        kp.merge_observation(store, acc, freqs + change.get('frequency', 0),
+                             [kstore.capture_block_id(archive[1])], other)
+    assert kstore.merged_capture_blocks(store) == {kstore.capture_block_id(archive[0])}
+
+
+@pytest.mark.parametrize('first, second, match', [
+    ({'baseline_binning': 'length', 'baseline_edges': '0,100,500,2000'},
+     {'baseline_binning': 'length', 'baseline_edges': '0,1000,3000,6000'}, 'baseline coordinate'),
+    ({}, {'baseline_binning': 'antenna'}, 'raw baseline axis'),
+])
+def test_merge_with_other_baseline_binning_is_refused(archive, config, tmp_path, first, second,
+                                                      match):
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive[:1], dict(config, **first))
+    other = dict(config, **second)
+    acc, freqs = kp.process_observation(archive[1], other, time_chunk=8)
+    with pytest.raises(ValueError, match=match):
+        kp.merge_observation(store, acc, freqs, [kstore.capture_block_id(archive[1])], other)
+    assert kstore.merged_capture_blocks(store) == {kstore.capture_block_id(archive[0])}
+
+
+@pytest.mark.parametrize('where', ['copy', 'swap'])
+def test_interrupted_promotion_is_finished(archive, config, tmp_path, monkeypatch, where):
+    store = str(tmp_path / 'master.zarr')
+    merge_all(store, archive[:1], config)
+    master, counter, _ = read_cube(store)
+    if where == 'copy':
+        def crashing(shape, chunks):
+            raise Crash()
+
+        monkeypatch.setattr(kstore, 'chunk_regions', crashing)
+    else:
+        # Crash once the master array is replaced, but not yet the counter array
+        rename = os.rename
+        renames = []
+
+        def crashing(src, dst):
+            renames.append(src)
+            if len(renames) == 3:
+                raise Crash()
+            rename(src, dst)
+
+        monkeypatch.setattr(os, 'rename', crashing)
+    with pytest.raises(Crash):
+        kstore.promote_store(store, np.uint64, 'test')
+    monkeypatch.undo()
+    assert kstore.finish_promotion(store)
+    assert not kstore.finish_promotion(store)
+    got_master, got_counter, attrs = read_cube(store)
+    promoted = where == 'swap'
+    assert got_master.dtype == got_counter.dtype == (np.uint64 if promoted else np.uint32)
+    assert len(attrs['dtype_promotions']) == promoted and 'promotion' not in attrs
+    np.testing.assert_array_equal(got_master, master)
+    np.testing.assert_array_equal(got_counter, counter)
+    assert not [name for name in os.listdir(os.path.join(store, kstore.GROUP))
+                if name.endswith((kstore.PROMOTED, kstore.REPLACED))]
+
+
+def test_promotion_needs_a_local_store():
+    with pytest.raises(ValueError, match='local directory'):
+        kstore.promote_store('s3://bucket/master.zarr', np.uint64)
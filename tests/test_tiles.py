@@ -0,0 +1,54 @@
+"""Frequency tiles read and merged into the master store one at a time."""
+import numpy as np
+import pytest
+
+pytest.importorskip('xarray')
+zarr = pytest.importorskip('zarr')
+
+import kathprfi_pipeline as kp  # noqa: E402
+import kathprfi_store as kstore  # noqa: E402
+from helpers import (BrokenArray, Crash, assert_same_store, merge_all, read_cube,  # noqa: E402
+                     read_marginals)
+
+
+def test_tiled_matches_full_band(archive, config, tmp_path):
+    full = str(tmp_path / 'full.zarr')
+    tiled = str(tmp_path / 'tiled.zarr')
+    merge_all(full, archive, config)
+    for path in archive:
+        kp.process_tiled(path, config, tiled, tile=64, time_chunk=8)
+    for got, expected in zip(read_cube(tiled)[:2], read_cube(full)[:2]):
+        np.testing.assert_array_equal(got, expected)
+    assert read_cube(tiled)[2]['counter_bound'] == read_cube(full)[2]['counter_bound']
+    tiled_marginals = read_marginals(tiled)
+    for key, (master, counter) in read_marginals(full).items():
+        np.testing.assert_array_equal(tiled_marginals[key][0], master)
+        np.testing.assert_array_equal(tiled_marginals[key][1], counter)
+
+
+def test_interrupted_tiles_resume(archive, config, tmp_path, monkeypatch):
+    full = str(tmp_path / 'full.zarr')
+    tiled = str(tmp_path / 'tiled.zarr')
+    merge_all(full, archive[:1], config)
+    journals = []
+    write = kstore.MergeJournal.write
+
+    def crashing(self, array, selection, compute):
+        # Crash in the second step of the third tile, after journaling it
+        if self not in journals:
+            journals.append(self)
+        if len(journals) == 3 and self.step == 0:
+            write(self, BrokenArray(), selection, compute)
+            raise Crash()
+        write(self, array, selection, compute)
+
+    monkeypatch.setattr(kstore.MergeJournal, 'write', crashing)
+    with pytest.raises(Crash):
+        kp.process_tiled(archive[0], config, tiled, tile=64, time_chunk=8)
+    monkeypatch.undo()
+    cbids = [kstore.capture_block_id(archive[0])]
+    assert kstore.merged_tiles(tiled, cbids) == {(0, 64), (64, 128)}
+    with pytest.raises(ValueError, match='same tiles'):
+        kp.process_tiled(archive[0], config, tiled, tile=128, time_chunk=8)
+    kp.process_tiled(archive[0], config, tiled, tile=64, time_chunk=8)
+    assert_same_store(tiled, full)